@@ -0,0 +1,159 @@
+import os
+import argparse
+import subprocess
+import tempfile
+import numpy as np
+from avmeta import get_stream, get_video_duration
+from mshit import save_metadata
+from logging_config import logger
+from tracing import TracedPopen
+
+# Automatic interest scoring.
+# The input is decoded once at a low resolution and frame rate, and two statistics are collected per frame:
+#   - the mean absolute difference from the previous frame (motion energy), computed here as the frames stream in
+#   - ffmpeg's scdet scene change score, printed to a side file by the metadata filter
+# The per-frame statistics are then binned into windows, and windows with little going on get a low interest.
+
+
+def read_scene_scores(metadata_file):
+    """Parse the pts_time/lavfi.scd.score pairs written by ffmpeg's metadata=print filter."""
+    times, scores = [], []
+    pts_time = None
+    with open(metadata_file, "r") as f:
+        for line in f:
+            if line.startswith("frame:"):
+                pts_time = float(line.rsplit("pts_time:", 1)[1])
+            elif line.startswith("lavfi.scd.score=") and pts_time is not None:
+                times.append(pts_time)
+                scores.append(float(line.split("=", 1)[1]))
+    return np.array(times, dtype=np.float64), np.array(scores, dtype=np.float64)
+
+
+def collect_frame_stats(input_file, fps=2.0, size=(160, 90), skip_nonref=True):
+    """Decode the input once at low resolution and frame rate, and collect per-frame statistics.
+    Frames are streamed through a pipe and only the previous one is kept, so memory use doesn't depend on the input.
+    Times are relative to the first video frame, whatever the stream's start_time.
+    Returns:
+        (frame_times, motion_energy, scene_times, scene_scores) as numpy arrays.
+    """
+    width, height = size
+    frame_size = width * height
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scores_file = os.path.join(tmp_dir, "scd.txt")
+        # stderr goes to a file, a pipe nobody reads while we read stdout could fill up and stall ffmpeg
+        stderr_file = os.path.join(tmp_dir, "stderr.txt")
+        video_filter = (
+            f"fps={fps},scale={width}:{height}:flags=fast_bilinear,format=gray,"
+            f"scdet=threshold=100,metadata=mode=print:key=lavfi.scd.score:file={scores_file}"
+        )
+        ffmpeg_cmd = [
+            "ffmpeg", "-v", "error",
+            # Don't decode frames nothing else references, since we're dropping most frames anyway
+            *(["-skip_frame", "nonref"] if skip_nonref else []),
+            "-i", input_file,
+            "-map", "0:v:0", "-an", "-sn",
+            "-vf", video_filter,
+            "-f", "rawvideo", "-pix_fmt", "gray", "-"
+        ]
+        logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+
+        energy = []
+        prev = None
+        with open(stderr_file, "wb") as stderr, \
+                TracedPopen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=stderr, bufsize=frame_size * 4) as proc:
+            while True:
+                buf = proc.stdout.read(frame_size)
+                if len(buf) < frame_size:
+                    break
+                frame = np.frombuffer(buf, dtype=np.uint8).astype(np.int16)
+                energy.append(0.0 if prev is None else float(np.abs(frame - prev).mean()))
+                prev = frame
+        if proc.returncode != 0:
+            with open(stderr_file, "r", errors="replace") as f:
+                logger.debug(f"FFmpeg stderr: {f.read()}")
+            raise RuntimeError(f"FFmpeg command failed with return code {proc.returncode}")
+
+        scene_times, scene_scores = read_scene_scores(scores_file)
+
+    # scdet reports the frames' pts, which start at the stream's start_time rather than at 0 like frame_times
+    start_time = get_stream(input_file).get("start_time", "N/A")
+    if start_time != "N/A":
+        scene_times = np.maximum(scene_times - float(start_time), 0.0)
+
+    energy = np.array(energy, dtype=np.float64)
+    frame_times = np.arange(len(energy), dtype=np.float64) / fps
+    logger.info(f"Collected statistics for {len(energy)} frames of {input_file}")
+    return frame_times, energy, scene_times, scene_scores
+
+
+def score_windows(duration, frame_times, energy, scene_times, scene_scores, window=1.0,
+                  min_interest=0.25, levels=4, cut_threshold=10.0):
+    """Turn per-frame statistics into one interest value per window.
+    Motion energy is normalized against the file's own 95th percentile, and windows containing a scene cut are
+    treated as fully active. The activity is quantized to `levels` interest values between min_interest and 1.
+    """
+    n_windows = max(1, int(np.ceil(duration / window)))
+
+    bins = np.minimum((frame_times / window).astype(np.int64), n_windows - 1)
+    counts = np.bincount(bins, minlength=n_windows)
+    motion = np.bincount(bins, weights=energy, minlength=n_windows) / np.maximum(counts, 1)
+
+    scene = np.zeros(n_windows)
+    if len(scene_times):
+        scene_bins = np.minimum((scene_times / window).astype(np.int64), n_windows - 1)
+        np.maximum.at(scene, scene_bins, scene_scores)
+
+    reference = np.percentile(motion, 95) if motion.any() else 1.0
+    activity = np.clip(motion / max(reference, 1e-9), 0, 1)
+    activity[scene >= cut_threshold] = 1.0
+
+    steps = max(levels - 1, 1)
+    return min_interest + (1 - min_interest) * np.round(activity * steps) / steps
+
+
+def windows_to_segments(interest, duration, window=1.0):
+    """Merge runs of windows with the same interest into segments, leaving out the pass-through (interest 1) ones."""
+    if len(interest) == 0:
+        return []
+    change_points = np.flatnonzero(np.diff(interest)) + 1
+    starts = np.concatenate(([0], change_points))
+    ends = np.concatenate((change_points, [len(interest)]))
+    segments = []
+    for start, end in zip(starts, ends):
+        value = float(interest[start])
+        if value >= 1.0:
+            continue
+        segments.append({"start": float(start * window), "end": float(min(end * window, duration)), "interest": round(value, 4)})
+    return segments
+
+
+def analyze_video(input_file, fps=2.0, size=(160, 90), window=1.0, min_interest=0.25, levels=4, cut_threshold=10.0):
+    """Score a video's interest automatically. Returns a segment list ready for add_pass_through_segments."""
+    duration = get_video_duration(input_file)
+    frame_times, energy, scene_times, scene_scores = collect_frame_stats(input_file, fps=fps, size=size)
+    interest = score_windows(duration, frame_times, energy, scene_times, scene_scores, window=window,
+                             min_interest=min_interest, levels=levels, cut_threshold=cut_threshold)
+    segments = windows_to_segments(interest, duration, window=window)
+    logger.info(f"Found {len(segments)} segments to compress in {input_file}")
+    return segments
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Automatically score the interest of a video's scenes, and write them to an mshit file")
+    parser.add_argument("input_video", help="Input video file")
+    parser.add_argument("-o", "--output", help="Metadata file to write. Default: <input_video>.mshit")
+    parser.add_argument("--fps", type=float, default=2.0, help="Frames per second to analyze. Default: 2")
+    parser.add_argument("--size", type=str, default="160x90", help="Resolution to analyze at. Default: 160x90")
+    parser.add_argument("-w", "--window", type=float, default=1.0, help="Length in seconds of the windows interest is scored over. Default: 1")
+    parser.add_argument("--min_interest", type=float, default=0.25, help="Interest given to windows with no activity. Default: 0.25")
+    parser.add_argument("--levels", type=int, default=4, help="Number of distinct interest values to use. Default: 4")
+    parser.add_argument("--cut_threshold", type=float, default=10.0, help="scdet score (0-100) above which a window counts as a scene cut. Default: 10")
+    parser.add_argument("--binary_mshit", help="Write the mshit file in the compact binary format.", action="store_true")
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.lower().split("x"))
+    segments = analyze_video(args.input_video, fps=args.fps, size=(width, height), window=args.window,
+                             min_interest=args.min_interest, levels=args.levels, cut_threshold=args.cut_threshold)
+    output = args.output if args.output else f"{os.path.splitext(args.input_video)[0]}.mshit"
+    save_metadata(output, get_video_duration(args.input_video), segments, binary=args.binary_mshit)
+    print(f"Wrote {len(segments)} segments to {output}")
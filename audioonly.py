@@ -0,0 +1,79 @@
+from logging_config import logger
+from progress import run_ffmpeg
+
+# Audio-only fast path. Files without a video stream skip all of the video probing, keyframe snapping and
+# segment splitting, and the whole audio track is processed in one ffmpeg run with one trim per segment.
+
+# Encoders that take a -b:a bitrate. Lossless and PCM codecs don't.
+LOSSY_AUDIO_ENCODERS = ("aac", "aac_at", "libopus", "libvorbis", "libmp3lame", "ac3", "eac3")
+
+
+def atempo_chain(factor):
+    """Build an atempo filter chain for a tempo factor. Older ffmpeg builds limit each atempo to 0.5-2.0."""
+    filters = []
+    while factor > 2.0:
+        filters.append("atempo=2.0")
+        factor /= 2.0
+    while factor < 0.5:
+        filters.append("atempo=0.5")
+        factor /= 0.5
+    filters.append(f"atempo={factor}")
+    return ",".join(filters)
+
+
+def build_audio_graph(segments, sample_rate, mode="encode", tempo=False):
+    """Build one filter_complex graph that trims every segment, changes its speed and concatenates them.
+    Args:
+        segments: Segments relative to the input, in order.
+        sample_rate: Sample rate of the input.
+        mode: "encode" speeds segments up by 1/interest, "decode" slows them back down by interest.
+        tempo: Use atempo (keeps the pitch) instead of asetrate/aresample (changes the pitch, like the video path).
+    Raises:
+        ValueError: None of the segments has any length.
+    """
+    segments = [seg for seg in segments if seg["end"] > seg["start"]]
+    n = len(segments)
+    if n == 0:
+        raise ValueError("Can't build an audio filter graph without segments, every segment is empty")
+    graph = [f"[0:a]asplit={n}" + "".join(f"[ain{i}]" for i in range(n))]
+    concat_inputs = ""
+    for i, seg in enumerate(segments):
+        start, end, interest = seg["start"], seg["end"], seg["interest"]
+        audio_filter = f"[ain{i}]atrim=start={start}:end={end},asetpts=PTS-STARTPTS"
+        if interest != 1.0:
+            speed_factor = 1 / interest if mode == "encode" else interest
+            if tempo:
+                audio_filter += f",{atempo_chain(speed_factor)}"
+            else:
+                audio_filter += f",asetrate={sample_rate}*{speed_factor},aresample={sample_rate}"
+        graph.append(f"{audio_filter}[a{i}]")
+        concat_inputs += f"[a{i}]"
+    graph.append(f"{concat_inputs}concat=n={n}:v=0:a=1[a]")
+    return ";".join(graph)
+
+
+def process_audio(input_file, output_file, segments, metadata, mode="encode", tempo=False, run=run_ffmpeg):
+    """Encode or decode a whole audio-only file in a single ffmpeg run.
+    The output container is picked by ffmpeg from output_file's extension.
+    Args:
+        metadata: get_audio_metadata() of the input.
+        run: Function to run ffmpeg with, e.g. a codec's run_ffmpeg.
+    """
+    graph = build_audio_graph(segments, metadata["sample_rate"], mode=mode, tempo=tempo)
+    bitrate_args = ["-b:a", str(int(metadata["abitrate"]))] if metadata["acodec"] in LOSSY_AUDIO_ENCODERS else []
+    ffmpeg_cmd = [
+        "ffmpeg", "-y",
+        "-i", input_file,
+        "-filter_complex", graph,
+        "-map", "[a]",
+        "-c:a", metadata["acodec"],
+        *bitrate_args,
+        output_file
+    ]
+
+    logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+    result = run(ffmpeg_cmd)
+
+    if result.returncode != 0:
+        logger.debug(f"FFmpeg stderr: {result.stderr}")
+        raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
@@ -1,23 +1,170 @@
+import json
 import math
 import os
 import subprocess
+import threading
+from contextlib import contextmanager
 from platform import system
 import warnings
 from typing import List
 from mdtypes import EssentialMetadataDict, FilterDict
 from logging_config import logger
+from fileops import file_identity
+from pktindex import get_packet_index
+from tracing import traced_run
+try:
+    import fcntl
+except ImportError:
+    # No inter-process locking of the probe cache on Windows
+    fcntl = None
+
+# Probe results are memoized in memory and persisted to disk, keyed by path, size and mtime,
+# so a file that hasn't changed is only ever ffprobed once.
+# The disk cache is shared by every process, so it's only changed under an exclusive lock on a lock file next to it,
+# and it's kept in least recently used order (dicts keep insertion order, so hits move their entry to the end).
+# Files in temp dirs (registered by each ShitCodec) are rewritten every run, and are never persisted.
+PROBE_CACHE_FILE = os.environ.get("SHIT_PROBE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "shit", "probe_cache.json"))
+PROBE_CACHE_MAX_ENTRIES = 1024
+
+_probe_cache = {}
+_keyframe_seeds = {}
+_transient_dirs = set()
+_probe_lock = threading.RLock()
+
+def add_transient_dir(path: str):
+    """Don't persist probes of files under path, e.g. a temp dir whose files are rewritten every run."""
+    with _probe_lock:
+        _transient_dirs.add(os.path.join(os.path.abspath(path), ""))
+
+def _is_transient(input_file: str) -> bool:
+    path = os.path.abspath(input_file)
+    return any(path.startswith(d) for d in _transient_dirs)
+
+def _load_disk_cache() -> dict:
+    try:
+        with open(PROBE_CACHE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+@contextmanager
+def _locked_disk_cache():
+    """Hold the inter-process lock on the disk cache."""
+    os.makedirs(os.path.dirname(PROBE_CACHE_FILE), exist_ok=True)
+    with open(f"{PROBE_CACHE_FILE}.lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _update_disk_cache(update):
+    """Read, change (update(disk) changes it in place) and write back the disk cache, under its lock."""
+    try:
+        with _locked_disk_cache():
+            disk = _load_disk_cache()
+            update(disk)
+            # Least recently used entries are first
+            while len(disk) > PROBE_CACHE_MAX_ENTRIES:
+                disk.pop(next(iter(disk)))
+            tmp_file = f"{PROBE_CACHE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(disk, f)
+            os.replace(tmp_file, PROBE_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Could not write probe cache {PROBE_CACHE_FILE}: {e}")
+
+def _store_disk_cache(key: str, probe: dict):
+    """Write a probe entry to the on-disk cache, dropping stale entries for the same path."""
+    path = key.rsplit("|", 2)[0]
+    if _is_transient(path):
+        return
+    def update(disk):
+        for stale in [k for k in disk if k.rsplit("|", 2)[0] == path]:
+            del disk[stale]
+        disk[key] = probe
+    _update_disk_cache(update)
+
+def _touch_disk_cache(key: str):
+    """Mark a disk cache entry as just used."""
+    def update(disk):
+        if key in disk:
+            disk[key] = disk.pop(key)
+    _update_disk_cache(update)
+
+def probe_file(input_file: str) -> dict:
+    """Probes a file once with ffprobe and memoizes the result.
+    Args:
+        input_file: Path to the input file.
+    Returns:
+        The parsed `ffprobe -show_format -show_streams` output, plus a "derived" dict for computed values.
+    """
+    key = file_identity(input_file)
+    with _probe_lock:
+        if key in _probe_cache:
+            return _probe_cache[key]
+        disk = _load_disk_cache()
+        if key in disk:
+            _probe_cache[key] = disk[key]
+            _touch_disk_cache(key)
+            return disk[key]
+
+    result = traced_run(
+        ["ffprobe", "-v", "error", "-show_format", "-show_streams", "-of", "json", input_file],
+        stdout=subprocess.PIPE, text=True, check=True
+    )
+    probe = json.loads(result.stdout)
+    probe.setdefault("streams", [])
+    probe.setdefault("format", {})
+    probe["derived"] = {}
+    logger.debug(f"Probed {input_file}")
+
+    with _probe_lock:
+        _probe_cache[key] = probe
+        _store_disk_cache(key, probe)
+    return probe
+
+def update_probe_cache(input_file: str, **derived):
+    """Stores computed values (e.g. averaged bitrates) alongside a file's cached probe."""
+    probe = probe_file(input_file)
+    with _probe_lock:
+        probe["derived"].update(derived)
+        _store_disk_cache(file_identity(input_file), probe)
+
+def seed_probe_cache(input_file: str, probe: dict, keyframes=None):
+    """Fill the in-memory caches for a file with probe results stored elsewhere (e.g. in an mshit file)."""
+    key = file_identity(input_file)
+    probe = {"streams": probe.get("streams", []), "format": probe.get("format", {}), "derived": probe.get("derived", {})}
+    with _probe_lock:
+        _probe_cache[key] = probe
+        if keyframes is not None:
+            _keyframe_seeds[key] = sorted(keyframes)
+    logger.debug(f"Seeded probe cache for {input_file}")
+
+def clear_probe_cache():
+    """Forget all in-memory probe results. The on-disk cache is left alone."""
+    with _probe_lock:
+        _probe_cache.clear()
+
+def get_stream(input_file: str, type: str = "video") -> dict:
+    """Returns the first audio or video stream of a file, or an empty dict if there isn't one."""
+    codec_type = "audio" if type[0].lower() == "a" else "video"
+    for stream in probe_file(input_file)["streams"]:
+        # Skip cover art, which shows up as a video stream
+        if stream.get("disposition", {}).get("attached_pic"):
+            continue
+        if stream.get("codec_type") == codec_type:
+            return stream
+    return {}
 
 def get_video_duration(input_file: str) -> float:
-    result = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", input_file], stdout=subprocess.PIPE, text=True, check=True)
-    return float(result.stdout.strip())
+    return float(probe_file(input_file)["format"]["duration"])
 
 def get_audio_sample_rate(input_file: str) -> float:
     try:
-        result = subprocess.run(
-            ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=sample_rate", "-of", "csv=p=0", input_file],
-            stdout=subprocess.PIPE, text=True, check=True
-        )
-        sample_rate = result.stdout.strip()
+        sample_rate = get_stream(input_file, "audio").get("sample_rate", "")
         if not sample_rate:
             raise ValueError("No audio stream found")
         return float(sample_rate)
@@ -37,82 +184,107 @@ def get_bit_rate(input_file: str, type: str = "video") -> float:
         The bitrate in bits per second.
     """
     audio = type[0].lower() == "a"  # only handle video or audio
-    typestr = "a:0" if audio else "v:0"  # defaults to video if unknown
+    derived_key = "abitrate" if audio else "vbitrate"
 
     # Try to get bitrate without having to compute
-    try:
-        metadata_check_br = subprocess.run(
-            ["ffprobe", "-v", "error", "-select_streams", typestr, "-show_entries", "stream=bit_rate", "-of", "csv=p=0", input_file],
-            stdout=subprocess.PIPE, text=True, check=True
-        ).stdout.strip().split(',')
-    except subprocess.CalledProcessError:
-        logger.error("Error getting bitrate from metadata")
-        metadata_check_br = ["N/A"]
-
-    if metadata_check_br[0] != "N/A":
-        if metadata_check_br[0] == "":
-            return 1
-        return int(metadata_check_br[0])
-
-    # Bitrate wasn't stored in the metadata, so we calculate it
-    if metadata_check_br[0] == "N/A":
-        logger.debug(f"{input_file} {'audio' if audio else 'video'} bitrate not found, computing average...")
-        fail_cmd = ["ffprobe", "-v", "error", "-select_streams", typestr, "-show_packets", "-show_entries", "packet=size", "-of", "csv=p=0", input_file]
-        result = subprocess.run(fail_cmd, stdout=subprocess.PIPE, text=True, check=True).stdout.strip().split('\n')
-        #logger.debug(fail_cmd)
-        #logger.debug(result)
-        total_size = 0
-        for size in result:
-            # Handle specific output from an opus file
-            if ',' in size:
-                size = size.split(',')[0]
-            total_size += int(size)
-        total_size = total_size * 8
-        duration = get_video_duration(input_file)
-        logger.debug(f"{input_file} {'audio' if audio else 'video'} computed avg bitrate: {total_size / duration:.2f}bps")
-        return total_size / duration
+    stream = get_stream(input_file, type)
+    if not stream:
+        return 1
+    if stream.get("bit_rate", "N/A") != "N/A":
+        return int(stream["bit_rate"])
+
+    derived = probe_file(input_file)["derived"]
+    if derived_key in derived:
+        return derived[derived_key]
+
+    # Bitrate wasn't stored in the metadata, so we calculate it from the packet index
+    logger.debug(f"{input_file} {'audio' if audio else 'video'} bitrate not found, computing average...")
+    duration = get_video_duration(input_file)
+    bit_rate = get_packet_index(input_file).stream(stream["index"]).average_bit_rate(duration)
+    logger.debug(f"{input_file} {'audio' if audio else 'video'} computed avg bitrate: {bit_rate:.2f}bps")
+    update_probe_cache(input_file, **{derived_key: bit_rate})
+    return bit_rate
+
+def get_bit_rate_between(input_file: str, start: float, end: float, type: str = "video") -> float:
+    """Computes the average video/audio bitrate of a time range of a file from its packet index."""
+    stream = get_stream(input_file, type)
+    if not stream:
+        return 1
+    return get_packet_index(input_file).stream(stream["index"]).bit_rate_between(start, end)
+
+def get_keyframes(input_file: str, sidecar_dir: str = None):
+    """Returns the sorted keyframe times of a file's video stream.
+    Args:
+        input_file: Path to the input file.
+        sidecar_dir: Optional directory to persist the packet index in.
+    """
+    seeded = _keyframe_seeds.get(file_identity(input_file))
+    if seeded is not None:
+        return seeded
+    stream = get_stream(input_file, "video")
+    if not stream:
+        return []
+    return get_packet_index(input_file, sidecar_dir).stream(stream["index"]).keyframes
+
+def is_intra_only(input_file: str) -> bool:
+    """Whether every packet of a file's video stream is a keyframe, as in ProRes, DNxHD or MJPEG."""
+    stream = get_stream(input_file, "video")
+    if not stream:
+        return False
+    packets = get_packet_index(input_file).stream(stream["index"])
+    return len(packets) > 0 and all(packets.key)
 
 def get_bit_frame_rate(input_file: str) -> float:
   meta = get_video_metadata(input_file)
   return meta["vbitrate"] / meta["fps"]
 
 
+def get_audio_encoder(acodec: str) -> str:
+  """Maps an audio codec name to the encoder ffmpeg uses for it."""
+  # Convert opus to libopus, vorbis to libvorbis and mp3 to libmp3lame
+  encoders = {"opus": "libopus", "vorbis": "libvorbis", "mp3": "libmp3lame"}
+  acodec = encoders.get(acodec, acodec)
+  # use the Apple hardware codecs on macOS
+  if system() == "Darwin" and acodec == "aac":
+    acodec = "aac_at"
+  return acodec
+
+
+def has_video(input_file: str) -> bool:
+  return bool(get_stream(input_file, "video"))
+
+
+def get_audio_metadata(input_file: str) -> dict:
+  """Gets the audio settings of a file, without touching its video stream (if there is one)."""
+  audio_stream = get_stream(input_file, "audio")
+  return {
+    "acodec": get_audio_encoder(audio_stream.get("codec_name", "aac")),
+    "abitrate": get_bit_rate(input_file, type="audio"),
+    "sample_rate": get_audio_sample_rate(input_file),
+  }
+
+
 def get_video_metadata(input_file: str) -> EssentialMetadataDict:
   # This function is a bit messy and can result in bugs if you're not careful about handling codec settings
-  video_cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=codec_name,width,height,r_frame_rate", "-of", "csv=p=0", input_file]
-  audio_cmd = ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=codec_name", "-of", "csv=p=0", input_file]
-  format_cmd = ["ffprobe", "-v", "error", "-show_entries", "format=bit_rate", "-of", "csv=p=0", input_file]
-
-  video_output = subprocess.run(video_cmd, stdout=subprocess.PIPE, text=True, check=True).stdout.strip()
-  audio_output = subprocess.run(audio_cmd, stdout=subprocess.PIPE, text=True, check=True).stdout.strip()
-  format_output = subprocess.run(format_cmd, stdout=subprocess.PIPE, text=True, check=True).stdout.strip()
-
-  video_result = video_output.split(',') if video_output else []
-  audio_result = audio_output.split(',') if audio_output else []
-  format_result = format_output.split(',') if format_output else []
-#
-#    if format_result[0] == "N/A":
-#      #print(video_size)
-
-  vcodec = video_result[0] if len(video_result) > 0 else "h264"
-  width = int(video_result[1]) if len(video_result) > 1 and video_result[1].isdigit() else 1920
-  height = int(video_result[2]) if len(video_result) > 2 and video_result[2].isdigit() else 1080
-  fps_str = video_result[3] if len(video_result) > 3 else "30/1"
+  # Everything here is answered from the probe cache, so calling it repeatedly is cheap.
+  video_stream = get_stream(input_file, "video")
+  audio_stream = get_stream(input_file, "audio")
+
+  vcodec = video_stream.get("codec_name", "h264")
+  width = int(video_stream.get("width", 1920))
+  height = int(video_stream.get("height", 1080))
+  fps_str = video_stream.get("r_frame_rate", "30/1")
   vbitrate = get_bit_rate(input_file)
 
   num, den = map(int, fps_str.split('/')) if '/' in fps_str else (30, 1)
   fps = num / den
 
-  acodec = audio_result[0] if len(audio_result) > 0 else "aac"
+  acodec = get_audio_encoder(audio_stream.get("codec_name", "aac"))
   abitrate = get_bit_rate(input_file, type="audio")
 
-  # Convert vp9 to libvpx-vp9, opus to libopus, and av1 to libvpx-vp9
+  # Convert vp9 to libvpx-vp9, and av1 to libvpx-vp9
   if vcodec == "vp9" or vcodec == "av1":
       vcodec = "libvpx-vp9"
-  if acodec == "vorbis":
-      acodec = "libvorbis"
-  if acodec == "opus":
-      acodec = "libopus"
 
   # use the Apple hardware codecs on macOS
   if system() == "Darwin":
@@ -120,8 +292,6 @@ def get_video_metadata(input_file: str) -> EssentialMetadataDict:
       vcodec = "h264_videotoolbox"
     if vcodec == "hevc":
       vcodec = "hevc_videotoolbox"
-    if acodec == "aac":
-      acodec = "aac_at"
 
   vcrf = estimate_crf(vcodec, vbitrate, (width, height), fps)
   acrf = estimate_crf(acodec, abitrate, (1, 1), 1)
@@ -178,8 +348,8 @@ def estimate_crf(codec: str, bitrate: int, resolution: tuple, fps: float) -> int
     #logger.debug(f"{codec} Scaled score: {scaled_score}")
 
     # Normalize scaled score between 0 and 1 based on practical observed ranges
-    # Assumption: scaled_score typically varies between -1.0 (excellent) and ~2.0 (poor)
-    min_log, max_log = -1,1
+    # Assumption: sources range from ~1 bit per pixel-frame (excellent) to ~0.01 (poor)
+    min_log, max_log = math.log1p(1), math.log1p(100)
     normalized_score = (scaled_score - min_log) / (max_log - min_log)
     #logger.debug(f"{codec} Normalized score (pre-clamp): {normalized_score}", level=2)
     normalized_score = min(max(normalized_score, 0), 1)  # Clamp 0-1
@@ -189,7 +359,7 @@ def estimate_crf(codec: str, bitrate: int, resolution: tuple, fps: float) -> int
 
     # If we're on Apple, the CRF is inverted (higher quality = higher CRF)
     # So we map the normalized score inversely to the CRF range
-    if codec == 'h264' or codec == 'hevc':
+    if codec.endswith('_videotoolbox'):
       estimated_crf = min_crf + (1 - normalized_score) * (max_crf - min_crf)
     else:
       estimated_crf = min_crf + normalized_score * (max_crf - min_crf)
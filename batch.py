@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import shit
+from avmeta import get_video_duration, probe_file
+from scheduler import run_segment_jobs
+from logging_config import logger
+
+# Batch mode: run shit.py over a directory or manifest of files.
+# Every file is one job on a shared queue, with a global limit on how many run at once. Each job runs in its own
+# directory under the output directory, so temp dirs and outputs never collide, and gets an equal share of the CPU.
+# Inputs are probed once here, which fills the on-disk probe cache the jobs read from instead of probing again.
+# Jobs run in a shit.py subprocess each, or with --in_process, through shit.main() on this interpreter's threads,
+# which skips the interpreter startup and shares the in-memory probe and keyframe caches between jobs.
+
+SHIT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shit.py")
+MEDIA_EXTENSIONS = (".mkv", ".mp4", ".mov", ".webm", ".avi", ".ts", ".m4v", ".mp3", ".m4a", ".opus", ".ogg", ".flac", ".wav")
+
+
+def find_jobs(path):
+    """List the jobs in a directory or manifest.
+    A directory gives one job per media file in it, using <name>.mshit next to the file as its metadata if there is one.
+    A manifest has one job per line: the input file, then optionally its metadata files, separated by tabs.
+    Relative paths in a manifest are relative to the manifest. Blank lines and lines starting with # are ignored.
+    Returns:
+        A list of {"input", "metadata"} dicts with absolute paths.
+    """
+    jobs = []
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if not name.lower().endswith(MEDIA_EXTENSIONS) or name.startswith(("compressed_", "restored_")):
+                continue
+            input_file = os.path.abspath(os.path.join(path, name))
+            metadata_file = f"{os.path.splitext(input_file)[0]}.mshit"
+            jobs.append({"input": input_file, "metadata": [metadata_file] if os.path.exists(metadata_file) else []})
+    else:
+        base_dir = os.path.dirname(os.path.abspath(path))
+        with open(path, "r") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line.strip() or line.startswith("#"):
+                    continue
+                files = [os.path.join(base_dir, p) for p in line.split("\t") if p]
+                jobs.append({"input": files[0], "metadata": files[1:]})
+    return jobs
+
+
+def job_directories(jobs, output_dir):
+    """Give each job its own directory, named after its input and made unique where names repeat."""
+    seen = {}
+    directories = []
+    for job in jobs:
+        name = os.path.splitext(os.path.basename(job["input"]))[0]
+        seen[name] = seen.get(name, 0) + 1
+        if seen[name] > 1:
+            name = f"{name}_{seen[name]}"
+        directories.append(os.path.join(output_dir, name))
+    return directories
+
+
+def empty_summary(job, job_dir, status="ok"):
+    return {"input": job["input"], "directory": job_dir, "status": status, "duration": job.get("duration"),
+            "compressed_duration": None, "ratio": None, "size_ratio": None, "elapsed": None}
+
+
+def run_job(job, job_dir, shit_args, threads, in_process=False):
+    """Run shit.py on one job in its own directory, and summarize how it went.
+    With in_process, it's run through shit.main() on the calling thread instead of in a subprocess.
+    """
+    os.makedirs(job_dir, exist_ok=True)
+    target_name = os.path.basename(job["input"])
+    metadata_args = ["-t", *job["metadata"]] if job["metadata"] else []
+    argv = [job["input"], target_name, *metadata_args, *shit_args]
+
+    summary = empty_summary(job, job_dir)
+    start_time = time.monotonic()
+    if in_process:
+        logger.info(f"Running shit.py {' '.join(argv)} in {job_dir}")
+        try:
+            shit.main(argv, output_dir=job_dir, thread_limit=threads)
+        except Exception as e:
+            logger.error(f"Job {job['input']} failed: {e}")
+            summary["status"] = f"failed ({e})"
+    else:
+        cmd = [sys.executable, SHIT_SCRIPT, *argv]
+        env = dict(os.environ, SHIT_THREADS=str(threads))
+        logger.info(f"Running {' '.join(cmd)} in {job_dir}")
+        with open(os.path.join(job_dir, "shit.log"), "w") as log:
+            result = subprocess.run(cmd, cwd=job_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            summary["status"] = f"failed ({result.returncode})"
+    summary["elapsed"] = round(time.monotonic() - start_time, 3)
+    if summary["status"] != "ok":
+        return summary
+
+    compressed = os.path.join(job_dir, f"compressed_{target_name}")
+    if os.path.exists(compressed):
+        summary["compressed_duration"] = get_video_duration(compressed)
+        if summary["duration"]:
+            summary["ratio"] = round(summary["compressed_duration"] / summary["duration"], 4)
+        summary["size_ratio"] = round(os.path.getsize(compressed) / os.path.getsize(job["input"]), 4)
+    return summary
+
+
+def run_batch(jobs, output_dir, concurrency=1, shit_args=(), in_process=False):
+    """Run every job on a shared queue, at most `concurrency` at once, longest first.
+    A failing job doesn't stop the others, it's reported in the summary.
+    Returns:
+        One summary dict per job, in job order.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Probe every input up front. This fills the shared probe cache, and gives the durations to schedule by.
+    for job in jobs:
+        try:
+            probe_file(job["input"])
+            job["duration"] = get_video_duration(job["input"])
+        except Exception as e:
+            logger.error(f"Could not probe {job['input']}: {e}")
+            job["duration"] = None
+
+    threads = max(1, (os.cpu_count() or 1) // max(1, concurrency))
+    tasks = []
+    for job, job_dir in zip(jobs, job_directories(jobs, output_dir)):
+        def task(job=job, job_dir=job_dir):
+            if job["duration"] is None:
+                return empty_summary(job, job_dir, "failed (probe)")
+            try:
+                return run_job(job, job_dir, list(shit_args), threads, in_process)
+            except Exception as e:
+                logger.error(f"Job {job['input']} failed: {e}")
+                return empty_summary(job, job_dir, f"failed ({e})")
+        tasks.append((job["duration"] or 0, task))
+    return run_segment_jobs(tasks, jobs=concurrency)
+
+
+def format_summary(summaries):
+    """Format job summaries as a table."""
+    def fmt(value):
+        return "-" if value is None else f"{value:.2f}" if isinstance(value, float) else str(value)
+    rows = [("input", "status", "duration", "ratio", "size ratio", "elapsed")]
+    rows += [(os.path.basename(s["input"]), s["status"], fmt(s["duration"]), fmt(s["ratio"]), fmt(s["size_ratio"]), fmt(s["elapsed"]))
+             for s in summaries]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run shit.py over a directory or manifest of files. Arguments not listed here are passed on to shit.py.")
+    parser.add_argument("inputs", help="Directory of input files, or a manifest with one input per line (optionally followed by its .mshit files, tab separated)")
+    parser.add_argument("-o", "--output_dir", default="batch", help="Directory to put each job's outputs and temp files in. Default: batch")
+    parser.add_argument("-n", "--concurrency", type=int, default=max(1, (os.cpu_count() or 1) // 4), help="Number of files to process at once. Default: a quarter of the CPU count")
+    parser.add_argument("--in_process", help="Run jobs on threads of this process through shit.main(), instead of a shit.py subprocess each. Skips the interpreter startup and shares the probe caches, but a job's log goes to this process's log instead of its own shit.log.", action="store_true")
+    parser.add_argument("--summary", help="File to write the JSON summary to. Default: <output_dir>/summary.json")
+    args, shit_args = parser.parse_known_args()
+
+    jobs = find_jobs(args.inputs)
+    start_time = time.monotonic()
+    summaries = run_batch(jobs, args.output_dir, concurrency=max(1, args.concurrency), shit_args=shit_args, in_process=args.in_process)
+    elapsed = time.monotonic() - start_time
+
+    summary_file = args.summary if args.summary else os.path.join(args.output_dir, "summary.json")
+    with open(summary_file, "w") as f:
+        json.dump({"elapsed": round(elapsed, 3), "jobs": summaries}, f, indent=2)
+    print(format_summary(summaries))
+    failed = sum(1 for s in summaries if s["status"] != "ok")
+    print(f"{len(summaries) - failed}/{len(summaries)} files processed in {elapsed:.1f}s, summary written to {summary_file}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import stat
+import time
+import shutil
+import argparse
+import itertools
+import subprocess
+from avmeta import get_video_duration
+from mshit import save_metadata
+from logging_config import logger
+
+# Benchmark suite. Synthetic sources are generated with lavfi testsrc/sine over a matrix of resolution, duration,
+# GOP size, codec and segment count, and shit.py is run on each one for every stage:
+#   encode: shit.py -e
+#   decode: shit.py -d, on the output of the encode stage
+#   roundtrip: shit.py with no stage flags, in a fresh directory
+# Each stage records its wall time, how many times it spawned ffmpeg/ffprobe, the bytes it left in TEMP_DIR,
+# the compression ratio and how far the restored duration is off the source's.
+# Spawns are counted by putting shims for ffmpeg/ffprobe at the front of the stage's PATH.
+
+SHIT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shit.py")
+STAGES = ("encode", "decode", "roundtrip")
+STAGE_ARGS = {"encode": ["-e"], "decode": ["-d"], "roundtrip": []}
+TARGET_NAME = "bench.mkv"
+
+# Metric -> how much worse than the baseline it may get before it's flagged as a regression
+REGRESSION_TOLERANCE = {"wall_time": 0.10, "spawns": 0, "temp_bytes": 0.10, "duration_error": 0.05}
+
+
+def make_shims(shim_dir):
+    """Write ffmpeg/ffprobe shims that log each spawn to $SHIT_BENCH_SPAWN_LOG before running the real binary."""
+    os.makedirs(shim_dir, exist_ok=True)
+    for tool in ("ffmpeg", "ffprobe"):
+        real = shutil.which(tool)
+        if real is None:
+            raise RuntimeError(f"{tool} not found on PATH")
+        shim = os.path.join(shim_dir, tool)
+        with open(shim, "w") as f:
+            f.write(f'#!/bin/sh\necho {tool} >> "$SHIT_BENCH_SPAWN_LOG"\nexec "{real}" "$@"\n')
+        os.chmod(shim, os.stat(shim).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def case_name(case):
+    return f"{case['resolution']}_{case['duration']:g}s_g{case['gop']}_{case['codec']}_{case['segments']}seg"
+
+
+def generate_source(output_file, resolution, duration, gop, codec, rate=30):
+    """Generate a synthetic test source: testsrc video with a sine tone, with a keyframe every `gop` frames."""
+    if os.path.exists(output_file):
+        return
+    ffmpeg_cmd = [
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "lavfi", "-i", f"testsrc=duration={duration}:size={resolution}:rate={rate}",
+        "-f", "lavfi", "-i", f"sine=frequency=432:duration={duration}",
+        "-c:v", codec, "-g", str(gop), "-keyint_min", str(gop), "-pix_fmt", "yuv420p",
+        "-c:a", "libopus",
+        f"{output_file}.tmp.mkv"
+    ]
+    logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+    result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    if result.returncode != 0:
+        logger.debug(f"FFmpeg stderr: {result.stderr}")
+        raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
+    os.replace(f"{output_file}.tmp.mkv", output_file)
+
+
+def make_segments(duration, count, interest=0.5):
+    """Spread `count` compressed segments evenly over the source, each followed by an equally long pass-through gap."""
+    length = duration / (2 * count)
+    return [{"start": round(2 * i * length, 3), "end": round((2 * i + 1) * length, 3), "interest": interest} for i in range(count)]
+
+
+def snapshot_files(path):
+    """{file: (inode, size, mtime)} for every file under path."""
+    files = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            st = os.stat(os.path.join(root, name))
+            files[os.path.join(root, name)] = (st.st_ino, st.st_size, st.st_mtime_ns)
+    return files
+
+
+def bytes_written(before, after):
+    """Size of the files in snapshot after that are new or were rewritten since snapshot before.
+    Unlike a change in total size, files that were overwritten count in full."""
+    return sum(entry[1] for path, entry in after.items() if before.get(path) != entry)
+
+
+def run_stage(stage, work_dir, source, metadata_file, shim_dir, shit_args):
+    """Run one stage of shit.py in work_dir and measure it.
+    The decode stage restores the compressed file the encode stage left in work_dir.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    spawn_log = os.path.join(work_dir, f"{stage}.spawns")
+    temp_dir = os.path.join(work_dir, f"temp_{os.path.splitext(TARGET_NAME)[0]}")
+    temp_files_before = snapshot_files(temp_dir)
+    open(spawn_log, "w").close()
+    env = dict(os.environ,
+               PATH=shim_dir + os.pathsep + os.environ.get("PATH", ""),
+               SHIT_BENCH_SPAWN_LOG=spawn_log,
+               # A cold probe cache for every stage, so runs don't depend on what ran before them
+               SHIT_PROBE_CACHE=os.path.join(work_dir, f"{stage}.probe_cache.json"))
+    compressed = os.path.join(work_dir, f"compressed_{TARGET_NAME}")
+    # In decode-only mode shit.py's input is the compressed file
+    stage_input = compressed if stage == "decode" else source
+    cmd = [sys.executable, SHIT_SCRIPT, stage_input, TARGET_NAME, "-t", metadata_file, *STAGE_ARGS[stage], *shit_args]
+
+    start_time = time.monotonic()
+    with open(os.path.join(work_dir, f"{stage}.log"), "w") as log:
+        result = subprocess.run(cmd, cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wall_time = time.monotonic() - start_time
+
+    with open(spawn_log, "r") as f:
+        spawned = f.read().split()
+    measurement = {
+        "status": "ok" if result.returncode == 0 else f"failed ({result.returncode})",
+        "wall_time": round(wall_time, 3),
+        "spawns": len(spawned),
+        "ffmpeg_spawns": spawned.count("ffmpeg"),
+        "ffprobe_spawns": spawned.count("ffprobe"),
+        "temp_bytes": bytes_written(temp_files_before, snapshot_files(temp_dir)),
+    }
+    if result.returncode != 0:
+        return measurement
+
+    original_duration = get_video_duration(source)
+    restored = os.path.join(work_dir, f"restored_{TARGET_NAME}")
+    if stage in ("encode", "roundtrip"):
+        measurement["compression_ratio"] = round(get_video_duration(compressed) / original_duration, 4)
+        measurement["size_ratio"] = round(os.path.getsize(compressed) / os.path.getsize(source), 4)
+    if stage in ("decode", "roundtrip"):
+        measurement["duration_error"] = round(abs(get_video_duration(restored) - original_duration), 4)
+    return measurement
+
+
+def run_benchmarks(cases, bench_dir, shit_args=()):
+    """Generate each case's source and run every stage on it.
+    Returns:
+        {case name: {"case": case, stage: measurement, ...}}
+    """
+    shim_dir = os.path.abspath(os.path.join(bench_dir, "shims"))
+    make_shims(shim_dir)
+    source_dir = os.path.join(bench_dir, "sources")
+    os.makedirs(source_dir, exist_ok=True)
+
+    results = {}
+    for case in cases:
+        name = case_name(case)
+        source = os.path.abspath(os.path.join(source_dir, f"{case['resolution']}_{case['duration']:g}s_g{case['gop']}_{case['codec']}.mkv"))
+        generate_source(source, case["resolution"], case["duration"], case["gop"], case["codec"])
+
+        run_dir = os.path.join(bench_dir, "runs", name)
+        shutil.rmtree(run_dir, ignore_errors=True)
+        os.makedirs(run_dir)
+        metadata_file = os.path.abspath(os.path.join(run_dir, "segments.mshit"))
+        save_metadata(metadata_file, get_video_duration(source), make_segments(case["duration"], case["segments"]))
+
+        results[name] = {"case": case}
+        for stage in STAGES:
+            # decode runs on the encode stage's output, roundtrip starts from scratch
+            work_dir = os.path.join(run_dir, "roundtrip" if stage == "roundtrip" else "stages")
+            results[name][stage] = run_stage(stage, work_dir, source, metadata_file, shim_dir, list(shit_args))
+            print(f"{name} {stage}: {results[name][stage]}")
+    return results
+
+
+def compare_results(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Compare results against a baseline. Returns a list of regression descriptions, empty if there are none."""
+    regressions = []
+    for name, stages in results.items():
+        if name not in baseline:
+            continue
+        for stage in STAGES:
+            current, previous = stages.get(stage, {}), baseline[name].get(stage, {})
+            if previous.get("status") == "ok" and current.get("status") != "ok":
+                regressions.append(f"{name} {stage}: {current.get('status')} (was ok)")
+                continue
+            for metric, allowed in tolerance.items():
+                if metric not in current or metric not in previous:
+                    continue
+                limit = previous[metric] * (1 + allowed) if metric != "duration_error" else previous[metric] + allowed
+                if current[metric] > limit:
+                    regressions.append(f"{name} {stage}: {metric} {current[metric]} vs baseline {previous[metric]}")
+    return regressions
+
+
+def parse_list(value, type=str):
+    return [type(v) for v in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark shit.py on synthetic sources. Arguments not listed here are passed on to shit.py.")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="File to write the results to. Default: bench_results.json")
+    parser.add_argument("--bench_dir", default="bench", help="Directory for generated sources and runs. Default: bench")
+    parser.add_argument("--resolutions", default="320x240,1280x720", help="Comma separated resolutions. Default: 320x240,1280x720")
+    parser.add_argument("--durations", default="10,60", help="Comma separated source durations in seconds. Default: 10,60")
+    parser.add_argument("--gops", default="30,250", help="Comma separated GOP sizes in frames. Default: 30,250")
+    parser.add_argument("--codecs", default="libx264", help="Comma separated video encoders for the sources, e.g. libx264,libx265,libvpx-vp9. Default: libx264")
+    parser.add_argument("--segments", default="1,8", help="Comma separated numbers of compressed segments. Default: 1,8")
+    parser.add_argument("-b", "--baseline", help="Compare against a stored results file, and exit with an error if anything regressed")
+    args, shit_args = parser.parse_known_args()
+
+    cases = [{"resolution": r, "duration": d, "gop": g, "codec": c, "segments": s}
+             for r, d, g, c, s in itertools.product(parse_list(args.resolutions), parse_list(args.durations, float),
+                                                    parse_list(args.gops, int), parse_list(args.codecs), parse_list(args.segments, int))]
+    results = run_benchmarks(cases, args.bench_dir, shit_args)
+    with open(args.output, "w") as f:
+        json.dump({"shit_args": shit_args, "results": results}, f, indent=2)
+    print(f"Wrote results for {len(cases)} cases to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_results(results, baseline)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        print(f"{len(regressions)} regressions against {args.baseline}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,968 @@
+import os
+import sys
+import threading
+from fileops import write_file_list, file_identity
+from meta import add_pass_through_segments, adjust_segments_to_keyframes, get_mutated_segments, calculate_compressed_duration, write_metadata_file
+from avmeta import get_video_duration, get_video_metadata, get_audio_sample_rate, get_bit_frame_rate, get_keyframes, probe_file, has_video, get_audio_metadata, add_transient_dir
+from audioonly import process_audio, build_audio_graph
+from mshit import make_probe_entry
+from scheduler import run_segment_jobs, thread_budget, THREAD_LIMIT, TaskPool
+from pipeline import watch_segment_list, PrefixConcatenator
+from profiles import DEFAULT_PROFILE, encoder_args, describe_profile
+from smartcut import plan_smart_cut, copy_range
+from logging_config import logger
+from progress import run_ffmpeg, ProgressBoard
+from tracing import in_current_context
+
+# The SHIT codec as a library. A ShitCodec holds the paths and options of one source, and all of its state, so any
+# number of them can be used from one process, one after another or at once. Probe results, keyframes and packet
+# indexes are cached per process by avmeta/pktindex, so they stay warm across codecs and calls.
+
+# Bump this when process_segment changes in a way that affects its output, to invalidate cached segments
+SEGMENT_CACHE_VERSION = 3
+# Filter graphs longer than this are passed in a script file. Linux limits a single argument to 128 KiB.
+FILTER_SCRIPT_THRESHOLD = 64 * 1024
+
+
+def get_source_duration(source):
+    """Duration of a segment source, which is either a file or a (file, start, end) range."""
+    if isinstance(source, tuple):
+        return source[2] - source[1]
+    return get_video_duration(source)
+
+
+def build_single_graph(segments, audio_sample_rate=0):
+    """Build one filter_complex graph that trims, speeds up and concatenates every segment of the input.
+    Audio is left out of the graph if audio_sample_rate is 0.
+    Raises:
+        ValueError: None of the segments has any length.
+    """
+    segments = [seg for seg in segments if seg["end"] > seg["start"]]
+    audio = audio_sample_rate > 0
+    n = len(segments)
+    if n == 0:
+        raise ValueError("Can't build a filter graph without segments, every segment is empty")
+
+    graph = [f"[0:v]split={n}" + "".join(f"[vin{i}]" for i in range(n))]
+    if audio:
+        graph.append(f"[0:a]asplit={n}" + "".join(f"[ain{i}]" for i in range(n)))
+
+    concat_inputs = ""
+    for i, seg in enumerate(segments):
+        start, end, interest = seg["start"], seg["end"], seg["interest"]
+        speed_factor = 1 / interest
+        graph.append(f"[vin{i}]trim=start={start}:end={end},setpts=(PTS-STARTPTS)*{interest}[v{i}]")
+        concat_inputs += f"[v{i}]"
+        if audio:
+            audio_filter = f"[ain{i}]atrim=start={start}:end={end},asetpts=PTS-STARTPTS"
+            if interest != 1.0:
+                audio_filter += f",asetrate={audio_sample_rate}*{speed_factor},aresample={audio_sample_rate}"
+            graph.append(f"{audio_filter}[a{i}]")
+            concat_inputs += f"[a{i}]"
+
+    graph.append(f"{concat_inputs}concat=n={n}:v=1:a={1 if audio else 0}[v]" + ("[a]" if audio else ""))
+    return ";".join(graph)
+
+
+def get_round_trip_segments(encoded_segments, compressed_segments):
+    """Get the decode segments for the compressed segments (files or ranges) from the encode pass.
+    The boundaries come from the compressed files themselves, so the compressed video doesn't need to be split or probed again."""
+    round_trip_segments = []
+    current_time = 0
+    for seg, compressed_file in zip(encoded_segments, compressed_segments):
+        compressed_duration = get_source_duration(compressed_file)
+        round_trip_segments.append({
+            "start": current_time,
+            "end": current_time + compressed_duration,
+            "interest": seg["interest"]
+        })
+        current_time += compressed_duration
+    logger.debug(f"Round trip segments: {round_trip_segments}")
+    return round_trip_segments
+
+
+class ShitCodec:
+    """Encodes a source into a compressed file and decodes it back, following a list of interest segments.
+
+    Args:
+        input_video: The source file.
+        compressed_video: Where the compressed file goes (or, to only decode, the compressed file to read).
+        restored_video: Where the restored file goes.
+        temp_dir: Directory for intermediate files. Created when needed.
+        minterp: Motion interpolation mode for decoding ('blend', 'dup' or 'mci'), or None.
+        jobs: Number of segments to encode/decode concurrently.
+        profile: Encoder profile, one of profiles.PROFILES.
+        single_graph: Encode with one ffmpeg filter graph over the whole file.
+        smart_cut: Cut encode segments at their exact times, stream copying whole GOPs.
+        split_segments: Split inputs with the segment muxer instead of reading segment ranges in place.
+        pipeline: Encode split segments as they're split off, and concatenate them as they finish. Implies split_segments.
+        final_reencode: Re-encode the whole restored file after concatenating it.
+        atempo: For audio-only inputs, change the speed with atempo instead of asetrate.
+        segment_cache: A SegmentCache to reuse processed segments from, or None.
+        thread_limit: Total number of threads for this codec's ffmpeg runs. Default: all of them (or $SHIT_THREADS).
+        debug: Draw debugging text on processed segments.
+        farm: A farm.Farm to process segments on, across every node running a worker, or None to process them here.
+        progress: The ProgressBoard this codec's ffmpeg runs report on. Default: one of its own.
+        stall_timeout, time_budget: Watchdog limits for this codec's ffmpeg runs, as for run_ffmpeg. Default: WATCHDOG's.
+    """
+
+    def __init__(self, input_video, compressed_video, restored_video, temp_dir, minterp=None, jobs=1, profile=DEFAULT_PROFILE,
+                 single_graph=False, smart_cut=False, split_segments=False, pipeline=False, final_reencode=False, atempo=False,
+                 segment_cache=None, thread_limit=THREAD_LIMIT, debug=False, farm=None, progress=None, stall_timeout=None,
+                 time_budget=None):
+        self.input_video = input_video
+        self.compressed_video = compressed_video
+        self.restored_video = restored_video
+        self.temp_dir = temp_dir
+        # Its files are rewritten every run, so their probes aren't worth keeping
+        add_transient_dir(temp_dir)
+        self.minterp = minterp
+        self.jobs = max(1, jobs)
+        self.profile = profile
+        self.single_graph = single_graph
+        self.smart_cut = smart_cut
+        self.split_segments = split_segments or pipeline
+        self.pipeline = pipeline
+        self.final_reencode = final_reencode
+        self.atempo = atempo
+        self.segment_cache = segment_cache
+        self.thread_limit = thread_limit
+        self.debug = debug
+        self.farm = farm
+        if farm is not None and (pipeline or smart_cut):
+            raise ValueError("Pipelined and smart cut encodes run their own segment tasks, and can't be farmed out")
+        self.progress = progress if progress is not None else ProgressBoard()
+        self.stall_timeout = stall_timeout
+        self.time_budget = time_budget
+        # Files without video skip every video probe and filter, and are processed in one go
+        self.audio_only = not has_video(input_video)
+
+    def run_ffmpeg(self, cmd, stage=None, **kwargs):
+        """run_ffmpeg with this codec's progress board and watchdog limits."""
+        stage = stage if stage is not None else sys._getframe(1).f_code.co_name
+        return run_ffmpeg(cmd, stage=stage, board=self.progress, stall_timeout=self.stall_timeout, time_budget=self.time_budget, **kwargs)
+
+    def segment_threads(self):
+        """Threads each concurrent segment's ffmpeg gets, or None to leave it to ffmpeg."""
+        return thread_budget(self.jobs, self.thread_limit) if self.jobs > 1 or self.thread_limit else None
+
+    def describe(self):
+        """A one line description of how the source will be processed, for logging."""
+        if self.audio_only:
+            return f"No video stream in {self.input_video}, using the audio-only path"
+        return f"Encoder profile {describe_profile(self.profile, get_video_metadata(self.input_video))}"
+
+    def prepare_segments(self, segments, duration=None):
+        """Add pass-through segments to a segment list, and adjust them to keyframes where the encode needs that.
+        Returns:
+            (pass_thru, encode_adjusted_segments)
+        """
+        if duration is None:
+            duration = get_video_duration(self.input_video)
+        pass_thru = add_pass_through_segments(segments, duration)
+        if self.audio_only or self.single_graph or self.smart_cut:
+            # Segments get cut exactly where they were asked for, rather than at keyframes
+            encode_adjusted_segments = pass_thru
+        else:
+            encode_adjusted_segments = adjust_segments_to_keyframes(self.input_video, pass_thru, self.temp_dir)
+        logger.info(f"Adjusted segments: {encode_adjusted_segments}, Original segments: {pass_thru}")
+        return pass_thru, encode_adjusted_segments
+
+    def encode(self, segments, duration=None, metadata_file=None, binary=False, curve=None, index_keyframes=True):
+        """Compress input_video into compressed_video.
+        Args:
+            segments: Interest segments relative to the source. Pass-through segments are added.
+            duration: Duration of the source. Default: probed.
+            metadata_file: If set, write the segments and the probe results of both files to this mshit file.
+            binary: Write metadata_file in the binary mshit format.
+            curve: An InterestCurve to follow instead of the segments, in a single ffmpeg run over the whole file.
+                segments should then be curve.segments().
+            index_keyframes: Store the compressed video's keyframes in metadata_file too, for a later decode-only run.
+                Costs a scan of the whole compressed video.
+        Returns:
+            A dict with the pass-through "segments", the keyframe "adjusted_segments" that were encoded,
+            the "compressed_segments" each one was encoded to, and the "compressed_duration".
+        """
+        os.makedirs(self.temp_dir, exist_ok=True)
+        if duration is None:
+            duration = get_video_duration(self.input_video)
+        if curve is not None:
+            # The curve's segments already cover the whole file, and nothing gets cut
+            pass_thru = encode_adjusted_segments = segments
+        else:
+            pass_thru, encode_adjusted_segments = self.prepare_segments(segments, duration)
+
+        if curve is not None:
+            compressed_segments = self.encode_curve(curve)
+        elif self.audio_only:
+            compressed_segments = self.encode_audio_only(encode_adjusted_segments)
+        else:
+            logger.info(get_video_metadata(self.input_video))
+            if self.single_graph:
+                compressed_segments = self.encode_single_graph(encode_adjusted_segments)
+            elif self.smart_cut:
+                compressed_segments = self.encode_segments_smart(encode_adjusted_segments)
+            elif self.pipeline:
+                compressed_segments = self.encode_segments_pipelined(encode_adjusted_segments)
+            else:
+                compressed_segments = self.encode_segments(encode_adjusted_segments)
+
+        if metadata_file:
+            # Store the probe results with the metadata, so a later decode-only run doesn't have to probe anything
+            probe = {
+                "source": make_probe_entry(self.input_video, probe_file(self.input_video)),
+                "compressed": make_probe_entry(self.compressed_video, probe_file(self.compressed_video),
+                                               get_keyframes(self.compressed_video, self.temp_dir) if index_keyframes else None),
+            }
+            write_metadata_file(metadata_file, duration, segments, probe=probe, binary=binary, curve=curve)
+        return {
+            "segments": pass_thru,
+            "adjusted_segments": encode_adjusted_segments,
+            "compressed_segments": compressed_segments,
+            "compressed_duration": curve.compressed_duration() if curve is not None else calculate_compressed_duration(duration, segments),
+        }
+
+    def decode(self, segments, duration=None, curve=None):
+        """Restore compressed_video into restored_video.
+        Args:
+            segments: The interest segments it was encoded with, relative to the source.
+            duration: Duration of the source. Default: the duration of input_video.
+            curve: The InterestCurve it was encoded with, if it was.
+        Returns:
+            The duration of the compressed video.
+        """
+        os.makedirs(self.temp_dir, exist_ok=True)
+        if duration is None:
+            duration = get_video_duration(self.input_video)
+        compressed_duration = get_video_duration(self.compressed_video)
+        if curve is not None:
+            self.decode_curve(curve)
+            return compressed_duration
+        if self.audio_only:
+            # The pass-through segments already cover the whole file, so they rebase straight onto the compressed one
+            self.decode_audio_only(get_mutated_segments(add_pass_through_segments(segments, duration)))
+            return compressed_duration
+
+        # Rebase the original segments to be relative to the compressed video
+        # Add pass thrus to the rebased segments
+        decode_pass_thru_segments = add_pass_through_segments(segments, compressed_duration)
+        rebased_segments = get_mutated_segments(decode_pass_thru_segments)
+        # Adjust the rebased segments to keyframes
+        decode_adjusted_segments = adjust_segments_to_keyframes(self.compressed_video, rebased_segments, self.temp_dir)
+        logger.debug(f"Adjusted segments: {decode_adjusted_segments}, Original segments: {decode_pass_thru_segments}")
+        self.decode_segments(decode_adjusted_segments)
+        return compressed_duration
+
+    def roundtrip(self, segments, duration=None, metadata_file=None, binary=False, curve=None):
+        """Encode, then decode the result. Arguments are as for encode.
+        Returns:
+            The duration of the compressed video.
+        """
+        # The decode below needs no keyframe index of the compressed video, or makes its own, so don't scan it here
+        encoded = self.encode(segments, duration, metadata_file=metadata_file, binary=binary, curve=curve, index_keyframes=False)
+        if self.audio_only or self.single_graph or self.smart_cut or curve is not None:
+            return self.decode(segments, duration, curve=curve)
+
+        # Decode the encode pass's segment files directly, instead of re-splitting the compressed video
+        round_trip_segments = get_round_trip_segments(encoded["adjusted_segments"], encoded["compressed_segments"])
+        # Decoded segments are cached by the encoded segment they came from, since the compressed files are rewritten each run
+        adjusted_segments = encoded["adjusted_segments"]
+        encode_cache_keys = self.get_segment_cache_keys([file_identity(self.input_video)] * len(adjusted_segments), adjusted_segments, "encode")
+        self.decode_segments(round_trip_segments, split_files=encoded["compressed_segments"], source_ids=encode_cache_keys)
+        return round_trip_segments[-1]["end"]
+
+    def process_segment(self, input_file, output_file, interest, mode="encode", segments=[], threads=None, start=None, end=None):
+        """Process a video segment by encoding (speed-up) or decoding (slow-down).
+        If threads is set, ffmpeg is limited to that many threads, so several segments can run at once.
+        If start and end are set, only that exact range of input_file is processed."""
+        logger.debug(f"Processing segment {input_file} with interest {interest} in mode {mode}")
+        # Interest is how interersted we are in a segment.
+        # The lower the interest, the more we want to speed up the segment during the encode pass.
+        # The higher the interest, the more we want to slow down the segment during the decode pass.
+
+        # The speed factor is the inverse of the interest value.
+        # Some filters will take the speed factor as an argument, while others will take the interest value.
+        # The filters will be inverse for the encode and decode passes.
+        audio = True 
+        speed_factor = 1
+        speed_filter = ""
+        target_framerate = 30
+        base_audio_sample_rate = get_audio_sample_rate(input_file)
+        if base_audio_sample_rate == 0:
+            logger.info("No audio detected in input file, disabling audio")
+            audio = False
+        source_audio_sr = get_audio_sample_rate(self.input_video)
+        fr_cmd = []
+        vf_head = "[0:v]"
+        vf_tail = "[v]"
+
+
+        # Encode pass
+        if mode == "encode":
+          # For the encode pass, the interest will be <1, so speed_factor should be >1
+          video_filter = f"{vf_head}"
+          speed_factor = 1 / interest
+          source_framerate = get_video_metadata(self.input_video)["fps"]
+
+          #target_framerate = get_video_metadata(input_file)["fps"] * speed_factor
+          # Setpts is takes a frequency value, so we use interest.
+          # We don't need to motion interpolate on the encode pass, as just increasing the output framerate will be enough, and faster.
+          video_filter += f"setpts={interest}*PTS"
+          if self.debug:
+            video_filter += f",drawtext=fontfile=AndaleMono.ttf:text='in encode, fps={source_framerate}, aset fps={source_framerate * speed_factor}':x=(w-text_w)/2:y=(h-text_h)/2:fontsize=48:fontcolor='#4c1659'@0.9"
+
+
+          # Rubberband version is slower, and preserves the tempo (which isn't necessary, since we're going to slow it down later)
+          # It results in some very interesting decode artifacts.
+          #audio_filter = f"[0:a]rubberband=tempo={speed_factor}[a]"
+
+          # asetrate version. Increases the sample rate, which speeds the audio up, and then resample down to the source sample rate.
+          audio_filter = f"[0:a]asetrate={base_audio_sample_rate}*{speed_factor},aresample={source_audio_sr}[a]" # We can resample to super high quality for processing, but it can cause issues with scenes with interest of 1
+          fr_cmd = ["-r", str(source_framerate)]
+
+
+        # Decode pass
+        if mode == "decode":
+          # For the decode pass, the speed factor will be <1, so we will slow down the video.
+          video_filter = f"{vf_head}"
+          speed_factor = interest # Value to be used to slow down the video
+          source_file_fps = get_video_metadata(self.input_video)["fps"]
+          logger.debug(f"{str(source_file_fps)} {target_framerate}")
+
+          # Motion interpolation fills in speed_factor times the frames, which setpts then spreads back out to the source framerate
+          interpolated_framerate = source_file_fps * speed_factor
+          target_framerate = source_file_fps
+
+          if self.minterp:
+            # https://www.hellocatfood.com/misusing-ffmpegs-motion-interpolation-options/
+            # Interesting.
+            mi_mode = 'blend'
+            if self.minterp == 'mci':
+                mi_mode = 'mci:me_mode=bidir:me=tdls:scd=none'
+
+            video_filter += f"minterpolate=fps={interpolated_framerate}:mi_mode={mi_mode},setpts={interest}*PTS"
+          else:
+            video_filter += f"setpts={interest}*PTS"
+
+          if self.debug:
+            video_filter += f",drawtext=fontfile=AndaleMono.ttf:text='in decode, fps={source_file_fps}':x=(w-text_w)/2:y=((h-text_h)/2)-text_h:fontsize=48:fontcolor='#4c1659'@0.9"
+
+          audio_filter = f"[0:a]asetrate={base_audio_sample_rate}*{1/interest},aresample={source_audio_sr}[a]"
+
+          # Restored segments come out at the source's framerate and sample rate, so they can be stream copied together
+          fr_cmd = ["-r", str(target_framerate)]
+
+        # Final decode pass
+        if mode == "decode-final":
+          # Final decode pass where we're setting the framerate and audio sample rate back to normal.
+          base_audio_sample_rate = get_audio_sample_rate(self.input_video)
+          target_framerate = get_video_metadata(self.input_video)["fps"]
+          audio_filter = f"[0:a]aresample={base_audio_sample_rate}[a]"
+          video_filter = f"{vf_head}"
+
+
+          video_filter += f"null"
+
+          new_kfs = ",".join([str(seg['end']) for seg in segments])
+          fr_cmd = ["-r", str(target_framerate), "-force_key_frames",new_kfs]
+
+        metadata = get_video_metadata(self.input_video)
+        logger.debug(f"target framerate: {target_framerate}")
+        logger.debug(metadata)
+        logger.debug(f"source bfps {self.input_video} {get_bit_frame_rate(self.input_video)}\ntarget bfps {input_file} {get_bit_frame_rate(input_file)}")
+
+        # Add tail at the very end
+        video_filter += vf_tail
+        # If you use high speed intermediaries, there's not as much lost even if it gets dropped down to 30fps.
+        speed_filter = f"{video_filter};{audio_filter}" if audio else video_filter
+
+        # The final command to run
+        # Input seeking decodes from the previous keyframe and drops the frames before start, so the cut is exact
+        input_range = ["-ss", str(start), "-t", str(end - start)] if start is not None else []
+
+        ffmpeg_cmd = [
+            "ffmpeg", "-y",
+            *input_range,
+            "-i", input_file,
+            "-filter_complex", speed_filter, #f"[0:v]setpts={setpts_factor}*PTS[v];[0:a]rubberband=tempo={rubberband_factor}[a]",
+            "-map", "[v]", *[s for s in ["-map", "[a]"] if audio],
+            # Encoder, preset, rate control and threading come from the encoder profile
+            *encoder_args(self.profile, metadata, get_bit_frame_rate(self.input_video) * target_framerate, threads),
+            *[s for s in ["-c:a", metadata["acodec"]] if audio],
+            *[s for s in ["-b:a", str(metadata["abitrate"])] if audio], 
+            #"-q:a", str(metadata["acrf"]), # 0-14
+            #"-ar", "128000",
+            "-fflags", "+genpts",
+            "-avoid_negative_ts", "make_zero",
+            *fr_cmd,
+            "-f", "matroska",
+            output_file
+        ]
+
+        logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+        # setpts scales the output by interest, and the final pass keeps the timing
+        input_duration = end - start if start is not None else get_video_duration(input_file)
+        expected_duration = input_duration * (interest if mode in ("encode", "decode") else 1.0)
+        # Trace encodes, decodes and the final re-encode as separate stages
+        result = self.run_ffmpeg(ffmpeg_cmd, expected_duration=expected_duration, stage=f"process_segment ({mode})")
+
+        if result.returncode != 0:
+            logger.debug(f"FFmpeg stdout: {result.stdout}")
+            logger.debug(f"FFmpeg stderr: {result.stderr}")
+            raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
+
+    def concatenate_segments(self, file_list_path, output_file, metadata, segments=[]):
+        """Concatenate processed segments into a final video file without re-encoding."""
+        logger.info(f"Concatenating segments in {file_list_path} into {output_file}")
+        new_kfs = ",".join([str(seg['end']) for seg in segments])
+        logger.debug(f"Forcing keyframes {new_kfs}")
+        ffmpeg_cmd = [
+            "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", file_list_path,
+            "-c", "copy",  # Copy codec to avoid re-encoding
+            #"-c:a", metadata["acodec"],  
+            #"-af", "[0:a]concat=n=1:v=0:a=1[a]",  # Concatenate audio streams
+            "-fflags", "+genpts",
+            "-avoid_negative_ts", "make_zero",
+            "-reset_timestamps", "1",
+            "-copyts",
+            "-r", str(metadata["fps"]),  # Set the output framerate
+            "-force_key_frames", new_kfs,
+            "-f", "matroska", output_file
+        ]
+        logger.debug(f"Running FFMpeg command: {' '.join(ffmpeg_cmd)}")
+
+        result = self.run_ffmpeg(ffmpeg_cmd, check=True)
+        #print(f"FFmpeg stdout: {result.stdout}")
+        #print(f"FFmpeg stderr: {result.stderr}")
+
+        if result.returncode != 0:
+            logger.error(f"FFmpeg stdout: {result.stdout}")
+            logger.error(f"FFmpeg stderr: {result.stderr}")
+            raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
+
+    def split_video(self, input_file, segments, prefix, on_split=None):
+        """Losslessly split the video file into segments based on the given segment interests.
+        If on_split is set, on_split(i, path) is called for each segment as soon as the muxer has finished writing it."""
+        split_files = []
+
+        logger.debug(f"Splitting video {input_file} into segments:")
+        logger.debug(f"{segments}")
+
+        segment_times = []
+
+        for i, seg in enumerate(segments):
+            start, end = seg["start"], seg["end"]
+            duration = end - start
+            logger.debug(f"Segment {i}, {duration}")
+            segment_times.append(str(end))# + duration))
+            output_file_template = f"{prefix}_%1d.mkv"  # Use .mkv extension
+            full_output_path_template = os.path.join(self.temp_dir, output_file_template)
+            outfile = os.path.join(self.temp_dir, f"{prefix}_{i}.mkv")
+            split_files.append(outfile)
+
+        # Use segment muxer https://stackoverflow.com/questions/44580808/how-to-use-ffmpeg-to-split-a-video-and-then-merge-it-smoothly
+        # https://superuser.com/questions/692714/how-to-split-videos-with-ffmpeg-and-segment-times-option
+        segment_times = ','.join(segment_times)
+        logger.debug(f"{outfile} {seg}")
+        ffmpeg_cmd = [
+            "ffmpeg", "-y",
+            #"-ss", str(start),
+            #"-accurate_seek",
+            "-i", input_file,
+            #"-to", str(end),
+            "-map", "0",
+            #"-f", "matroska",
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_format", "matroska",
+            "-segment_times", segment_times,
+            #"-copyts",
+            "-reset_timestamps", "1",
+            "-fflags", "+genpts",
+            "-avoid_negative_ts", "make_zero",
+            #outfile, # Use .mkv format
+            full_output_path_template,
+        ]
+
+        expected_duration = segments[-1]["end"] if segments else None
+        if on_split is None:
+            logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+            result = self.run_ffmpeg(ffmpeg_cmd, expected_duration=expected_duration)
+        else:
+            # The muxer adds each segment to the list once it's closed
+            list_file = os.path.join(self.temp_dir, f"{prefix}_segments.csv")
+            if os.path.exists(list_file):
+                os.remove(list_file)
+            ffmpeg_cmd[-1:-1] = ["-segment_list", list_file, "-segment_list_type", "csv"]
+            logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+
+            split_result = {}
+            cancel = threading.Event()
+            def split():
+                try:
+                    split_result["result"] = self.run_ffmpeg(ffmpeg_cmd, expected_duration=expected_duration, stage="split_video", cancel=cancel)
+                except Exception as e:
+                    split_result["error"] = e
+            split_thread = threading.Thread(target=in_current_context(split))
+            split_thread.start()
+            try:
+                for i, path in watch_segment_list(list_file, split_thread):
+                    if i < len(segments):
+                        on_split(i, path)
+            except BaseException:
+                # Don't leave the split running, or waiting on its thread would hang the interpreter on exit
+                cancel.set()
+                raise
+            finally:
+                split_thread.join()
+            if "error" in split_result:
+                raise split_result["error"]
+            result = split_result["result"]
+    #logger.debug(f"FFmpeg stdout: {result.stdout}")
+    #logger.debug(f"FFmpeg stderr: {result.stderr}")
+
+        if result.returncode != 0:
+            raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
+
+        logger.debug(f"Segments for {input_file} split with times {segments}: {outfile}")
+
+        return split_files
+
+    def segment_cache_params(self, mode):
+        """The encoder parameters that affect a processed segment's output, for segment cache keys."""
+        return {
+            "version": SEGMENT_CACHE_VERSION,
+            "metadata": get_video_metadata(self.input_video),
+            "audio_sample_rate": get_audio_sample_rate(self.input_video),
+            "minterp": self.minterp if mode == "decode" else None,
+            "profile": self.profile,
+            "debug": self.debug,
+            # A split file and a range of the input start decoding from different places
+            "split_segments": self.split_segments,
+        }
+
+    def get_segment_cache_keys(self, source_ids, segments, mode, position=True):
+        """Get the segment cache key of each segment, given the identity of the source each one is cut from.
+        position: Whether the segment's start and end go into the key. Not needed if the source ids identify the segments."""
+        if not self.segment_cache:
+            return [None] * len(segments)
+        params = self.segment_cache_params(mode)
+        return [self.segment_cache.key(source_id, seg, mode, params, position) for source_id, seg in zip(source_ids, segments)]
+
+    def fetch_cached_segments(self, cache_keys, output_files):
+        """Place cached segments at their output paths. Returns whether each one was found.
+        Segments without an output file (pass-through ones) are never cached."""
+        if not self.segment_cache:
+            return [False] * len(output_files)
+        return [output_file is not None and self.segment_cache.fetch(key, output_file) for key, output_file in zip(cache_keys, output_files)]
+
+    def store_cached_segments(self, cache_keys, output_files, skip):
+        """Add the newly processed segments to the segment cache, except the ones marked in skip."""
+        if not self.segment_cache:
+            return
+        for key, output_file, skipped in zip(cache_keys, output_files, skip):
+            if not skipped:
+                self.segment_cache.store(key, output_file)
+
+    def get_segment_sources(self, input_file, segments, prefix, to_process=None):
+        """Get what each segment should be read from: a (file, start, end) range of the input, or a split file if split_segments is set.
+        Args:
+            to_process: Which segments will be processed. If none will (they're pass-through or already in the segment
+                cache), nothing is split and every segment gets a range, which the concat list can reference directly.
+        """
+        if self.split_segments and (to_process is None or any(to_process)):
+            return self.split_video(input_file, segments, prefix)
+        return [(input_file, seg["start"], seg["end"]) for seg in segments]
+
+    def process_segment_source(self, source, output_file, interest, mode="encode", threads=None):
+        """Process a segment read from a file or from a (file, start, end) range."""
+        if isinstance(source, tuple):
+            input_file, start, end = source
+            self.process_segment(input_file, output_file, interest, mode=mode, threads=threads, start=start, end=end)
+        else:
+            self.process_segment(source, output_file, interest, mode=mode, threads=threads)
+
+    def run_segments(self, items):
+        """Process segments, longest first, here or on the farm if there is one.
+        Args:
+            items: One dict per segment, with its "index", "duration", "source", "output", "interest" and "mode",
+                which are passed on to process_segment_source.
+        """
+        if self.farm is not None:
+            self.farm.run(self, items)
+            return
+        threads = self.segment_threads()
+        run_segment_jobs([(item["duration"], lambda item=item: self.process_segment_source(item["source"], item["output"], item["interest"], mode=item["mode"], threads=threads))
+                          for item in items], self.jobs)
+
+    def encode_segments(self, segments_to_encode):
+        """Encode (compress) the segments.
+        Pass-through segments aren't written anywhere. The concat list references their range of the input directly."""
+        processed = [seg["interest"] != 1.0 for seg in segments_to_encode]
+        compressed_segments = [os.path.join(self.temp_dir, f"compressed_{i}.mkv") if processed[i] else None for i in range(len(segments_to_encode))]
+        cache_keys = self.get_segment_cache_keys([file_identity(self.input_video)] * len(segments_to_encode), segments_to_encode, "encode")
+        cached = self.fetch_cached_segments(cache_keys, compressed_segments)
+
+        sources = self.get_segment_sources(self.input_video, segments_to_encode, "split",
+                                           [processed[i] and not cached[i] for i in range(len(processed))])
+
+        logger.info(f"Beginning encode pass\n{sources}")
+
+        items = []
+        for i, seg in enumerate(segments_to_encode):
+            interest = seg["interest"]
+
+            if not processed[i]:
+                # Skip processing and reference the source in the concat list
+                compressed_segments[i] = sources[i]
+                logger.info(f"Skipping processing for segment {i} with interest {interest}. Using source {compressed_segments[i]}.")
+                continue
+
+            full_compressed_path = compressed_segments[i]
+            if cached[i]:
+                logger.info(f"Using cached segment {i} with interest {interest}.")
+                continue
+            # An earlier run may have left a hardlink into the segment cache here, which must not be written through
+            if os.path.lexists(full_compressed_path):
+                os.remove(full_compressed_path)
+
+            logger.info(f"Processing segment {i} with interest {interest}. Saving to file {full_compressed_path}")
+            items.append({"index": i, "duration": seg["end"] - seg["start"], "source": sources[i],
+                          "output": full_compressed_path, "interest": interest, "mode": "encode"})
+
+        # Each encoded segment comes out interest times as long as it went in
+        self.progress.start_stage("encode", sum((seg["end"] - seg["start"]) * seg["interest"] for i, seg in enumerate(segments_to_encode) if processed[i] and not cached[i]))
+        self.run_segments(items)
+        self.progress.end_stage()
+        self.store_cached_segments(cache_keys, compressed_segments, [cached[i] or not processed[i] for i in range(len(processed))])
+
+        for i, seg in enumerate(segments_to_encode):
+            compressed_segment_duration = get_source_duration(compressed_segments[i])
+            original_duration = seg["end"] - seg["start"]
+            logger.info(f"Original segment duration: {original_duration}, Compressed segment duration: {compressed_segment_duration}")
+
+        compressed_concat_file = os.path.join(self.temp_dir, "compressed_list.txt")
+        write_file_list(compressed_concat_file, compressed_segments, self.temp_dir)
+
+        metadata = get_video_metadata(self.input_video)
+        self.concatenate_segments(compressed_concat_file, self.compressed_video, metadata, segments=get_mutated_segments(segments_to_encode))
+        logger.info(f"Compression complete: saved as {self.compressed_video}")
+
+        return compressed_segments
+
+    def encode_segments_pipelined(self, segments_to_encode):
+        """Encode (compress) the segments, overlapping the split, the encodes and the concat.
+        Each segment is encoded as soon as the segment muxer has closed it, and contiguous runs of finished segments
+        are concatenated while later ones are still encoding."""
+        processed = [seg["interest"] != 1.0 for seg in segments_to_encode]
+        compressed_segments = [os.path.join(self.temp_dir, f"compressed_{i}.mkv") if processed[i] else None for i in range(len(segments_to_encode))]
+        cache_keys = self.get_segment_cache_keys([file_identity(self.input_video)] * len(segments_to_encode), segments_to_encode, "encode")
+        cached = self.fetch_cached_segments(cache_keys, compressed_segments)
+        for i, path in enumerate(compressed_segments):
+            # An earlier run may have left a hardlink into the segment cache here, which must not be written through
+            if processed[i] and not cached[i] and os.path.lexists(path):
+                os.remove(path)
+
+        metadata = get_video_metadata(self.input_video)
+        keyframe_segments = get_mutated_segments(segments_to_encode)
+        concatenator = PrefixConcatenator(lambda list_file, output_file: self.concatenate_segments(list_file, output_file, metadata, segments=keyframe_segments),
+                                          self.temp_dir, "compressed")
+        threads = self.segment_threads()
+        pool = TaskPool(self.jobs)
+
+        def on_split(i, path):
+            interest = segments_to_encode[i]["interest"]
+            if not processed[i]:
+                # Pass-through segments are referenced as split
+                compressed_segments[i] = path
+                concatenator.ready(i, path)
+            elif cached[i]:
+                logger.info(f"Using cached segment {i} with interest {interest}.")
+                concatenator.ready(i, compressed_segments[i])
+            else:
+                logger.info(f"Processing segment {i} with interest {interest}. Saving to file {compressed_segments[i]}")
+                pool.submit(i, lambda: self.process_segment(path, compressed_segments[i], interest, mode="encode", threads=threads),
+                            on_done=lambda i, _: concatenator.ready(i, compressed_segments[i]))
+
+        logger.info("Beginning pipelined encode pass")
+        self.progress.start_stage("encode", sum((seg["end"] - seg["start"]) * seg["interest"] for i, seg in enumerate(segments_to_encode) if processed[i] and not cached[i]))
+        try:
+            self.split_video(self.input_video, segments_to_encode, "split", on_split=on_split)
+        finally:
+            pool.join()
+            self.progress.end_stage()
+        self.store_cached_segments(cache_keys, compressed_segments, [cached[i] or not processed[i] for i in range(len(processed))])
+
+        concatenator.finish(len(segments_to_encode), self.compressed_video)
+        logger.info(f"Compression complete: saved as {self.compressed_video}")
+        return compressed_segments
+
+    def encode_segments_smart(self, segments_to_encode):
+        """Encode (compress) the segments, cutting them at their exact times.
+        Segments to be sped up are decoded straight from the input, and pass-through segments are stream copied,
+        except for the partial GOPs at their edges, which are re-encoded."""
+        keyframes = get_keyframes(self.input_video, self.temp_dir)
+        duration = get_video_duration(self.input_video)
+        # Keyframes within half a frame of a boundary count as being on it
+        tolerance = 0.5 / get_video_metadata(self.input_video)["fps"]
+
+        threads = self.segment_threads()
+        compressed_pieces = []
+        tasks = []
+        encoded_time = 0
+        for i, seg in enumerate(segments_to_encode):
+            start, end, interest = seg["start"], seg["end"], seg["interest"]
+            if interest == 1.0:
+                pieces = plan_smart_cut(start, end, keyframes, duration, tolerance)
+            else:
+                pieces = [("encode", start, end)]
+            logger.info(f"Segment {i} with interest {interest} cut into pieces {pieces}")
+
+            for j, (action, piece_start, piece_end) in enumerate(pieces):
+                piece_file = os.path.join(self.temp_dir, f"compressed_{i}_{j}.mkv")
+                if action == "copy" and not self.split_segments:
+                    # Whole GOPs are referenced straight from the input in the concat list
+                    compressed_pieces.append((self.input_video, piece_start, piece_end))
+                    continue
+                compressed_pieces.append(piece_file)
+                if action == "copy":
+                    tasks.append((0, lambda path=piece_file, s=piece_start, e=piece_end: copy_range(self.input_video, path, s, e, run=self.run_ffmpeg)))
+                else:
+                    encoded_time += piece_end - piece_start
+                    tasks.append((piece_end - piece_start,
+                                  lambda path=piece_file, s=piece_start, e=piece_end, interest=interest: self.process_segment(self.input_video, path, interest, mode="encode", threads=threads, start=s, end=e)))
+
+        logger.info(f"Re-encoding {encoded_time:.2f}s of {duration:.2f}s, stream copying the rest")
+        run_segment_jobs(tasks, self.jobs)
+
+        compressed_concat_file = os.path.join(self.temp_dir, "compressed_list.txt")
+        write_file_list(compressed_concat_file, compressed_pieces, self.temp_dir)
+
+        metadata = get_video_metadata(self.input_video)
+        self.concatenate_segments(compressed_concat_file, self.compressed_video, metadata, segments=get_mutated_segments(segments_to_encode))
+        logger.info(f"Compression complete: saved as {self.compressed_video}")
+
+        return compressed_pieces
+
+    def encode_single_graph(self, segments_to_encode):
+        """Encode (compress) the whole input in a single ffmpeg run, with no intermediate segment files."""
+        metadata = get_video_metadata(self.input_video)
+        audio_sample_rate = get_audio_sample_rate(self.input_video)
+        audio = audio_sample_rate > 0
+        source_framerate = metadata["fps"]
+
+        graph = build_single_graph(segments_to_encode, audio_sample_rate)
+        # Keep keyframes at the segment boundaries, so the decoder can split the compressed file there
+        new_kfs = ",".join([str(seg['end']) for seg in get_mutated_segments(segments_to_encode)])
+
+        ffmpeg_cmd = [
+            "ffmpeg", "-y",
+            "-i", self.input_video,
+            "-filter_complex", graph,
+            "-map", "[v]", *[s for s in ["-map", "[a]"] if audio],
+            *encoder_args(self.profile, metadata, get_bit_frame_rate(self.input_video) * source_framerate),
+            *[s for s in ["-c:a", metadata["acodec"]] if audio],
+            *[s for s in ["-b:a", str(metadata["abitrate"])] if audio],
+            "-r", str(source_framerate),
+            "-force_key_frames", new_kfs,
+            "-f", "matroska",
+            self.compressed_video
+        ]
+
+        logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+        result = self.run_ffmpeg(ffmpeg_cmd, expected_duration=calculate_compressed_duration(get_video_duration(self.input_video), segments_to_encode))
+
+        if result.returncode != 0:
+            logger.debug(f"FFmpeg stdout: {result.stdout}")
+            logger.debug(f"FFmpeg stderr: {result.stderr}")
+            raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
+
+        logger.info(f"Compression complete: saved as {self.compressed_video}")
+        return [self.compressed_video]
+
+    def filter_complex_args(self, graph, name):
+        """ffmpeg arguments for a filter graph, passed in a script file in temp_dir if it's too long for the command line."""
+        if len(graph) <= FILTER_SCRIPT_THRESHOLD:
+            return ["-filter_complex", graph]
+        script_file = os.path.join(self.temp_dir, f"{name}_graph.txt")
+        with open(script_file, "w") as f:
+            f.write(graph)
+        return ["-filter_complex_script", script_file]
+
+    def encode_curve(self, curve):
+        """Encode (compress) the whole input along an interest curve, in a single ffmpeg run."""
+        if self.audio_only:
+            process_audio(self.input_video, self.compressed_video, curve.segments(), get_audio_metadata(self.input_video), mode="encode", tempo=self.atempo, run=self.run_ffmpeg)
+            logger.info(f"Compression complete: saved as {self.compressed_video}")
+            return [self.compressed_video]
+        metadata = get_video_metadata(self.input_video)
+        audio_sample_rate = get_audio_sample_rate(self.input_video)
+        audio = audio_sample_rate > 0
+        source_framerate = metadata["fps"]
+
+        graph = f"[0:v]setpts=PTS-STARTPTS,setpts='{curve.setpts_expr()}'[v]"
+        if audio:
+            graph += ";" + build_audio_graph(curve.segments(), audio_sample_rate, mode="encode")
+        logger.info(f"Compressing along an interest curve with {len(curve)} points")
+
+        ffmpeg_cmd = [
+            "ffmpeg", "-y",
+            "-i", self.input_video,
+            *self.filter_complex_args(graph, "encode_curve"),
+            "-map", "[v]", *[s for s in ["-map", "[a]"] if audio],
+            *encoder_args(self.profile, metadata, get_bit_frame_rate(self.input_video) * source_framerate),
+            *[s for s in ["-c:a", metadata["acodec"]] if audio],
+            *[s for s in ["-b:a", str(metadata["abitrate"])] if audio],
+            "-r", str(source_framerate),
+            "-f", "matroska",
+            self.compressed_video
+        ]
+
+        logger.debug(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+        result = self.run_ffmpeg(ffmpeg_cmd, expected_duration=curve.compressed_duration())
+
+        if result.returncode != 0:
+            logger.debug(f"FFmpeg stderr: {result.stderr}")
+            raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
+
+        logger.info(f"Compression complete: saved as {self.compressed_video}")
+        return [self.compressed_video]
+
+    def decode_curve(self, curve):
+        """Decode (expand) a file compressed along an interest curve, in a single ffmpeg run."""
+        # Audio is mapped piece by piece, with the pieces rebased onto the compressed timeline
+        audio_segments = get_mutated_segments(curve.segments())
+        if self.audio_only:
+            self.decode_audio_only(audio_segments)
+            return
+        metadata = get_video_metadata(self.input_video)
+        audio_sample_rate = get_audio_sample_rate(self.compressed_video)
+        audio = audio_sample_rate > 0
+        source_framerate = metadata["fps"]
+
+        video_filter = f"[0:v]setpts=PTS-STARTPTS,setpts='{curve.inverse_setpts_expr()}'"
+        if self.minterp:
+            # Slowed down parts are interpolated back up to the source framerate
+            mi_mode = 'blend'
+            if self.minterp == 'mci':
+                mi_mode = 'mci:me_mode=bidir:me=tdls:scd=none'
+            video_filter += f",minterpolate=fps={source_framerate}:mi_mode={mi_mode}"
+        graph = f"{video_filter}[v]"
+        if audio:
+            graph += ";" + build_audio_graph(audio_segments, audio_sample_rate, mode="decode")
+
+        ffmpeg_cmd = [
+            "ffmpeg", "-y",
+            "-i", self.compressed_video,
+            *self.filter_complex_args(graph, "decode_curve"),
+            "-map", "[v]", *[s for s in ["-map", "[a]"] if audio],
+            *encoder_args(self.profile, metadata, get_bit_frame_rate(self.input_video) * source_framerate),
+            *[s for s in ["-c:a", metadata["acodec"]] if audio],
+            *[s for s in ["-b:a", str(metadata["abitrate"])] if audio],
+            "-r", str(source_framerate),
+            "-f", "matroska",
+            self.restored_video
+        ]
+
+        logger.debug(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+        result = self.run_ffmpeg(ffmpeg_cmd, expected_duration=curve.duration)
+
+        if result.returncode != 0:
+            logger.debug(f"FFmpeg stderr: {result.stderr}")
+            raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
+
+        logger.info(f"Decompression complete: saved as {self.restored_video}")
+
+    def encode_audio_only(self, segments_to_encode):
+        """Encode (compress) an input with no video stream, in a single ffmpeg run over the whole audio track."""
+        process_audio(self.input_video, self.compressed_video, segments_to_encode, get_audio_metadata(self.input_video), mode="encode", tempo=self.atempo, run=self.run_ffmpeg)
+        logger.info(f"Compression complete: saved as {self.compressed_video}")
+        return [self.compressed_video]
+
+    def decode_audio_only(self, segments):
+        """Decode (expand) an audio-only compressed file, in a single ffmpeg run over the whole audio track."""
+        process_audio(self.compressed_video, self.restored_video, segments, get_audio_metadata(self.compressed_video), mode="decode", tempo=self.atempo, run=self.run_ffmpeg)
+        logger.info(f"Decompression complete: saved as {self.restored_video}")
+
+    def decode_segments(self, segments, split_files=None, source_ids=None):
+        """Decode (expand) the segments.
+        If split_files is given (one file or (file, start, end) range per segment), those are decoded directly instead of cutting up the compressed video.
+        source_ids identify each segment for the segment cache (e.g. by the cache key of the encoded segment it is).
+        They default to the compressed video itself, and then the segment's position on it goes into the key too."""
+        #original_duration = get_video_duration(self.input_video)
+
+        # This code is now done before calling this function
+        # We need to adjust the segment times to first be relative to the compressed video.
+        # Then we adjust those times to the closest keyframes.
+        #segments_with_pass_through = add_pass_through_segments(segments, original_duration)
+        #mutated_segments = get_mutated_segments(original_duration, segments_with_pass_through)
+        #adjusted_segments = adjust_segments_to_keyframes(self.compressed_video, mutated_segments)
+
+        #adjusted_segments = mutated_segments
+
+        logger.debug(f"Segments: {segments}")
+        # Dynamically infer the filename extension
+        _, ext = os.path.splitext(self.compressed_video)
+        processed = [seg["interest"] != 1.0 for seg in segments]
+        restored_segments = [os.path.join(self.temp_dir, f"restored_{i}{ext}") if processed[i] else None for i in range(len(segments))]
+        if source_ids is None:
+            cache_keys = self.get_segment_cache_keys([file_identity(self.compressed_video)] * len(segments), segments, "decode")
+        else:
+            # A segment's place on the compressed timeline moves whenever an earlier segment's interest changes
+            cache_keys = self.get_segment_cache_keys(source_ids, segments, "decode", position=False)
+        cached = self.fetch_cached_segments(cache_keys, restored_segments)
+
+        if split_files is None:
+            split_files = self.get_segment_sources(self.compressed_video, segments, "decode_pre",
+                                                   [processed[i] and not cached[i] for i in range(len(processed))])
+        logger.info(f"Beginning decode pass\n{split_files}")
+
+        items = []
+        for i, seg in enumerate(segments):
+            interest = seg["interest"]
+            expansion_factor = 1 / interest  # Decompression factor (to restore timing)
+
+            if not processed[i]:
+                # Skip processing and reference the source in the concat list
+                restored_segments[i] = split_files[i]
+                logger.debug(f"Skipping processing for segment {i} with interest {interest}. Using source {split_files[i]}.")
+                continue
+
+            full_restored_path = restored_segments[i]
+            if cached[i]:
+                logger.debug(f"Using cached segment {i} with interest {interest}.")
+                continue
+            # An earlier run may have left a hardlink into the segment cache here, which must not be written through
+            if os.path.lexists(full_restored_path):
+                os.remove(full_restored_path)
+
+            logger.debug(f"Processing segment {i} with expansion factor {expansion_factor}. Saving to file {full_restored_path}")
+            # Restored segments are 1/interest times longer than the compressed ones, so weigh them by that
+            items.append({"index": i, "duration": (seg["end"] - seg["start"]) * expansion_factor, "source": split_files[i],
+                          "output": full_restored_path, "interest": expansion_factor, "mode": "decode"})
+
+        self.progress.start_stage("decode", sum(item["duration"] for item in items))
+        self.run_segments(items)
+        self.progress.end_stage()
+        self.store_cached_segments(cache_keys, restored_segments, [cached[i] or not processed[i] for i in range(len(processed))])
+
+        for i, seg in enumerate(segments):
+            compressed_duration = seg["end"] - seg["start"]
+            restored_duration = get_source_duration(restored_segments[i])
+            logger.info(f"Compressed segment duration: {compressed_duration}, Restored segment duration: {restored_duration}")
+
+        restored_concat_file = os.path.join(self.temp_dir, "restored_list.txt")
+        write_file_list(restored_concat_file, restored_segments, self.temp_dir)
+
+        metadata = get_video_metadata(self.input_video)
+
+        if self.final_reencode:
+            high_fps_video = os.path.join(self.temp_dir, "high_fps.mkv")
+            self.concatenate_segments(restored_concat_file, high_fps_video, metadata, segments=segments)
+
+            # Reencode to match the framerate to the original video
+            self.process_segment(high_fps_video, self.restored_video, 1.0, mode="decode-final", segments=segments)
+        else:
+            # Every restored segment is already at the source's framerate and sample rate
+            self.concatenate_segments(restored_concat_file, self.restored_video, metadata, segments=segments)
+        logger.info(f"Decompression complete: saved as {self.restored_video}")
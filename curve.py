@@ -0,0 +1,107 @@
+import numpy as np
+
+# Continuous interest curves.
+# Instead of piecewise-constant segments, a .mshit file can hold a time -> interest function, given either as control
+# points ({"points": [[time, interest], ...]}) or as a sampled series ({"start": t0, "interval": dt, "samples": [...]}).
+# Interest is interpolated linearly between points, and held constant before the first and after the last.
+# The compressed timeline is the integral of the interest, out(t) = integral of interest from 0 to t, which is
+# piecewise quadratic. It compiles into one setpts expression for the whole file, a flat sum with one term per piece:
+#   u = clip(T, t0, t1) - t0,  term = u * (a + h * u)                    (a: interest at t0, h: half the slope)
+# and the decoder's inverse, with y = clip(T, c0, c1) - c0 on the compressed timeline:
+#   term = 2 * y / (a + sqrt(a * a + 4 * h * y))
+# which is the root of u * (a + h * u) = y, in a form that doesn't divide by h, so flat pieces need no special case.
+# Audio can't follow a continuous rate, so it's mapped piece by piece at each piece's mean interest, which puts it
+# exactly in step with the video at every control point.
+
+
+class InterestCurve:
+    """A piecewise-linear time -> interest function over [0, duration].
+    Args:
+        times: Strictly increasing control point times.
+        interests: Interest at each control point, all above 0.
+        duration: Duration of the video the curve is relative to.
+    """
+
+    def __init__(self, times, interests, duration):
+        times = np.asarray(times, dtype=np.float64)
+        interests = np.asarray(interests, dtype=np.float64)
+        if len(times) == 0 or len(times) != len(interests):
+            raise ValueError("An interest curve needs one interest per control point, and at least one point")
+        if np.any(np.diff(times) <= 0):
+            raise ValueError("Interest curve control points must be in strictly increasing time order")
+        if np.any(interests <= 0):
+            raise ValueError("Interest curve values must be above 0")
+        # Hold the first and last interest out to the ends of the video
+        inside = times[(times > 0) & (times < duration)]
+        self.times = np.concatenate(([0.0], inside, [duration]))
+        self.interests = np.interp(self.times, times, interests)
+        self.duration = float(duration)
+        # Position of each control point on the compressed timeline
+        self.compressed_times = np.concatenate(([0.0], np.cumsum(self.piece_durations() * self.mean_interests())))
+
+    @classmethod
+    def from_metadata(cls, curve, duration):
+        """Build a curve from its mshit form, either control points or a sampled series."""
+        if "points" in curve:
+            points = np.asarray(curve["points"], dtype=np.float64).reshape(-1, 2)
+            return cls(points[:, 0], points[:, 1], duration)
+        samples = np.asarray(curve["samples"], dtype=np.float64)
+        times = curve.get("start", 0.0) + curve["interval"] * np.arange(len(samples))
+        return cls(times, samples, duration)
+
+    def to_metadata(self):
+        """The curve in its mshit form, as control points."""
+        return {"points": np.column_stack((self.times, self.interests)).tolist()}
+
+    def __len__(self):
+        return len(self.times)
+
+    def __repr__(self):
+        return f"InterestCurve({len(self)} points over {self.duration}s)"
+
+    def piece_durations(self):
+        return np.diff(self.times)
+
+    def mean_interests(self):
+        """Mean interest of each piece between control points."""
+        return (self.interests[:-1] + self.interests[1:]) / 2
+
+    def compressed_duration(self):
+        return float(self.compressed_times[-1])
+
+    def segments(self):
+        """Piecewise-constant segments at each piece's mean interest. They compress each piece to the same duration
+        as the curve does, so they line up with it at every control point."""
+        return [{"start": s, "end": e, "interest": i}
+                for s, e, i in zip(self.times[:-1].tolist(), self.times[1:].tolist(), self.mean_interests().tolist())]
+
+    def rebased(self):
+        """The curve relative to the compressed timeline, with each control point moved to where it ends up.
+        Interest is only exact at the control points, since it's no longer linear between them."""
+        return InterestCurve(self.compressed_times, self.interests, self.compressed_duration())
+
+    def _pieces(self):
+        starts, ends = self.times[:-1].tolist(), self.times[1:].tolist()
+        c_starts, c_ends = self.compressed_times[:-1].tolist(), self.compressed_times[1:].tolist()
+        a = self.interests[:-1].tolist()
+        h = (np.diff(self.interests) / self.piece_durations() / 2).tolist()
+        return zip(starts, ends, c_starts, c_ends, a, h)
+
+    def setpts_expr(self):
+        """setpts expression that compresses the video along the curve. Takes input timestamps starting at 0."""
+        terms = []
+        for t0, t1, _, _, a, h in self._pieces():
+            u = f"(clip(T,{t0!r},{t1!r})-{t0!r})"
+            terms.append(f"{u}*({a!r}+{h!r}*{u})" if h else f"{u}*{a!r}")
+        # Anything past the end keeps the last interest
+        terms.append(f"max(T-{self.duration!r},0)*{self.interests[-1].item()!r}")
+        return f"({'+'.join(terms)})/TB"
+
+    def inverse_setpts_expr(self):
+        """setpts expression that expands a compressed video back along the curve. Takes input timestamps starting at 0."""
+        terms = []
+        for _, _, c0, c1, a, h in self._pieces():
+            y = f"(clip(T,{c0!r},{c1!r})-{c0!r})"
+            terms.append(f"2*{y}/({a!r}+sqrt({a * a!r}+{4 * h!r}*{y}))" if h else f"{y}/{a!r}")
+        terms.append(f"max(T-{self.compressed_duration()!r},0)/{self.interests[-1].item()!r}")
+        return f"({'+'.join(terms)})/TB"
@@ -0,0 +1,220 @@
+import re
+import json
+import subprocess
+import argparse
+import numpy as np
+from avmeta import get_stream, get_video_duration, has_video
+from meta import compose_segment_maps
+from mshit import load_metadata
+from curve import InterestCurve
+from timeline import Timeline
+from scheduler import run_segment_jobs, thread_budget, THREAD_LIMIT
+from progress import run_ffmpeg
+from tracing import traced_run
+from logging_config import logger
+
+# Sampled quality evaluation of a restored file against its source.
+# Full-file PSNR/SSIM/VMAF decodes and compares every frame, which takes longer than the encode itself. Instead, each
+# segment of the segment map gets a few short windows, spread evenly over it and kept away from its edges, and each
+# window is compared in its own ffmpeg run (accurate input seeking on both files, one filter chain for every metric),
+# with the windows running in parallel.
+# The restored file is on the source's timeline, so a window is at the same time in both. Segment boundaries move a
+# little when they're snapped to keyframes on the way in and out, which the EDGE_MARGIN kept clear at each end absorbs.
+# Results are averaged per segment, and reported with each segment's place on the compressed timeline too.
+
+SAMPLES_PER_SEGMENT = 3
+WINDOW_SECONDS = 2.0
+# Seconds kept clear at each end of a segment, for boundaries moved by keyframe snapping
+EDGE_MARGIN = 1.0
+METRICS = ("psnr", "ssim", "vmaf")
+
+_METRIC_PATTERNS = {
+    "psnr": re.compile(r"PSNR .*?average:(\S+)"),
+    "ssim": re.compile(r"SSIM .*?All:(\S+)"),
+    "vmaf": re.compile(r"VMAF score[:=]\s*(\S+)"),
+}
+_has_libvmaf = None
+
+
+def has_libvmaf():
+    """Whether this ffmpeg was built with the libvmaf filter."""
+    global _has_libvmaf
+    if _has_libvmaf is None:
+        result = traced_run(["ffmpeg", "-hide_banner", "-filters"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        _has_libvmaf = result.returncode == 0 and re.search(r"\slibvmaf\s", result.stdout) is not None
+    return _has_libvmaf
+
+
+def sample_windows(start, end, samples=SAMPLES_PER_SEGMENT, window=WINDOW_SECONDS, margin=EDGE_MARGIN):
+    """Start times and length of the windows sampled from [start, end).
+    margin seconds are kept clear at each end (at most a quarter of the segment each), and what's left is cut into
+    `samples` equal parts with a window at the middle of each. Segments too short for that get fewer windows, and
+    segments with less than one window left are compared on all of it.
+    """
+    margin = min(margin, (end - start) / 4)
+    start, end = start + margin, end - margin
+    duration = end - start
+    count = max(1, min(samples, int(duration // window)))
+    length = min(window, duration)
+    centers = start + (np.arange(count) + 0.5) * duration / count
+    return (centers - length / 2).tolist(), length
+
+
+def compare_window(source, restored, start, length, size, metrics, threads=None, label=None, run=run_ffmpeg):
+    """Compare `length` seconds of restored against source, from `start`.
+    Args:
+        size: (width, height) of the source. The restored video is scaled to it if it differs.
+        metrics: Metrics to compute, out of METRICS.
+        run: Function to run ffmpeg with.
+    Returns:
+        Dict of metric -> score for the window.
+    """
+    width, height = size
+    thread_opts = ["-threads", str(threads)] if threads else []
+    # The restored frames go through each metric in turn, they pass their main input through unchanged
+    graph = [f"[0:v]setpts=PTS-STARTPTS,format=yuv420p,split={len(metrics)}" + "".join(f"[ref{i}]" for i in range(len(metrics))),
+             f"[1:v]setpts=PTS-STARTPTS,scale={width}:{height}:flags=bicubic,format=yuv420p[main0]"]
+    for i, metric in enumerate(metrics):
+        options = "shortest=1" + (f":n_threads={threads}" if metric == "vmaf" and threads else "")
+        graph.append(f"[main{i}][ref{i}]{'libvmaf' if metric == 'vmaf' else metric}={options}[main{i + 1}]")
+    ffmpeg_cmd = [
+        "ffmpeg", "-hide_banner", "-nostdin",
+        *thread_opts, "-ss", str(start), "-t", str(length), "-i", source,
+        *thread_opts, "-ss", str(start), "-t", str(length), "-i", restored,
+        "-filter_complex", ";".join(graph),
+        "-map", f"[main{len(metrics)}]",
+        "-f", "null", "-"
+    ]
+    result = run(ffmpeg_cmd, expected_duration=length, label=label)
+
+    if result.returncode != 0:
+        logger.debug(f"FFmpeg stderr: {result.stderr}")
+        raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
+    scores = {}
+    for metric in metrics:
+        match = _METRIC_PATTERNS[metric].search(result.stderr)
+        if match is None:
+            raise RuntimeError(f"FFmpeg didn't report a {metric} score for {restored} at {start}s")
+        scores[metric] = float(match.group(1))
+    return scores
+
+
+def evaluate(source, restored, segments, duration=None, samples=SAMPLES_PER_SEGMENT, window=WINDOW_SECONDS,
+             margin=EDGE_MARGIN, jobs=1, thread_limit=THREAD_LIMIT, vmaf=True, run=run_ffmpeg):
+    """Estimate the quality of restored against source, per segment, from sampled windows.
+    Args:
+        source: The original video.
+        restored: The restored video, on the source's timeline.
+        segments: The interest segments it was encoded with, relative to the source.
+        duration: Duration of the source. Default: probed.
+        samples: Windows per segment.
+        window: Length of each window in seconds.
+        margin: Seconds kept clear at each end of a segment.
+        jobs: Number of windows to compare concurrently.
+        vmaf: Compute VMAF too, if ffmpeg has libvmaf.
+        run: Function to run ffmpeg with, e.g. a codec's run_ffmpeg.
+    Returns:
+        Dict with "metrics", the metrics computed, "segments", one dict per segment of the completed segment map
+        (start, end, interest, compressed_start, compressed_end, windows and the mean and min of each metric),
+        and "overall", the duration-weighted mean of each metric.
+    """
+    if not has_video(source):
+        raise ValueError(f"{source} has no video to evaluate")
+    if duration is None:
+        duration = get_video_duration(source)
+    metrics = [m for m in METRICS if m != "vmaf" or (vmaf and has_libvmaf())]
+    if vmaf and "vmaf" not in metrics:
+        logger.warning("FFmpeg was built without libvmaf, skipping VMAF")
+    stream = get_stream(source)
+    size = (stream["width"], stream["height"])
+    # Only compare what both files have, the restored file can come out a frame or so short
+    end = min(duration, get_video_duration(restored))
+
+    segment_map = Timeline.from_segments(segments).completed(duration)
+    compressed_map = segment_map.rebased()
+    threads = thread_budget(jobs, thread_limit) if jobs > 1 or thread_limit else None
+    tasks = []
+    for index, (seg_start, seg_end) in enumerate(zip(segment_map.start.tolist(), segment_map.end.tolist())):
+        seg_end = min(seg_end, end)
+        if seg_end <= seg_start:
+            continue
+        starts, length = sample_windows(seg_start, seg_end, samples, window, margin)
+        for k, start in enumerate(starts):
+            label = f"segment {index} window {k} ({start:.2f}s)"
+            tasks.append((index, length, lambda start=start, length=length, label=label:
+                          compare_window(source, restored, start, length, size, metrics, threads, label, run)))
+    logger.info(f"Comparing {len(tasks)} windows of {restored} against {source} for {', '.join(metrics)}")
+    scores = run_segment_jobs([(length, task) for _, length, task in tasks], jobs)
+
+    results = []
+    for index in range(len(segment_map)):
+        window_scores = [score for (i, _, _), score in zip(tasks, scores) if i == index]
+        result = {
+            "start": segment_map.start[index].item(),
+            "end": segment_map.end[index].item(),
+            "interest": segment_map.interest[index].item(),
+            "compressed_start": compressed_map.start[index].item(),
+            "compressed_end": compressed_map.end[index].item(),
+            "windows": len(window_scores),
+        }
+        for metric in metrics:
+            values = [s[metric] for s in window_scores]
+            result[metric] = float(np.mean(values)) if values else None
+            result[f"{metric}_min"] = float(np.min(values)) if values else None
+        results.append(result)
+
+    overall = {}
+    for metric in metrics:
+        scored = [r for r in results if r[metric] is not None]
+        weights = [r["end"] - r["start"] for r in scored]
+        overall[metric] = float(np.average([r[metric] for r in scored], weights=weights)) if scored else None
+    return {"metrics": metrics, "segments": results, "overall": overall}
+
+
+def format_report(report):
+    """The evaluation as a table, one row per segment."""
+    metrics = report["metrics"]
+    lines = [f"{'start':>9} {'end':>9} {'interest':>8} {'windows':>7}" + "".join(f" {m:>7} {m + ' min':>9}" for m in metrics)]
+    for seg in report["segments"]:
+        line = f"{seg['start']:9.2f} {seg['end']:9.2f} {seg['interest']:8.3g} {seg['windows']:7d}"
+        for metric in metrics:
+            line += " " + (f"{seg[metric]:7.3f} {seg[metric + '_min']:9.3f}" if seg[metric] is not None else f"{'-':>7} {'-':>9}")
+        lines.append(line)
+    lines.append("overall: " + ", ".join(f"{m} {report['overall'][m]:.3f}" for m in metrics if report["overall"][m] is not None))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate PSNR, SSIM and VMAF of a restored video against its source, per segment, from sampled windows")
+    parser.add_argument("source", help="Original video")
+    parser.add_argument("restored", help="Restored video")
+    parser.add_argument("-t", "--metadata", nargs="+", help="Metadata file(s) it was encoded with, as for shit.py -t. Default: the whole file as one segment.")
+    parser.add_argument("-n", "--samples", type=int, default=SAMPLES_PER_SEGMENT, help=f"Windows per segment. Default: {SAMPLES_PER_SEGMENT}")
+    parser.add_argument("-w", "--window", type=float, default=WINDOW_SECONDS, help=f"Length of each window in seconds. Default: {WINDOW_SECONDS:g}")
+    parser.add_argument("-m", "--margin", type=float, default=EDGE_MARGIN, help=f"Seconds kept clear at each end of a segment, where keyframe snapping may have moved its boundary. Default: {EDGE_MARGIN:g}")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of windows to compare concurrently. Default: 1")
+    parser.add_argument("--no_vmaf", help="Skip VMAF even if ffmpeg has libvmaf.", action="store_true")
+    parser.add_argument("--json", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    duration = None
+    segments = []
+    if args.metadata:
+        passes = [load_metadata(metadata_file) for metadata_file in args.metadata]
+        duration = passes[0]["duration"]
+        if len(passes) > 1:
+            segments = compose_segment_maps([(p["duration"], p["segments"]) for p in passes])
+        elif "curve" in passes[0]:
+            segments = InterestCurve.from_metadata(passes[0]["curve"], duration).segments()
+        else:
+            segments = passes[0]["segments"]
+    report = evaluate(args.source, args.restored, segments, duration, samples=args.samples, window=args.window,
+                      margin=args.margin, jobs=args.jobs, vmaf=not args.no_vmaf)
+    logger.info(f"Quality of {args.restored}:\n{format_report(report)}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import argparse
+import threading
+from codec import ShitCodec
+from logging_config import logger
+from tracing import in_current_context
+
+# Multi-node segment processing over a shared filesystem.
+# A coordinator publishes each stage's segments as a job in the farm directory:
+#   jobs/<job id>/job.json           the source and the codec options workers need
+#   jobs/<job id>/items/<i>.json     one work item per segment: its source, interest, mode and duration
+#   jobs/<job id>/claims/<i>.lock    held by the worker processing the item
+#   jobs/<job id>/done/<i>.json      written once the item's output is in place
+#   jobs/<job id>/failed/<i>.json    the errors of failed attempts
+#   jobs/<job id>/out/<i>.mkv        the item's output
+# A job is staged next to jobs/ and renamed into place, so workers never see half of one.
+# Workers claim items, longest first, by creating their lock file with O_EXCL, which only one of them can do. They keep
+# the lock's mtime fresh while they work. A lock whose mtime hasn't changed for a whole lease, timed on the observing
+# worker's own clock so node clock skew doesn't matter, belongs to a dead or hung worker: it's renamed away (which,
+# again, only one worker can do) and the item is claimed again. A heartbeat can land between the check and the rename,
+# so the renamed lock is checked again, and put back if it turns out to be alive. Failed items are retried up to MAX_ATTEMPTS times.
+# The coordinator works on its own job like any other worker, then waits for the rest and moves the outputs into place.
+
+LEASE_SECONDS = 60.0
+POLL_INTERVAL = 1.0
+MAX_ATTEMPTS = 3
+
+
+def _write_json(path, data):
+    """Write JSON to path atomically, so readers see all of it or none of it."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def make_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class FarmJob:
+    """One published job in a farm directory."""
+
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        self.spec = _read_json(os.path.join(job_dir, "job.json"))
+        if self.spec is None:
+            raise FileNotFoundError(f"No job in {job_dir}")
+        self.count = self.spec["count"]
+        self.lease = self.spec["lease"]
+        self._items = {}
+
+    @classmethod
+    def publish(cls, farm_dir, spec, items):
+        """Publish items as a new job. Returns the FarmJob."""
+        job_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        staging_dir = os.path.join(farm_dir, "staging", job_id)
+        for sub_dir in ("items", "claims", "done", "failed", "out"):
+            os.makedirs(os.path.join(staging_dir, sub_dir))
+        for i, item in enumerate(items):
+            _write_json(os.path.join(staging_dir, "items", f"{i}.json"), item)
+        _write_json(os.path.join(staging_dir, "job.json"), dict(spec, count=len(items)))
+        job_dir = os.path.join(farm_dir, "jobs", job_id)
+        os.makedirs(os.path.dirname(job_dir), exist_ok=True)
+        os.rename(staging_dir, job_dir)
+        logger.info(f"Published {len(items)} work items as {job_dir}")
+        return cls(job_dir)
+
+    def _path(self, sub_dir, i, ext):
+        return os.path.join(self.job_dir, sub_dir, f"{i}.{ext}")
+
+    def item(self, i):
+        if i not in self._items:
+            item = _read_json(self._path("items", i, "json"))
+            if item is None:
+                raise FileNotFoundError(f"No item {i} in {self.job_dir}")
+            self._items[i] = item
+        return self._items[i]
+
+    def output_path(self, i):
+        return self._path("out", i, "mkv")
+
+    def is_done(self, i):
+        return os.path.exists(self._path("done", i, "json"))
+
+    def attempts(self, i):
+        failed = _read_json(self._path("failed", i, "json"))
+        return len(failed["errors"]) if failed else 0
+
+    def is_exhausted(self, i):
+        return not self.is_done(i) and self.attempts(i) >= MAX_ATTEMPTS
+
+    def try_claim(self, i, worker_id):
+        """Claim item i for worker_id. Returns False if someone else holds it."""
+        try:
+            fd = os.open(self._path("claims", i, "lock"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": worker_id, "time": time.time()}, f)
+        return True
+
+    def owner(self, i):
+        claim = None
+        try:
+            claim = _read_json(self._path("claims", i, "lock"))
+        except ValueError:
+            # Caught between the claim being created and written
+            pass
+        return claim["worker"] if claim else None
+
+    def heartbeat(self, i, worker_id):
+        """Renew worker_id's lease on item i. Returns False if it has lost the item."""
+        if self.owner(i) != worker_id:
+            return False
+        try:
+            os.utime(self._path("claims", i, "lock"))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self, i, worker_id):
+        """Drop worker_id's claim on item i, if it still holds it."""
+        if self.owner(i) == worker_id:
+            try:
+                os.remove(self._path("claims", i, "lock"))
+            except FileNotFoundError:
+                pass
+
+    def try_steal(self, i, worker_id, observed):
+        """Take over item i if its lease has expired.
+        Args:
+            observed: {(job_dir, i): (mtime, first seen)} of the claims this worker has seen, kept between calls.
+        """
+        claim_path = self._path("claims", i, "lock")
+        try:
+            mtime = os.stat(claim_path).st_mtime_ns
+        except FileNotFoundError:
+            return self.try_claim(i, worker_id)
+        now = time.monotonic()
+        key = (self.job_dir, i)
+        if key not in observed or observed[key][0] != mtime:
+            observed[key] = (mtime, now)
+            return False
+        if now - observed[key][1] < self.lease:
+            return False
+        stale_path = f"{claim_path}.stale.{worker_id}"
+        try:
+            os.rename(claim_path, stale_path)
+        except FileNotFoundError:
+            # Another worker got there first
+            return False
+        del observed[key]
+        if os.stat(stale_path).st_mtime_ns != mtime:
+            # Its owner renewed it just before the rename, so it's alive: put it back, unless the item has been
+            # claimed again in the meantime, in which case the owner finds out at its next heartbeat
+            try:
+                os.link(stale_path, claim_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        logger.warning(f"Lease on item {i} of {self.job_dir} expired, reclaiming it")
+        return self.try_claim(i, worker_id)
+
+    def mark_done(self, i, worker_id, elapsed):
+        _write_json(self._path("done", i, "json"), {"worker": worker_id, "elapsed": elapsed})
+
+    def mark_failed(self, i, worker_id, error):
+        # Only the claim holder writes this, so there's no race on it
+        failed = _read_json(self._path("failed", i, "json")) or {"errors": []}
+        failed["errors"].append({"worker": worker_id, "error": error})
+        _write_json(self._path("failed", i, "json"), failed)
+
+    def order(self):
+        """Item indexes, longest first."""
+        return sorted(range(self.count), key=lambda i: self.item(i)["duration"], reverse=True)
+
+    def progress(self):
+        """(done, claimed, exhausted) item counts."""
+        done = sum(1 for i in range(self.count) if self.is_done(i))
+        claimed = len([name for name in os.listdir(os.path.join(self.job_dir, "claims")) if name.endswith(".lock")])
+        exhausted = sum(1 for i in range(self.count) if self.is_exhausted(i))
+        return done, claimed, exhausted
+
+
+class FarmWorker:
+    """Processes work items from a farm directory.
+    Args:
+        farm_dir: The shared farm directory.
+        jobs: Number of items to process at once.
+        worker_id: Unique name of this worker. Default: host, pid and a random suffix.
+    """
+
+    def __init__(self, farm_dir, jobs=1, worker_id=None):
+        self.farm_dir = farm_dir
+        self.jobs = max(1, jobs)
+        self.worker_id = worker_id or make_worker_id()
+        self._observed = {}
+        self._claim_lock = threading.Lock()
+        self._codecs = {}
+
+    def list_jobs(self):
+        jobs_dir = os.path.join(self.farm_dir, "jobs")
+        if not os.path.isdir(jobs_dir):
+            return []
+        return [os.path.join(jobs_dir, name) for name in sorted(os.listdir(jobs_dir))]
+
+    def codec_for(self, job):
+        """A codec with the job's source and options, for processing its items."""
+        if job.job_dir not in self._codecs:
+            spec = job.spec
+            self._codecs[job.job_dir] = ShitCodec(spec["input_video"], None, None, job.job_dir, minterp=spec["minterp"],
+                                                  jobs=self.jobs, profile=spec["profile"], debug=spec["debug"],
+                                                  stall_timeout=spec.get("stall_timeout"), time_budget=spec.get("time_budget"))
+        return self._codecs[job.job_dir]
+
+    def claim_next(self, job):
+        """Claim the longest open item of job, or one whose lease has expired. Returns its index, or None."""
+        with self._claim_lock:
+            for i in job.order():
+                if job.is_done(i) or job.is_exhausted(i):
+                    continue
+                if job.try_claim(i, self.worker_id) or job.try_steal(i, self.worker_id, self._observed):
+                    return i
+        return None
+
+    def process(self, job, i):
+        """Process item i, which this worker has claimed, keeping its lease alive until it's done."""
+        item = job.item(i)
+        stop = threading.Event()
+
+        def keep_alive():
+            while not stop.wait(job.lease / 4):
+                if job.heartbeat(i, self.worker_id):
+                    continue
+                # The lock goes missing for a moment while another worker tries to steal it and puts it back,
+                # so only give up once someone else holds it, and otherwise try again on the next tick
+                owner = job.owner(i)
+                if owner is not None and owner != self.worker_id:
+                    logger.warning(f"Lost item {i} of {job.job_dir} to {owner}")
+                    return
+        heartbeat = threading.Thread(target=keep_alive, daemon=True)
+        heartbeat.start()
+
+        codec = self.codec_for(job)
+        source = tuple(item["source"]) if isinstance(item["source"], list) else item["source"]
+        tmp_output = f"{job.output_path(i)}.{self.worker_id}.tmp"
+        start_time = time.monotonic()
+        logger.info(f"Processing item {i} of {job.job_dir} ({item['mode']}, interest {item['interest']})")
+        try:
+            codec.process_segment_source(source, tmp_output, item["interest"], mode=item["mode"], threads=codec.segment_threads())
+            if job.is_done(i):
+                # Someone else finished it after taking over our lease
+                os.remove(tmp_output)
+            else:
+                os.replace(tmp_output, job.output_path(i))
+                job.mark_done(i, self.worker_id, round(time.monotonic() - start_time, 3))
+        except Exception as e:
+            logger.error(f"Item {i} of {job.job_dir} failed: {e}")
+            job.mark_failed(i, self.worker_id, str(e))
+            if os.path.exists(tmp_output):
+                os.remove(tmp_output)
+        finally:
+            stop.set()
+            heartbeat.join()
+            job.release(i, self.worker_id)
+
+    def work_on(self, job):
+        """Process items of job on `jobs` threads until there are none left to claim. Returns how many were processed."""
+        processed = [0] * self.jobs
+
+        def work(slot):
+            while True:
+                try:
+                    i = self.claim_next(job)
+                    if i is None:
+                        return
+                    self.process(job, i)
+                except FileNotFoundError:
+                    # The coordinator has retired the job
+                    return
+                processed[slot] += 1
+        threads = [threading.Thread(target=in_current_context(work), args=(slot,)) for slot in range(self.jobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sum(processed)
+
+    def run(self, idle_exit=None, poll_interval=POLL_INTERVAL):
+        """Work on every published job, polling for new ones.
+        Args:
+            idle_exit: Stop after this many seconds without finding work. Default: run forever.
+        """
+        logger.info(f"Worker {self.worker_id} watching {self.farm_dir}")
+        idle_since = time.monotonic()
+        while True:
+            processed = 0
+            for job_dir in self.list_jobs():
+                try:
+                    processed += self.work_on(FarmJob(job_dir))
+                except FileNotFoundError:
+                    # Retired while we were looking at it
+                    continue
+            if processed:
+                idle_since = time.monotonic()
+            elif idle_exit is not None and time.monotonic() - idle_since > idle_exit:
+                logger.info(f"Worker {self.worker_id} idle for {idle_exit}s, exiting")
+                return
+            time.sleep(poll_interval)
+
+
+class Farm:
+    """Coordinator side of a farm: runs a codec's segments on every worker watching farm_dir.
+    Args:
+        farm_dir: The shared farm directory. The source, and any split segment files, must be on shared storage too.
+        lease: Seconds without a heartbeat after which a worker's items are taken over.
+        poll_interval: Seconds between checks on the job's progress.
+    """
+
+    def __init__(self, farm_dir, lease=LEASE_SECONDS, poll_interval=POLL_INTERVAL):
+        self.farm_dir = os.path.abspath(farm_dir)
+        self.lease = lease
+        self.poll_interval = poll_interval
+
+    def run(self, codec, items):
+        """Process items (see ShitCodec.run_segments) on the farm, with this process working on them too."""
+        if not items:
+            return
+        spec = {"input_video": os.path.abspath(codec.input_video), "minterp": codec.minterp, "profile": codec.profile,
+                "debug": codec.debug, "stall_timeout": codec.stall_timeout, "time_budget": codec.time_budget, "lease": self.lease}
+        published = []
+        for item in items:
+            source = item["source"]
+            source = [os.path.abspath(source[0]), source[1], source[2]] if isinstance(source, tuple) else os.path.abspath(source)
+            published.append({"index": item["index"], "duration": item["duration"], "source": source,
+                              "interest": item["interest"], "mode": item["mode"]})
+        job = FarmJob.publish(self.farm_dir, spec, published)
+
+        # Work on it here as well, then wait for whatever other workers still have
+        worker = FarmWorker(self.farm_dir, jobs=codec.jobs)
+        worker.work_on(job)
+        last_report = None
+        while True:
+            done, claimed, exhausted = job.progress()
+            if (done, claimed) != last_report:
+                logger.info(f"Farm job {os.path.basename(job.job_dir)}: {done}/{job.count} done, {claimed} in progress")
+                last_report = (done, claimed)
+            if exhausted:
+                failed = [i for i in range(job.count) if job.is_exhausted(i)]
+                raise RuntimeError(f"Farm items {failed} of {job.job_dir} failed {MAX_ATTEMPTS} times")
+            if done == job.count:
+                break
+            # Pick up items whose workers died, or that failed and can be retried
+            worker.work_on(job)
+            time.sleep(self.poll_interval)
+
+        for i, item in enumerate(items):
+            shutil.move(job.output_path(i), item["output"])
+        self.retire(job)
+
+    def retire(self, job):
+        """Move a finished job out of jobs/, so workers stop looking at it, and delete it."""
+        retired_dir = os.path.join(self.farm_dir, "retired", os.path.basename(job.job_dir))
+        os.makedirs(os.path.dirname(retired_dir), exist_ok=True)
+        os.rename(job.job_dir, retired_dir)
+        shutil.rmtree(retired_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process segments published to a shared farm directory by shit.py --farm.")
+    parser.add_argument("farm_dir", help="The shared farm directory")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of segments to process at once. Default: 1")
+    parser.add_argument("--worker_id", help="Unique name for this worker. Default: host name, pid and a random suffix")
+    parser.add_argument("--idle_exit", type=float, help="Exit after this many seconds without work. Default: run until killed")
+    args = parser.parse_args()
+
+    FarmWorker(args.farm_dir, jobs=args.jobs, worker_id=args.worker_id).run(idle_exit=args.idle_exit)
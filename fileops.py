@@ -1,7 +1,49 @@
 import os
+import shutil
+import fcntl
+
+# ioctl that makes dst share src's data blocks on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
 def write_file_list(file_list_path, segment_filenames, temp_directory):
-    """Write a list of segment filenames to a file for FFmpeg concatenation."""
+    """Write a list of segments to a file for FFmpeg concatenation.
+    Each segment is either a filename, or a (filename, inpoint, outpoint) range of a file, which the concat demuxer reads in place."""
     with open(file_list_path, "w") as f:
-        for filename in segment_filenames:
-            relative_filename = os.path.relpath(filename, temp_directory)
-            f.write(f"file '{relative_filename}'\n")
\ No newline at end of file
+        for segment in segment_filenames:
+            filename, inpoint, outpoint = segment if isinstance(segment, tuple) else (segment, None, None)
+            relative_filename = os.path.relpath(filename, temp_directory).replace("'", "'\\''")
+            f.write(f"file '{relative_filename}'\n")
+            if inpoint is not None:
+                f.write(f"inpoint {inpoint}\n")
+                f.write(f"outpoint {outpoint}\n")
+
+def file_identity(path):
+    """A string that identifies a file's current contents by path, size and mtime, for use as a cache key."""
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+
+def reflink(src, dst):
+    """Make dst a copy-on-write clone of src. Raises OSError where that isn't supported."""
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst, falling back to a reflink and then a plain copy (e.g. across filesystems). dst is replaced if it exists."""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        reflink(src, dst)
+        return
+    except OSError:
+        pass
+    shutil.copy2(src, dst)
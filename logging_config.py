@@ -7,7 +7,8 @@ class FunctionFilter(logging.Filter):
         self.func_names = func_names
 
     def filter(self, record):
-        return record.funcName in self.func_names
+        # Warnings and errors always get through, wherever they come from
+        return record.levelno >= logging.WARNING or record.funcName in self.func_names
 
 # Set up logging
 logger = colorlog.getLogger(__name__)
@@ -24,7 +25,7 @@ if not logger.hasHandlers():
       }
   ))
   #functions_to_watch = ["get_mutated_segments", "adjust_segments_to_keyframes", "add_pass_through_segments", "split_video", "concatenate_segments", "encode_segments", "decode_segments"]
-  functions_to_watch = ['split_video', 'concatenate_segments', 'encode_segments', 'decode_segments', 'process_segment']
+  functions_to_watch = ['split_video', 'concatenate_segments', 'encode_segments', 'encode_segments_pipelined', 'encode_segments_smart', 'encode_single_graph', 'encode_audio_only', 'decode_segments', 'encode_curve', 'decode_curve', 'process_segment', 'report_progress', 'publish', 'get_proxy', 'evaluate', 'collect_frame_stats', 'process', 'run', 'run_ffmpeg', 'main', '<module>']
   #functions_to_watch = ["add_pass_through_segments"]
 
   ff = FunctionFilter(functions_to_watch)
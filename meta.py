@@ -1,181 +1,110 @@
-import os
-import subprocess
 from logging_config import logger
-from avmeta import get_video_duration
+from avmeta import get_video_duration, get_keyframes
+from mshit import save_metadata
+from timeline import Timeline
 from math import isclose
 
 def add_pass_through_segments(segments, original_duration):
     """Add pass-through segments with intensity 1 between the given segments."""
-    new_segments = []
-    previous_end = 0
-
-    for seg in segments:
-        start, end, interest = seg["start"], seg["end"], seg["interest"]
-
-        # Adjust start to 0 if it's close to 0
-        if start < 1:
-            start = 0
-
-        # Add pass-through segment if there is a gap between the previous end and the current start
-        if start > previous_end:
-            new_segments.append({
-                "start": previous_end,
-                "end": start,
-                "interest": 1.0
-            })
-
-        # Add the current segment
-        new_segments.append(seg)
-        previous_end = end
-
-    # Adjust end to original_duration if it's close to original_duration
-    if previous_end > original_duration - 1:
-        previous_end = original_duration
-
-    # Add pass-through segment if there is a gap between the last segment end and the original duration
-    if previous_end < original_duration:
-        new_segments.append({
-            "start": previous_end,
-            "end": original_duration,
-            "interest": 1.0
-        })
-    logger.debug(f"New segments with pass-through: {new_segments}")
+    new_segments = Timeline.from_segments(segments).with_pass_through(original_duration).to_segments()
+    logger.debug(f"Added {len(new_segments) - len(segments)} pass-through segments to {len(segments)} segments")
     return new_segments
 
 
 def calculate_compressed_duration(original_duration, segments):
-    """Calculate the estimated compressed duration based on the original duration and segment information."""
-    compressed_duration = 0
-    for seg in segments:
-        start, end, interest = seg["start"], seg["end"], seg["interest"]
-        segment_duration = end - start
-        compressed_segment_duration = segment_duration * interest
-        compressed_duration += compressed_segment_duration
-        logger.info(f"Segment {start}-{end} with interest {interest}: Original segment duration: {segment_duration}, Compressed segment duration = {compressed_segment_duration}")
-
-    # Add the duration of the parts of the video not covered by segments
-    total_segment_duration = sum(seg["end"] - seg["start"] for seg in segments)
-    non_segment_duration = original_duration - total_segment_duration
-    compressed_duration += non_segment_duration
-
-    return compressed_duration
+    """Calculate the estimated compressed duration based on the original duration and segment information.
+    The parts of the video not covered by segments keep their duration."""
+    return Timeline.from_segments(segments).compressed_duration(original_duration)
 
 def calculate_expanded_duration(compressed_duration, segments):
     """Calculate the estimated expanded duration based on the compressed duration and segment information."""
-    expanded_duration = 0
-    for seg in segments:
-        start, end, interest = seg["start"], seg["end"], seg["interest"]
-        segment_duration = end - start
-
-        # Relative compressed duration based on interest
-        compressed_duration = calculate_compressed_duration(segment_duration, [seg])
-
-        expanded_segment_duration = compressed_duration / interest
-        expanded_duration += expanded_segment_duration
-        logger.info(f"Segment {start}-{end} with interest {interest}: Compressed segment duration: {compressed_duration}, Expanded segment duration = {expanded_segment_duration}")
-
-    # Add the duration of the parts of the video not covered by segments
-    total_segment_duration = sum(seg["end"] - seg["start"] for seg in segments)
-    non_segment_duration = compressed_duration - total_segment_duration
-    expanded_duration += non_segment_duration
-
-    return expanded_duration
+    return Timeline.from_segments(segments).expanded_duration(compressed_duration)
 
 
 def get_mutated_segments(segments):
     """Return a list of mutated segments relative to the times in the compressed video."""
-    mutated_segments = []
-    current_time = 0
-
-    for i, seg in enumerate(segments):
-        start, end, interest = seg["start"], seg["end"], seg["interest"]
-        segment_duration = end - start
-        compressed_segment_duration = segment_duration * interest
-        logger.debug(f"Time: {current_time} segment {i} segment_duration: {segment_duration}, * {interest} = {compressed_segment_duration}")
-
-        mutated_segments.append({
-            "start": current_time,
-            "end": current_time + compressed_segment_duration,
-            "interest": interest
-        })
-
-        current_time += compressed_segment_duration
-
-    ## Add the remaining duration as a single segment if there is any
-    #total_segment_duration = sum(seg["end"] - seg["start"] for seg in segments)
-    #non_segment_duration = original_duration - total_segment_duration
-    #if non_segment_duration > 0:
-    #    mutated_segments.append({
-    #        "start": current_time,
-    #        "end": current_time + non_segment_duration,
-    #        "interest": 1.0
-    #    })
-
-    logger.info(f"Mutated segments: {mutated_segments}")
+    mutated_segments = Timeline.from_segments(segments).rebased().to_segments()
+    logger.debug(f"Mutated {len(mutated_segments)} segments, compressed duration {mutated_segments[-1]['end'] if mutated_segments else 0}")
     return mutated_segments
 
 
+def complete_segment_map(segments, duration):
+    """Add pass-through segments and close any remaining gaps, so the segments cover [0, duration) contiguously."""
+    return Timeline.from_segments(segments).completed(duration).to_segments()
+
+
+def merge_equal_segments(segments):
+    """Merge adjacent segments with the same interest."""
+    return Timeline.from_segments(segments).merged().to_segments()
+
+
+def compose_segments(first, second):
+    """Compose two complete segment maps, where second is relative to the output of first.
+    Each map takes a timeline to one sped up by interest within each segment, so the composition is another
+    piecewise-linear map, with breakpoints from both maps and interests multiplied together."""
+    first_out = get_mutated_segments(first)
+    composed = []
+    i = j = 0
+    position = 0  # In first's output timeline, which second's segments are relative to
+    while i < len(first) and j < len(second):
+        end = min(first_out[i]["end"], second[j]["end"])
+        if end > position:
+            # Map the interval back to first's input timeline
+            interest = first[i]["interest"]
+            start_in = first[i]["start"] + (position - first_out[i]["start"]) / interest
+            end_in = first[i]["start"] + (end - first_out[i]["start"]) / interest
+            composed.append({"start": start_in, "end": end_in, "interest": interest * second[j]["interest"]})
+            position = end
+        if isclose(first_out[i]["end"], end, abs_tol=1e-9):
+            i += 1
+        if j < len(second) and isclose(second[j]["end"], end, abs_tol=1e-9):
+            j += 1
+    # second may be slightly shorter than first's output, which leaves the rest of first's segments as they are
+    while i < len(first):
+        if first_out[i]["end"] > position:
+            interest = first[i]["interest"]
+            start_in = first[i]["start"] + (max(position, first_out[i]["start"]) - first_out[i]["start"]) / interest
+            composed.append({"start": start_in, "end": first[i]["end"], "interest": interest})
+            position = first_out[i]["end"]
+        i += 1
+    return merge_equal_segments(composed)
+
+
+def compose_segment_maps(passes):
+    """Compose the segment maps of several passes into one map from the original timeline to the final one.
+    Args:
+        passes: List of (duration, segments) per pass, in order. Each pass's segments are relative to the output of the one before.
+    Returns:
+        The composed segments, relative to the first pass's input, which can be encoded (and decoded) in a single pass.
+    """
+    duration, segments = passes[0]
+    composed = complete_segment_map(segments, duration)
+    for pass_duration, pass_segments in passes[1:]:
+        composed = compose_segments(composed, complete_segment_map(pass_segments, pass_duration))
+    logger.info(f"Composed {len(passes)} passes into {len(composed)} segments: {composed}")
+    return composed
+
+
 def adjust_segments_to_keyframes(input_file, segments, temp_dir):
     """Adjust segment times to the closest keyframes."""
-    keyframes_file = os.path.join(temp_dir, f"{os.path.splitext(input_file)[0]}_keyframes.txt")
     original_duration = get_video_duration(input_file)
     logger.debug(f"Adjusting segments {segments} for {input_file}")
-    
-    # Run ffprobe to get keyframes
-    ffprobe_cmd = [
-        "ffprobe", "-i", input_file, "-select_streams", "v",
-        "-show_packets", "-show_entries", "packet=pts_time,flags", "-of", "csv"
-    ]
-    
-    logger.debug(f"Loading keyframes from {keyframes_file}")
-    with open(keyframes_file, "w") as f:
-        result = subprocess.run(ffprobe_cmd, stdout=f, stderr=subprocess.PIPE, text=True)
-    
-    if result.returncode != 0:
-        raise RuntimeError(f"ffprobe command failed with return code {result.returncode}")
-    
-    # Read keyframes from file
-    keyframes = []
-    with open(keyframes_file, "r") as f:
-        for line in f:
-            if ",K" in line:  # Filter keyframes
-                parts = line.strip().split(",")
-                if len(parts) > 1 and parts[1]:
-                    try:
-                        keyframes.append(float(parts[1]))
-                    except ValueError:
-                        logger.warning(f"Skipping invalid keyframe timestamp: {parts[1]}")
-    
+
+    # The packet index is kept as a sidecar in the temp dir, so later runs on the same file don't rescan it
+    keyframes = get_keyframes(input_file, sidecar_dir=temp_dir)
+
     if not keyframes:
         raise RuntimeError("No keyframes found in the input file.")
-    
+
     logger.info(f"Found {len(keyframes)} keyframes.")
-    
+
     # Adjust segments to the closest keyframes
-    adjusted_segments = []
-    for i, seg in enumerate(segments):
-        start = min(keyframes, key=lambda k: abs(k - seg["start"]))
-        end = min(keyframes, key=lambda k: abs(k - seg["end"]))
-        # If the first or last segment is close to the start/end of the file, set its start/end to the file boundary.
-        if i == len(segments) - 1:
-            if isclose(end, original_duration, rel_tol=0.1):
-                end = original_duration
-        elif i == 0:
-            if isclose(start, 0.0, rel_tol=0.1):
-                start = 0.0
-        logger.debug(f"Found adjusted keyframe for segment {i}: {start} {end}")
-        adjusted_segments.append({"start": start, "end": end, "interest": seg["interest"]})
-    
+    adjusted_segments = Timeline.from_segments(segments).snapped(keyframes, original_duration).to_segments()
     logger.debug(f"Adjusted keyframes for {input_file}: {adjusted_segments}")
-    
+
     return adjusted_segments
 
 
-def write_metadata_file(metadata_file, duration, segments):
-    """Write the video metadata to a file."""
-    metadata = {
-        "duration": duration,
-        "segments": segments
-    }
-    with open(metadata_file, "w") as f:
-        f.write(str(metadata))
\ No newline at end of file
+def write_metadata_file(metadata_file, duration, segments, probe=None, binary=False, curve=None):
+    """Write the video metadata to a file. curve is an optional InterestCurve."""
+    save_metadata(metadata_file, duration, segments, probe=probe, binary=binary, curve=curve.to_metadata() if curve is not None else None)
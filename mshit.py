@@ -0,0 +1,124 @@
+import ast
+import json
+import os
+import struct
+from logging_config import logger
+
+# .mshit metadata files come in two variants, both carrying the same schema:
+#   JSON text: {"format": "mshit", "version": 1, "duration": ..., "segments": [...], "probe": {...}}
+#   Binary: MSHIT_MAGIC, a little-endian uint32 header length, the JSON header (everything but the segments,
+#           plus "segment_count"), then one SEGMENT_STRUCT record per segment. The records can be read as a stream.
+# Files written before versioning (a python dict literal) are migrated when loaded.
+# Either variant can also carry an interest "curve" (see curve.py), in which case the segments are its
+# piecewise-constant approximation, for readers that only understand segments.
+MSHIT_VERSION = 1
+MSHIT_MAGIC = b"MSHITB\x00\x01"
+SEGMENT_STRUCT = struct.Struct("<ddd")  # start, end, interest
+HEADER_LEN_STRUCT = struct.Struct("<I")
+SEGMENT_CHUNK = 4096
+
+
+def migrate_metadata(metadata):
+    """Bring metadata from any older version up to MSHIT_VERSION."""
+    version = metadata.get("version", 0)
+    if version > MSHIT_VERSION:
+        raise ValueError(f"mshit version {version} is newer than the supported version {MSHIT_VERSION}")
+    if version == 0:
+        # Unversioned files only had the duration and the segments
+        metadata = {
+            "duration": float(metadata["duration"]),
+            "segments": [{"start": float(s["start"]), "end": float(s["end"]), "interest": float(s["interest"])} for s in metadata["segments"]],
+        }
+    metadata["format"] = "mshit"
+    metadata["version"] = MSHIT_VERSION
+    metadata.setdefault("probe", {})
+    return metadata
+
+
+def iter_binary_segments(f, count):
+    """Read segment records from a binary mshit file a chunk at a time."""
+    remaining = count
+    while remaining > 0:
+        n = min(remaining, SEGMENT_CHUNK)
+        chunk = f.read(n * SEGMENT_STRUCT.size)
+        if len(chunk) != n * SEGMENT_STRUCT.size:
+            raise ValueError("Truncated mshit file")
+        for start, end, interest in SEGMENT_STRUCT.iter_unpack(chunk):
+            yield {"start": start, "end": end, "interest": interest}
+        remaining -= n
+
+
+def load_metadata(metadata_file):
+    """Load a .mshit file in any of its variants.
+    Args:
+        metadata_file: Path to the metadata file.
+    Returns:
+        A dict with "duration", "segments", "probe" (cached probe results, possibly empty) and "curve", if it has one.
+    """
+    with open(metadata_file, "rb") as f:
+        if f.read(len(MSHIT_MAGIC)) == MSHIT_MAGIC:
+            (header_len,) = HEADER_LEN_STRUCT.unpack(f.read(HEADER_LEN_STRUCT.size))
+            metadata = json.loads(f.read(header_len))
+            metadata["segments"] = list(iter_binary_segments(f, metadata.pop("segment_count")))
+            return migrate_metadata(metadata)
+        f.seek(0)
+        text = f.read().decode()
+
+    try:
+        metadata = json.loads(text)
+    except ValueError:
+        # Unversioned files are python dict literals. They're only ever parsed as literals, never eval'd.
+        metadata = ast.literal_eval(text)
+        logger.warning(f"{metadata_file} is in the old unversioned mshit format, and will be migrated. Re-save it to upgrade it.")
+    return migrate_metadata(metadata)
+
+
+def save_metadata(metadata_file, duration, segments, probe=None, binary=False, curve=None):
+    """Write a .mshit file.
+    Args:
+        metadata_file: Path to the metadata file.
+        duration: Duration of the video the segments are relative to.
+        segments: List of segment dicts.
+        probe: Optional cached probe results, see make_probe_entry.
+        binary: Write the compact binary variant instead of JSON.
+        curve: Optional interest curve, in its InterestCurve.to_metadata() form.
+    """
+    metadata = {"format": "mshit", "version": MSHIT_VERSION, "duration": duration, "probe": probe or {}}
+    if curve is not None:
+        metadata["curve"] = curve
+    if binary:
+        metadata["segment_count"] = len(segments)
+        header = json.dumps(metadata).encode()
+        with open(metadata_file, "wb") as f:
+            f.write(MSHIT_MAGIC)
+            f.write(HEADER_LEN_STRUCT.pack(len(header)))
+            f.write(header)
+            for seg in segments:
+                f.write(SEGMENT_STRUCT.pack(seg["start"], seg["end"], seg["interest"]))
+    else:
+        metadata["segments"] = segments
+        with open(metadata_file, "w") as f:
+            json.dump(metadata, f)
+
+
+def make_probe_entry(input_file, probe, keyframes=None):
+    """Build the probe results of a file for storing in an mshit file."""
+    entry = {
+        "name": os.path.basename(input_file),
+        "size": os.path.getsize(input_file),
+        "ffprobe": {"streams": probe["streams"], "format": probe["format"]},
+    }
+    if keyframes is not None:
+        entry["keyframes"] = list(keyframes)
+    return entry
+
+
+def find_probe_entry(metadata, input_file):
+    """Find the stored probe results that belong to input_file, matched by name and size."""
+    if not os.path.exists(input_file):
+        return None
+    size = os.path.getsize(input_file)
+    for entry in metadata.get("probe", {}).values():
+        if entry.get("name") == os.path.basename(input_file) and entry.get("size") == size:
+            return entry
+    return None
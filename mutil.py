@@ -1,5 +1,6 @@
 from avmeta import *
 from meta import *
+from mshit import load_metadata
 from sys import argv
 # Helper script for testing internal library functions
 
@@ -39,8 +40,7 @@ duration = get_video_duration(file)
  # print(file, "audio bitrate ", get_bit_rate(file, type="audio") / 1000, "kbps")
 
 if file == "testing_file.mkv" or file == "compressed_out_test.mkv":
-  with open("testing_file.mshit", "r") as f:
-    metadata = eval(f.read())
+  metadata = load_metadata("testing_file.mshit")
   scenes = metadata["segments"]
   passthru = add_pass_through_segments(scenes, duration)
   mutated = get_mutated_segments(duration, passthru)
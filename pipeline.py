@@ -0,0 +1,99 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fileops import write_file_list
+from logging_config import logger
+from tracing import in_current_context
+
+# Pipelined split -> process -> concat.
+# The segment muxer writes a -segment_list entry as it closes each segment, so segments can be processed while the
+# rest of the input is still being split. Processed segments are handed to a PrefixConcatenator, which stream copies
+# each contiguous prefix of finished segments into a chunk in the background, leaving only the chunks and the last
+# few segments for the final concat.
+
+POLL_INTERVAL = 0.2
+
+
+def watch_segment_list(list_file, split_thread, poll_interval=POLL_INTERVAL):
+    """Yield (index, path) for each segment in a segment muxer's CSV list, as it's written.
+    Stops once split_thread has finished and every entry has been read.
+    Relative entries are relative to the list's directory.
+    """
+    list_dir = os.path.dirname(list_file)
+    seen = 0
+    while True:
+        # The muxer is done once its thread is, so read the list one last time after that
+        finished = not split_thread.is_alive()
+        entries = []
+        if os.path.exists(list_file):
+            with open(list_file, "r") as f:
+                # Only complete lines, the muxer may be halfway through writing the last one
+                entries = [line.split(",", 1)[0] for line in f.read().split("\n")[:-1] if line]
+        for index in range(seen, len(entries)):
+            path = entries[index] if os.path.isabs(entries[index]) else os.path.join(list_dir, entries[index])
+            yield index, path
+        seen = max(seen, len(entries))
+        if finished:
+            return
+        time.sleep(poll_interval)
+
+
+class PrefixConcatenator:
+    """Concatenates segments in the background as contiguous prefixes of them finish.
+    Args:
+        concat: concat(file_list_path, output_file), e.g. concatenate_segments with its metadata bound.
+        temp_dir: Where chunks and their lists go.
+        name: Prefix for chunk file names.
+        chunk_size: Minimum number of new segments in the finished prefix before a chunk is written.
+    """
+
+    def __init__(self, concat, temp_dir, name, chunk_size=8):
+        self.concat = concat
+        self.temp_dir = temp_dir
+        self.name = name
+        self.chunk_size = chunk_size
+        self.entries = {}
+        self.chunks = []
+        self.chunk_start = 0
+        self.prefix_end = 0
+        self._lock = threading.Lock()
+        # One chunk at a time, they're stream copies and mostly I/O
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
+
+    def ready(self, index, entry):
+        """Mark segment index as finished, with entry being what the concat list should reference."""
+        with self._lock:
+            self.entries[index] = entry
+            while self.prefix_end in self.entries:
+                self.prefix_end += 1
+            if self.prefix_end - self.chunk_start < self.chunk_size:
+                return
+            chunk_entries = [self.entries[i] for i in range(self.chunk_start, self.prefix_end)]
+            chunk_file = os.path.join(self.temp_dir, f"{self.name}_chunk_{len(self.chunks)}.mkv")
+            logger.debug(f"Concatenating segments {self.chunk_start}-{self.prefix_end - 1} into {chunk_file}")
+            self.chunks.append(chunk_file)
+            self.chunk_start = self.prefix_end
+            self._futures.append(self._executor.submit(in_current_context(self._write_chunk), chunk_entries, chunk_file))
+
+    def _write_chunk(self, chunk_entries, chunk_file):
+        list_file = f"{os.path.splitext(chunk_file)[0]}.txt"
+        write_file_list(list_file, chunk_entries, self.temp_dir)
+        self.concat(list_file, chunk_file)
+
+    def finish(self, count, output_file):
+        """Concatenate the chunks and the remaining segments into output_file, once all count segments are ready."""
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._executor.shutdown(wait=True)
+        missing = [i for i in range(count) if i not in self.entries]
+        if missing:
+            raise RuntimeError(f"Segments {missing} never finished")
+        final_entries = self.chunks + [self.entries[i] for i in range(self.chunk_start, count)]
+        list_file = os.path.join(self.temp_dir, f"{self.name}_list.txt")
+        write_file_list(list_file, final_entries, self.temp_dir)
+        logger.info(f"Concatenating {len(self.chunks)} chunks and {count - self.chunk_start} segments into {output_file}")
+        self.concat(list_file, output_file)
@@ -0,0 +1,188 @@
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from fileops import file_identity
+from logging_config import logger
+from tracing import TracedPopen
+
+SIDECAR_MAGIC = b"SHITPKT1\n"
+
+_index_cache = {}
+_index_lock = threading.Lock()
+
+
+def nearest_keyframe(keyframes, t: float) -> float:
+    """Return the keyframe closest to t from a sorted sequence of keyframe times. Ties go to the earlier keyframe."""
+    i = bisect_left(keyframes, t)
+    if i == 0:
+        return keyframes[0]
+    if i == len(keyframes):
+        return keyframes[-1]
+    before, after = keyframes[i - 1], keyframes[i]
+    return before if t - before <= after - t else after
+
+
+class StreamPackets:
+    """Timestamps, sizes and keyframe flags of every packet in one stream, stored in flat arrays."""
+
+    def __init__(self, codec_type: str = ""):
+        self.codec_type = codec_type
+        self.pts = array('d')
+        self.size = array('q')
+        self.key = array('B')
+        self._keyframes = None
+        self._sorted_pts = None
+        self._size_prefix = None
+
+    def __len__(self):
+        return len(self.pts)
+
+    def append(self, pts: float, size: int, key: bool):
+        self.pts.append(pts)
+        self.size.append(size)
+        self.key.append(1 if key else 0)
+
+    @property
+    def keyframes(self) -> array:
+        """Sorted timestamps of the keyframes in this stream."""
+        if self._keyframes is None:
+            self._keyframes = array('d', sorted(p for p, k in zip(self.pts, self.key) if k and not math.isnan(p)))
+        return self._keyframes
+
+    def nearest_keyframe(self, t: float) -> float:
+        return nearest_keyframe(self.keyframes, t)
+
+    def total_bytes(self) -> int:
+        return sum(self.size)
+
+    def bytes_between(self, start: float, end: float) -> int:
+        """Total size of the packets with start <= pts < end."""
+        if self._sorted_pts is None:
+            order = sorted((i for i in range(len(self.pts)) if not math.isnan(self.pts[i])), key=self.pts.__getitem__)
+            self._sorted_pts = array('d', (self.pts[i] for i in order))
+            self._size_prefix = array('q', accumulate((self.size[i] for i in order), initial=0))
+        lo = bisect_left(self._sorted_pts, start)
+        hi = bisect_left(self._sorted_pts, end)
+        return self._size_prefix[hi] - self._size_prefix[lo]
+
+    def average_bit_rate(self, duration: float) -> float:
+        return self.total_bytes() * 8 / duration
+
+    def bit_rate_between(self, start: float, end: float) -> float:
+        return self.bytes_between(start, end) * 8 / (end - start)
+
+
+class PacketIndex:
+    """Packet index of a media file, built from a single streaming ffprobe pass over all of its packets."""
+
+    def __init__(self, key: str = "", streams=None):
+        self.key = key
+        self.streams = streams if streams is not None else {}
+
+    def stream(self, index: int) -> StreamPackets:
+        return self.streams.get(index, StreamPackets())
+
+    @classmethod
+    def build(cls, input_file: str) -> "PacketIndex":
+        """Index every packet of a file. ffprobe's output is parsed as it streams, and never held in memory."""
+        index = cls(file_identity(input_file))
+        ffprobe_cmd = [
+            "ffprobe", "-v", "error", "-show_entries", "packet=codec_type,stream_index,pts_time,size,flags",
+            "-of", "csv=p=0", input_file
+        ]
+        logger.debug(f"Indexing packets of {input_file}")
+        with TracedPopen(ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1 << 16) as proc:
+            for line in proc.stdout:
+                # Some packets (opus, for example) have side data appended to the line
+                parts = line.rstrip("\n").split(",")
+                if len(parts) < 5 or not parts[3].isdigit():
+                    continue
+                codec_type, stream_index, pts_time, size, flags = parts[:5]
+                stream = index.streams.get(int(stream_index))
+                if stream is None:
+                    stream = index.streams[int(stream_index)] = StreamPackets(codec_type)
+                try:
+                    pts = float(pts_time)
+                except ValueError:
+                    pts = math.nan
+                stream.append(pts, int(size), flags.startswith("K"))
+            stderr = proc.stderr.read()
+        if proc.returncode != 0:
+            logger.debug(f"ffprobe stderr: {stderr}")
+            raise RuntimeError(f"ffprobe command failed with return code {proc.returncode}")
+        logger.info(f"Indexed {sum(len(s) for s in index.streams.values())} packets in {len(index.streams)} streams of {input_file}")
+        return index
+
+    def save(self, path: str):
+        """Persist the index as a sidecar file."""
+        header = {
+            "key": self.key,
+            "byteorder": sys.byteorder,
+            "streams": [{"index": i, "codec_type": s.codec_type, "count": len(s)} for i, s in self.streams.items()],
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SIDECAR_MAGIC)
+            f.write(json.dumps(header).encode() + b"\n")
+            for s in self.streams.values():
+                s.pts.tofile(f)
+                s.size.tofile(f)
+                s.key.tofile(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, key: str):
+        """Load a sidecar written by save(). Returns None if it is missing, unreadable or for a different file."""
+        try:
+            with open(path, "rb") as f:
+                if f.readline() != SIDECAR_MAGIC:
+                    return None
+                header = json.loads(f.readline())
+                if header["key"] != key:
+                    return None
+                index = cls(key)
+                for entry in header["streams"]:
+                    s = StreamPackets(entry["codec_type"])
+                    for arr in (s.pts, s.size, s.key):
+                        arr.fromfile(f, entry["count"])
+                        if header["byteorder"] != sys.byteorder:
+                            arr.byteswap()
+                    index.streams[entry["index"]] = s
+                return index
+        except (OSError, EOFError, ValueError, KeyError):
+            return None
+
+
+def get_packet_index(input_file: str, sidecar_dir: str = None) -> PacketIndex:
+    """Return the packet index of a file, building it at most once per file version.
+    Args:
+        input_file: Path to the input file.
+        sidecar_dir: If set, the index is also loaded from/saved to a sidecar file in this directory.
+    """
+    key = file_identity(input_file)
+    with _index_lock:
+        if key in _index_cache:
+            return _index_cache[key]
+
+    sidecar = None
+    index = None
+    if sidecar_dir:
+        sidecar = os.path.join(sidecar_dir, f"{os.path.basename(os.path.splitext(input_file)[0])}.pktidx")
+        index = PacketIndex.load(sidecar, key)
+        if index is not None:
+            logger.debug(f"Loaded packet index for {input_file} from {sidecar}")
+    if index is None:
+        index = PacketIndex.build(input_file)
+        if sidecar:
+            os.makedirs(sidecar_dir, exist_ok=True)
+            index.save(sidecar)
+
+    with _index_lock:
+        _index_cache[key] = index
+    return index
@@ -0,0 +1,79 @@
+import os
+import hashlib
+from fileops import file_identity
+from avmeta import get_keyframes, has_video, is_intra_only
+from progress import run_ffmpeg
+from logging_config import logger
+
+# Low-resolution proxies for previews.
+# A proxy is the source downscaled, at a reduced frame rate and encoded with the fastest x264 preset, with its
+# keyframes forced onto the source's keyframe times (and no others), so the same segment plan snaps to the same
+# boundaries on it, give or take a proxy frame. Intra-only sources get an intra-only proxy. Sources with too many
+# keyframes to list on the command line use ffmpeg's -force_key_frames source, which misses the keyframes the frame
+# rate reduction drops. Timestamps are kept as they are, so a .mshit tuned on the proxy
+# carries over to the source unchanged. Proxies are cached per source and settings, and made once.
+
+DEFAULT_PROXY_DIR = os.environ.get("SHIT_PROXY_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "shit", "proxies"))
+PROXY_HEIGHT = 360
+PROXY_FPS = 15
+# Longest -force_key_frames list to pass, well under Linux's 128 KiB limit on a single argument
+MAX_KEYFRAME_LIST_LENGTH = 64 * 1024
+
+
+def proxy_path(input_file, height=PROXY_HEIGHT, fps=PROXY_FPS, cache_dir=DEFAULT_PROXY_DIR):
+    """Where the proxy of input_file's current contents with these settings is cached."""
+    key = hashlib.sha256(f"{file_identity(input_file)}|{height}|{fps}".encode()).hexdigest()
+    return os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(input_file))[0]}_{height}p{fps:g}_{key[:16]}.mkv")
+
+
+def get_proxy(input_file, height=PROXY_HEIGHT, fps=PROXY_FPS, cache_dir=DEFAULT_PROXY_DIR, run=run_ffmpeg):
+    """Get the proxy of input_file, making it if it isn't cached yet.
+    Files without video are their own proxy.
+    Args:
+        height: Height of the proxy in pixels. The width keeps the aspect ratio.
+        fps: Frame rate of the proxy.
+        run: Function to run ffmpeg with.
+    Returns:
+        The path of the proxy.
+    """
+    if not has_video(input_file):
+        logger.info(f"{input_file} has no video, previewing it as it is")
+        return input_file
+    output_file = proxy_path(input_file, height, fps, cache_dir)
+    if os.path.exists(output_file):
+        logger.info(f"Using cached proxy {output_file}")
+        return output_file
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Keyframes go where the source has them, and only there
+    if is_intra_only(input_file):
+        keyframe_args = ["-g", "1"]
+    else:
+        keyframes = ",".join(str(t) for t in get_keyframes(input_file))
+        if len(keyframes) > MAX_KEYFRAME_LIST_LENGTH:
+            logger.warning(f"{input_file} has too many keyframes to list, the proxy only keeps the ones that survive its frame rate")
+            keyframes = "source"
+        keyframe_args = ["-force_key_frames", keyframes, "-g", "100000", "-sc_threshold", "0"]
+    tmp_file = f"{output_file}.{os.getpid()}.tmp.mkv"
+    ffmpeg_cmd = [
+        "ffmpeg", "-y",
+        "-i", input_file,
+        "-map", "0:v:0", "-map", "0:a:0?",
+        "-vf", f"scale=-2:{height},fps={fps}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "28", "-pix_fmt", "yuv420p",
+        *keyframe_args,
+        "-c:a", "aac", "-b:a", "96k",
+        "-f", "matroska",
+        tmp_file
+    ]
+    logger.info(f"Making a {height}p {fps:g} fps proxy of {input_file}")
+    result = run(ffmpeg_cmd)
+
+    if result.returncode != 0:
+        logger.debug(f"FFmpeg stderr: {result.stderr}")
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
+    os.replace(tmp_file, output_file)
+    logger.info(f"Proxy saved as {output_file}")
+    return output_file
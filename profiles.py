@@ -0,0 +1,93 @@
+from platform import system
+from avmeta import estimate_crf
+from scheduler import thread_args
+
+# Encoder profiles pick the encoder implementation, its speed preset and its rate control.
+# The codec family always follows the source, since processed segments get concatenated with stream-copied ones.
+#   hardware: use VideoToolbox on macOS where there is one
+#   x26x_preset: -preset for libx264/libx265
+#   vpx_deadline/vpx_cpu_used: -deadline/-cpu-used for libvpx
+#   rate_control: "bitrate" (match the source's bits per frame), "constrained" (CRF capped at that bitrate) or "crf"
+PROFILES = {
+    "fast": {"hardware": True, "x26x_preset": "veryfast", "vpx_deadline": "realtime", "vpx_cpu_used": 8, "rate_control": "bitrate"},
+    "balanced": {"hardware": True, "x26x_preset": "medium", "vpx_deadline": "good", "vpx_cpu_used": 4, "rate_control": "constrained"},
+    "archival": {"hardware": False, "x26x_preset": "slow", "vpx_deadline": "good", "vpx_cpu_used": 1, "rate_control": "crf"},
+}
+DEFAULT_PROFILE = "balanced"
+
+# Codec family (as named by get_video_metadata) -> (hardware encoder, software encoder)
+VIDEO_ENCODERS = {
+    "h264": ("h264_videotoolbox", "libx264"),
+    "h264_videotoolbox": ("h264_videotoolbox", "libx264"),
+    "hevc": ("hevc_videotoolbox", "libx265"),
+    "hevc_videotoolbox": ("hevc_videotoolbox", "libx265"),
+    "libvpx-vp9": (None, "libvpx-vp9"),
+}
+
+# Software encoder -> codec name estimate_crf knows the CRF range of
+CRF_CODECS = {"libx264": "h264", "libx265": "hevc", "libvpx-vp9": "libvpx-vp9"}
+
+
+def get_video_encoder(profile_name, vcodec):
+    """Pick the encoder for a codec family under a profile."""
+    hardware, software = VIDEO_ENCODERS.get(vcodec, (None, vcodec))
+    if PROFILES[profile_name]["hardware"] and hardware and system() == "Darwin":
+        return hardware
+    return software
+
+
+def encoder_args(profile_name, metadata, bitrate, threads=None):
+    """Build the video encoder arguments for a profile.
+    Args:
+        profile_name: One of PROFILES.
+        metadata: get_video_metadata() of the source.
+        bitrate: Target video bitrate in bits per second.
+        threads: Optional thread budget for the encoder.
+    Returns:
+        A list of ffmpeg arguments, starting with -c:v.
+    """
+    profile = PROFILES[profile_name]
+    encoder = get_video_encoder(profile_name, metadata["vcodec"])
+    rate_control = profile["rate_control"]
+    bitrate = str(int(bitrate))
+    args = ["-c:v", encoder]
+
+    if encoder in CRF_CODECS:
+        crf = str(estimate_crf(CRF_CODECS[encoder], metadata["vbitrate"], metadata["resolution"], metadata["fps"]))
+
+    if encoder in ("libx264", "libx265"):
+        args += ["-preset", profile["x26x_preset"]]
+        if rate_control == "bitrate":
+            args += ["-b:v", bitrate]
+        elif rate_control == "constrained":
+            args += ["-crf", crf, "-maxrate", bitrate, "-bufsize", str(2 * int(bitrate))]
+        else:
+            args += ["-crf", crf]
+    elif encoder == "libvpx-vp9":
+        # -row-mt is libvpx only
+        args += ["-deadline", profile["vpx_deadline"], "-cpu-used", str(profile["vpx_cpu_used"]), "-row-mt", "1"]
+        if rate_control == "bitrate":
+            args += ["-b:v", bitrate]
+        elif rate_control == "constrained":
+            args += ["-crf", crf, "-b:v", bitrate]
+        else:
+            args += ["-crf", crf, "-b:v", "0"]
+    else:
+        # VideoToolbox (and anything unknown) only gets a bitrate, CRF-like quality isn't supported everywhere
+        args += ["-b:v", bitrate]
+
+    return args + thread_args(encoder, threads)
+
+
+def describe_profile(profile_name, metadata):
+    """A one line description of what a profile does with a source, for reporting."""
+    profile = PROFILES[profile_name]
+    encoder = get_video_encoder(profile_name, metadata["vcodec"])
+    if encoder in ("libx264", "libx265"):
+        speed = f"preset {profile['x26x_preset']}"
+    elif encoder == "libvpx-vp9":
+        speed = f"deadline {profile['vpx_deadline']}, cpu-used {profile['vpx_cpu_used']}"
+    else:
+        speed = "hardware"
+    rate_control = profile["rate_control"] if encoder in CRF_CODECS else "bitrate"
+    return f"{profile_name}: {encoder} ({speed}, {rate_control} rate control)"
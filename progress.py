@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import subprocess
+from tracing import TracedPopen, current_segment
+from logging_config import logger
+
+# Live progress and a stall watchdog for ffmpeg runs.
+# run_ffmpeg starts ffmpeg with -progress on its stdout, and reads that (and stderr) on background threads, so the
+# main loop never blocks on a pipe. Each progress block updates the run's out_time, fps and speed on a ProgressBoard
+# (PROGRESS, unless the run is given its own), which reports per-run and per-stage fps, speed and ETA every
+# REPORT_INTERVAL seconds, optionally to a JSON file as well.
+# Runs whose output stops advancing for stall_timeout seconds, or that take longer than time_budget, are killed.
+# The limits and the board are per call, so several codecs in one process can each have their own.
+
+REPORT_INTERVAL = 5.0
+POLL_INTERVAL = 0.5
+_EOF = object()
+
+
+class FFmpegWatchdogError(RuntimeError):
+    """An ffmpeg run was killed by the watchdog."""
+
+
+def _parse_out_time(block):
+    """Output position in seconds of a -progress block, if it has one."""
+    for key in ("out_time_us", "out_time_ms"):  # out_time_ms is in microseconds too
+        value = block.get(key, "N/A")
+        if value.lstrip("-").isdigit():
+            return max(0.0, int(value) / 1e6)
+    return None
+
+
+def _parse_float(value):
+    try:
+        return float(value.rstrip("x"))
+    except (AttributeError, ValueError):
+        return None
+
+
+class ProgressBoard:
+    """Progress of the ffmpeg runs in flight, and of the stage they're part of.
+    All durations are in output seconds, which is what ffmpeg reports progress in.
+    """
+
+    def __init__(self, report_interval=REPORT_INTERVAL, progress_file=None):
+        self.report_interval = report_interval
+        self.progress_file = progress_file
+        self._lock = threading.Lock()
+        self._runs = {}
+        self._next_id = 0
+        self._last_report = 0.0
+        self._stage = None
+
+    def start_stage(self, name, total_duration):
+        """Start a stage of several runs, with total_duration seconds of output between them."""
+        with self._lock:
+            self._stage = {"name": name, "total": total_duration, "done": 0.0, "started": time.monotonic()}
+
+    def end_stage(self):
+        with self._lock:
+            self._stage = None
+
+    def start_run(self, label, expected_duration=None):
+        with self._lock:
+            run_id = self._next_id
+            self._next_id += 1
+            self._runs[run_id] = {"label": label, "expected": expected_duration, "out_time": 0.0,
+                                  "fps": None, "speed": None, "frame": None, "started": time.monotonic()}
+            return run_id
+
+    def update_run(self, run_id, block):
+        """Apply a -progress block to a run. Returns True if its output advanced."""
+        with self._lock:
+            run = self._runs[run_id]
+            out_time = _parse_out_time(block)
+            frame = block.get("frame")
+            advanced = (out_time is not None and out_time > run["out_time"]) or (frame is not None and frame != run["frame"])
+            if out_time is not None:
+                run["out_time"] = max(run["out_time"], out_time)
+            run["frame"] = frame
+            run["fps"] = _parse_float(block.get("fps"))
+            run["speed"] = _parse_float(block.get("speed"))
+            return advanced
+
+    def finish_run(self, run_id):
+        with self._lock:
+            run = self._runs.pop(run_id)
+            if self._stage is not None:
+                self._stage["done"] += run["expected"] if run["expected"] is not None else run["out_time"]
+
+    def snapshot(self):
+        """Current progress of every run and the stage, for reporting or for a scheduler to act on."""
+        now = time.monotonic()
+        with self._lock:
+            runs = []
+            for run in self._runs.values():
+                eta = None
+                if run["expected"] is not None and run["speed"]:
+                    eta = max(0.0, run["expected"] - run["out_time"]) / run["speed"]
+                runs.append({"label": run["label"], "out_time": run["out_time"], "expected": run["expected"],
+                             "fps": run["fps"], "speed": run["speed"], "eta": eta, "elapsed": now - run["started"]})
+            stage = None
+            if self._stage is not None:
+                done = self._stage["done"] + sum(run["out_time"] for run in self._runs.values())
+                elapsed = now - self._stage["started"]
+                # Output seconds per wall second, over the whole stage so far
+                speed = done / elapsed if elapsed > 0 else None
+                eta = max(0.0, self._stage["total"] - done) / speed if speed else None
+                stage = {"name": self._stage["name"], "done": done, "total": self._stage["total"],
+                         "fps": sum(run["fps"] or 0 for run in runs), "speed": speed, "eta": eta, "elapsed": elapsed}
+        return {"time": time.time(), "runs": runs, "stage": stage}
+
+    def report_progress(self, force=False):
+        """Log the current progress, at most every report_interval seconds unless forced."""
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_report < self.report_interval:
+                return
+            self._last_report = now
+        snapshot = self.snapshot()
+
+        def fmt(value, unit=""):
+            return "?" if value is None else f"{value:.1f}{unit}"
+        for run in snapshot["runs"]:
+            logger.info(f"{run['label']}: {fmt(run['out_time'], 's')}/{fmt(run['expected'], 's')}, "
+                        f"{fmt(run['fps'])} fps, {fmt(run['speed'], 'x')}, ETA {fmt(run['eta'], 's')}")
+        stage = snapshot["stage"]
+        if stage:
+            logger.info(f"{stage['name']}: {fmt(stage['done'], 's')}/{fmt(stage['total'], 's')}, "
+                        f"{fmt(stage['fps'])} fps, {fmt(stage['speed'], 'x')}, ETA {fmt(stage['eta'], 's')}")
+        if self.progress_file:
+            tmp_file = f"{self.progress_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_file, self.progress_file)
+
+
+PROGRESS = ProgressBoard()
+
+# Watchdog defaults, for runs that don't set their own limits
+WATCHDOG = {"stall_timeout": 300.0, "time_budget": None}
+
+
+def _pump(pipe, put):
+    for line in pipe:
+        put(line)
+    put(_EOF)
+
+
+def run_ffmpeg(cmd, expected_duration=None, label=None, stage=None, check=False, stall_timeout=None, time_budget=None, board=None,
+               cancel=None):
+    """Run ffmpeg with live progress reporting and the watchdog. Returns a CompletedProcess, like subprocess.run.
+    Args:
+        cmd: ffmpeg command line, without -progress.
+        expected_duration: Duration of the output in seconds, for the ETA.
+        label: Name of the run in progress reports. Default: the segment index and output file.
+        stage: Tracing stage. Default: the calling function's name.
+        stall_timeout, time_budget: Override WATCHDOG for this run. 0 turns a limit off.
+        board: ProgressBoard to report on. Default: PROGRESS.
+        cancel: A threading.Event that kills the run when it's set, e.g. from another thread that gave up on it.
+    Raises:
+        FFmpegWatchdogError: The run stalled, went over its time budget or was cancelled, and was killed.
+    """
+    stage = stage if stage is not None else sys._getframe(1).f_code.co_name
+    stall_timeout = WATCHDOG["stall_timeout"] if stall_timeout is None else stall_timeout
+    time_budget = WATCHDOG["time_budget"] if time_budget is None else time_budget
+    board = PROGRESS if board is None else board
+    if label is None:
+        segment = current_segment()
+        label = os.path.basename(cmd[-1]) if segment is None else f"segment {segment} ({os.path.basename(cmd[-1])})"
+
+    progress_cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+    run_id = board.start_run(label, expected_duration)
+    progress_lines = queue.Queue()
+    stderr_lines = []
+    killed = None
+    try:
+        with TracedPopen(progress_cmd, stage=stage, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True) as proc:
+            readers = [threading.Thread(target=_pump, args=(proc.stdout, progress_lines.put), daemon=True),
+                       threading.Thread(target=_pump, args=(proc.stderr, stderr_lines.append), daemon=True)]
+            for reader in readers:
+                reader.start()
+
+            started = last_advance = time.monotonic()
+            block = {}
+            while True:
+                try:
+                    line = progress_lines.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    line = None
+                if line is _EOF:
+                    break
+                if line is not None and "=" in line:
+                    key, value = line.strip().split("=", 1)
+                    block[key] = value
+                    if key == "progress":
+                        if board.update_run(run_id, block):
+                            last_advance = time.monotonic()
+                        block = {}
+
+                now = time.monotonic()
+                if stall_timeout and now - last_advance > stall_timeout:
+                    killed = f"no progress for {stall_timeout}s"
+                elif time_budget and now - started > time_budget:
+                    killed = f"over its time budget of {time_budget}s"
+                elif cancel is not None and cancel.is_set():
+                    killed = "cancelled"
+                if killed:
+                    proc.kill()
+                    break
+                board.report_progress()
+
+            proc.wait()
+            for reader in readers:
+                reader.join()
+    finally:
+        board.finish_run(run_id)
+
+    stderr = "".join(line for line in stderr_lines if line is not _EOF)
+    if killed:
+        logger.error(f"Killed {label}: {killed}")
+        logger.debug(f"FFmpeg stderr: {stderr}")
+        raise FFmpegWatchdogError(f"FFmpeg run {label} killed: {killed}")
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output="", stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, "", stderr)
@@ -0,0 +1,98 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from logging_config import logger
+from tracing import set_segment, in_current_context
+
+# Total number of threads this process may use. Set by batch runs, which share the machine between several processes.
+THREAD_LIMIT = int(os.environ.get("SHIT_THREADS", "0"))
+
+def thread_budget(jobs: int, limit: int = None) -> int:
+    """Number of threads each of `jobs` concurrent ffmpeg runs can use without oversubscribing the machine, or `limit` threads."""
+    return max(1, (limit or THREAD_LIMIT or os.cpu_count() or 1) // max(1, jobs))
+
+def thread_args(codec: str, threads: int) -> list:
+    """Build the ffmpeg arguments that limit an encode (and its filter graph) to `threads` threads."""
+    if not threads:
+        return []
+    args = ["-filter_complex_threads", str(threads)]
+    if codec.endswith("_videotoolbox"):
+        # Hardware encoders don't take a thread count, only the filters run on the CPU
+        return args
+    args += ["-threads", str(threads)]
+    if codec == "libx265":
+        args += ["-x265-params", f"pools={threads}"]
+    return args
+
+def _run_task(index, task):
+    # Attribute the subprocesses the task runs to its segment
+    set_segment(index)
+    try:
+        return task()
+    finally:
+        set_segment(None)
+
+def run_segment_jobs(tasks, jobs=1):
+    """Run independent segment tasks on a worker pool, longest segments first.
+    Args:
+        tasks: List of (duration, callable) tuples, one per segment.
+        jobs: Number of tasks to run concurrently.
+    Returns:
+        The return value of each callable, in the original task order.
+    Raises:
+        The first exception raised by a task. Tasks that haven't started yet are cancelled,
+        and tasks that are already running are allowed to finish before it is raised.
+    """
+    results = [None] * len(tasks)
+    if jobs <= 1:
+        for i, (_, task) in enumerate(tasks):
+            results[i] = _run_task(i, task)
+        return results
+
+    # Longest first, so a long segment doesn't end up running alone at the end
+    order = sorted(range(len(tasks)), key=lambda i: tasks[i][0], reverse=True)
+    logger.debug(f"Running {len(tasks)} segment tasks on {jobs} workers in order {order}")
+
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    futures = {executor.submit(in_current_context(_run_task), i, tasks[i][1]): i for i in order}
+    try:
+        done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+        failed = [f for f in done if f.exception() is not None]
+        if failed:
+            first = min(failed, key=lambda f: futures[f])
+            logger.error(f"Segment {futures[first]} failed, cancelling remaining segments")
+            raise first.exception()
+        for future, i in futures.items():
+            results[i] = future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return results
+
+class TaskPool:
+    """A worker pool for segment tasks that become available one at a time, e.g. as a split produces segments.
+    Unlike run_segment_jobs, tasks start as soon as they're submitted, in the order they're submitted.
+    """
+
+    def __init__(self, jobs=1):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self.futures = {}
+
+    def submit(self, index, task, on_done=None):
+        """Queue task as segment `index`. on_done(index, result) is called from the worker once it succeeds."""
+        def run():
+            result = _run_task(index, task)
+            if on_done is not None:
+                on_done(index, result)
+            return result
+        self.futures[self.executor.submit(in_current_context(run))] = index
+
+    def join(self):
+        """Wait for every task. Raises the exception of the lowest failed segment, after cancelling the rest."""
+        try:
+            done, _ = wait(self.futures, return_when=FIRST_EXCEPTION)
+            failed = [f for f in done if f.exception() is not None]
+            if failed:
+                first = min(failed, key=lambda f: self.futures[f])
+                logger.error(f"Segment {self.futures[first]} failed, cancelling remaining segments")
+                raise first.exception()
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+from fileops import link_or_copy
+from logging_config import logger
+
+DEFAULT_CACHE_DIR = os.environ.get("SHIT_SEGMENT_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "shit", "segments"))
+
+
+class SegmentCache:
+    """Content-addressed store of processed segment files, with size-based LRU eviction.
+
+    Entries are keyed by a hash of everything that determines a segment's output: the source
+    identity, the segment boundaries, the interest, the mode and the encoder parameters.
+    Files are hardlinked in and out of the cache where possible, so hits cost no copying.
+    Anything that writes over a file fetched from the cache must remove it first, or it will
+    write through the hardlink into the cache entry.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=50 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, source_id, seg, mode, params, position=True):
+        """Hash the inputs that determine a processed segment's output.
+        If the source id already identifies the segment (e.g. it's the cache key of the encoded segment being decoded),
+        set position to False to leave its start and end out, which move whenever an earlier segment changes.
+        """
+        key_data = {
+            "source": source_id,
+            "interest": seg["interest"],
+            "mode": mode,
+            "params": params,
+        }
+        if position:
+            key_data["start"], key_data["end"] = seg["start"], seg["end"]
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.mkv")
+
+    def fetch(self, key, output_file):
+        """Place the cached segment for key at output_file. Returns False on a miss."""
+        entry = self._entry_path(key)
+        if not os.path.exists(entry):
+            self.misses += 1
+            return False
+        link_or_copy(entry, output_file)
+        # Bump the mtime, which is what eviction goes by
+        os.utime(entry)
+        self.hits += 1
+        self.bytes_saved += os.path.getsize(entry)
+        logger.debug(f"Segment cache hit {key} -> {output_file}")
+        return True
+
+    def store(self, key, output_file):
+        """Add a processed segment to the cache."""
+        entry = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_entry = f"{entry}.{os.getpid()}.tmp"
+        link_or_copy(output_file, tmp_entry)
+        os.replace(tmp_entry, entry)
+        logger.debug(f"Segment cache store {output_file} -> {key}")
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            logger.debug(f"Evicted {path} from segment cache")
+
+    def report(self):
+        """Return the hit/miss statistics of this run."""
+        return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved}
@@ -1,36 +1,59 @@
 import os
-import subprocess
-import shutil
 import argparse
-from fileops import *
-from meta import *
-from sys import argv
-from avmeta import get_video_duration, get_video_metadata, get_audio_sample_rate, get_bit_frame_rate
+from functools import partial
+from contextlib import nullcontext
+from meta import compose_segment_maps, get_mutated_segments, write_metadata_file, calculate_compressed_duration
+from avmeta import get_video_duration, seed_probe_cache
+from mshit import load_metadata, find_probe_entry
+from codec import ShitCodec
+from curve import InterestCurve
+from farm import Farm, LEASE_SECONDS
+from preview import get_proxy, PROXY_HEIGHT, PROXY_FPS
+from evaluate import evaluate, format_report, SAMPLES_PER_SEGMENT, WINDOW_SECONDS
+from scheduler import THREAD_LIMIT
+from profiles import PROFILES, DEFAULT_PROFILE
+from segcache import SegmentCache, DEFAULT_CACHE_DIR
 from logging_config import logger
+from tracing import record_spans, write_chrome_trace, format_summary
+from progress import run_ffmpeg, ProgressBoard
+
+# Command line interface. All of the work is done by ShitCodec (codec.py), which can also be used as a library.
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Scene Human Interest Temporal Compression")
+    parser.add_argument("input_video", help="Input video file")
+    parser.add_argument("target_name", help="Target name for output files")
+    parser.add_argument("-t", "--metadata", help="Metadata file containing duration and scenes. Given several (e.g. the files from chained --save_for_next_pass runs), their passes are composed and run as a single encode and decode.", nargs='+')
+    parser.add_argument('-d', '--decode', help="Only run the decoder", action="store_true")
+    parser.add_argument('-s', '--save_for_next_pass', help="Saves the mutated metadata with the interest times relative to the new compressed file, for doing multiple passes.")
+    parser.add_argument('-e', '--encode', help="Only run encode pass.", action="store_true")
+    parser.add_argument('-m','--minterp', type=str, help="Turn on motion interpolation during decoding VERY SLOW!) Valid parameters are: 'dup', 'blend', 'mci'. Default: blend", nargs='?', const='blend', choices=['blend','dup','mci'])
+    parser.add_argument('-g', '--single_graph', help="Encode with one ffmpeg filter graph over the whole file instead of splitting, encoding and concatenating segments.", action="store_true")
+    parser.add_argument('--smart_cut', help="Cut encode segments at their exact times instead of the nearest keyframes. Only the partial GOPs at segment edges are re-encoded, whole GOPs of pass-through segments are stream copied.", action="store_true")
+    parser.add_argument('--split_segments', help="Split inputs into segment files with the segment muxer, instead of reading segments from their range of the input. Slower, but works for inputs that can't be seeked accurately (e.g. MPEG-TS).", action="store_true")
+    parser.add_argument('--pipeline', help="Encode segments as soon as the segment muxer has split them off, and concatenate finished runs of segments while later ones are still encoding, instead of splitting, encoding and concatenating one after another. Implies --split_segments.", action="store_true")
+    parser.add_argument('--final_reencode', help="Re-encode the whole restored file after concatenating the restored segments, as a fallback for players that have trouble with the stream-copied result. Slower, and adds a generation of loss.", action="store_true")
+    parser.add_argument('--atempo', help="For audio-only inputs, change the speed with atempo, which keeps the pitch, instead of asetrate.", action="store_true")
+    parser.add_argument('-p', '--profile', help=f"Encoder profile, which picks the encoder, its speed preset and rate control. Default: {DEFAULT_PROFILE}", choices=list(PROFILES), default=DEFAULT_PROFILE)
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of segments to encode/decode concurrently. Each ffmpeg gets an equal share of the CPU threads. Default: 1")
+    parser.add_argument('--preview', help="Run the same segment plan on a low resolution, low frame rate proxy of the input, with the fast profile, for quickly tuning interest values. The proxy is made once and cached per input. Outputs are named compressed_preview_<target_name> and restored_preview_<target_name>.", action="store_true")
+    parser.add_argument('--preview_height', type=int, default=PROXY_HEIGHT, help=f"Height of the preview proxy. Default: {PROXY_HEIGHT}")
+    parser.add_argument('--preview_fps', type=float, default=PROXY_FPS, help=f"Frame rate of the preview proxy. Default: {PROXY_FPS}")
+    parser.add_argument('--evaluate', help="After restoring, estimate PSNR, SSIM and VMAF (if ffmpeg has libvmaf) of the restored file against the source, per segment, from a few short windows sampled from each segment. Needs a full run, the source isn't known to -d or -e.", action="store_true")
+    parser.add_argument('--eval_samples', type=int, default=SAMPLES_PER_SEGMENT, help=f"Windows sampled per segment by --evaluate. Default: {SAMPLES_PER_SEGMENT}")
+    parser.add_argument('--eval_window', type=float, default=WINDOW_SECONDS, help=f"Length in seconds of each window sampled by --evaluate. Default: {WINDOW_SECONDS:g}")
+    parser.add_argument('--farm', help="Process the encode and decode segments on a render farm: publish them as work items in this shared directory, for workers (python farm.py <dir>) on any node to claim. This process works on them too. The input must be on shared storage.")
+    parser.add_argument('--farm_lease', type=float, default=LEASE_SECONDS, help=f"Seconds without a heartbeat after which a farm worker's segments are taken over by another. Default: {LEASE_SECONDS:g}")
+    parser.add_argument('--stall_timeout', type=float, default=300, help="Kill ffmpeg runs whose output hasn't advanced for this many seconds. 0 turns it off. Default: 300")
+    parser.add_argument('--time_budget', type=float, help="Kill ffmpeg runs that take longer than this many seconds.")
+    parser.add_argument('--progress_file', help="Write the progress (fps, speed and ETA per ffmpeg run and for the current stage) to this JSON file as it's reported.")
+    parser.add_argument('--trace', help="Write a Chrome trace (chrome://tracing, Perfetto) of every ffmpeg/ffprobe run to this file, and log a per-stage summary of where the time went.")
+    parser.add_argument('--binary_mshit', help="Write .mshit metadata files in the compact binary format instead of JSON.", action="store_true")
+    parser.add_argument('-c', '--cache', help=f"Reuse processed segments from earlier runs, stored in a segment cache directory. Default: {DEFAULT_CACHE_DIR}", nargs='?', const=DEFAULT_CACHE_DIR)
+    parser.add_argument('--cache_size', type=float, default=50, help="Maximum size of the segment cache in GiB. Least recently used segments are evicted past this. Default: 50")
+    return parser
 
-# Argument parsing
-parser = argparse.ArgumentParser(description="Scene Human Interest Temporal Compression")
-parser.add_argument("input_video", help="Input video file")
-parser.add_argument("target_name", help="Target name for output files")
-parser.add_argument("-t", "--metadata", help="Metadata file containing duration and scenes")
-parser.add_argument('-d', '--decode', help="Only run the decoder", action="store_true")
-parser.add_argument('-s', '--save_for_next_pass', help="Saves the mutated metadata with the interest times relative to the new compressed file, for doing multiple passes.")
-parser.add_argument('-e', '--encode', help="Only run encode pass.", action="store_true")
-parser.add_argument('-m','--minterp', type=str, help="Turn on motion interpolation during decoding VERY SLOW!) Valid parameters are: 'dup', 'blend', 'mci'. Default: blend", nargs='?', const='blend', choices=['blend','dup','mci'])
-args = parser.parse_args()
-# https://stackoverflow.com/questions/15301147/python-argparse-default-value-or-specified-value
-# Define input/output filenames
-INPUT_VIDEO = args.input_video
-COMPRESSED_VIDEO = "compressed_" + args.target_name
-RESTORED_VIDEO = "restored_" + args.target_name
-
-VIDEO_CODEC = "h264_videotoolbox"
-AUDIO_CODEC = "aac_at"
-
-MINTERP = args.minterp
-
-# Split the extension from the filename
-TEMP_DIR = "temp_" + os.path.splitext(args.target_name)[0]
 
 # Define segment times (adjust as needed)
 # SEGMENTS = t/
@@ -53,404 +76,138 @@ TEMP_DIR = "temp_" + os.path.splitext(args.target_name)[0]
 #
 #]
 
-# Ensure temp directory exists
-os.makedirs(TEMP_DIR, exist_ok=True)
-
-
-def process_segment(input_file, output_file, interest, mode="encode", segments=[]):
-    """Process a video segment by encoding (speed-up) or decoding (slow-down)."""
-    logger.debug(f"Processing segment {input_file} with interest {interest} in mode {mode}")
-    # Interest is how interersted we are in a segment.
-    # The lower the interest, the more we want to speed up the segment during the encode pass.
-    # The higher the interest, the more we want to slow down the segment during the decode pass.
-
-    # The speed factor is the inverse of the interest value.
-    # Some filters will take the speed factor as an argument, while others will take the interest value.
-    # The filters will be inverse for the encode and decode passes.
-    audio = True 
-    speed_factor = 1
-    speed_filter = ""
-    target_framerate = 30
-    base_audio_sample_rate = get_audio_sample_rate(input_file)
-    if base_audio_sample_rate == 0:
-        logger.info("No audio detected in input file, disabling audio")
-        audio = False
-    source_audio_sr = get_audio_sample_rate(INPUT_VIDEO)
-    fr_cmd = []
-    vf_head = "[0:v]"
-    vf_tail = "[v]"
-
-
-    # Encode pass
-    if mode == "encode":
-      # For the encode pass, the interest will be <1, so speed_factor should be >1
-      video_filter = f"{vf_head}"
-      speed_factor = 1 / interest
-      source_framerate = get_video_metadata(INPUT_VIDEO)["fps"]
-
-      #target_framerate = get_video_metadata(input_file)["fps"] * speed_factor
-      # Setpts is takes a frequency value, so we use interest.
-      # We don't need to motion interpolate on the encode pass, as just increasing the output framerate will be enough, and faster.
-      video_filter += f"setpts={interest}*PTS"
-      if DEBUG:
-        video_filter += f",drawtext=fontfile=AndaleMono.ttf:text='in encode, fps={source_framerate}, aset fps={source_framerate * speed_factor}':x=(w-text_w)/2:y=(h-text_h)/2:fontsize=48:fontcolor='#4c1659'@0.9"
-      
-
-      # Rubberband version is slower, and preserves the tempo (which isn't necessary, since we're going to slow it down later)
-      # It results in some very interesting decode artifacts.
-      #audio_filter = f"[0:a]rubberband=tempo={speed_factor}[a]"
-
-      # asetrate version. Increases the sample rate, which speeds the audio up, and then resample down to the source sample rate.
-      audio_filter = f"[0:a]asetrate={base_audio_sample_rate}*{speed_factor},aresample={source_audio_sr}[a]" # We can resample to super high quality for processing, but it can cause issues with scenes with interest of 1
-      fr_cmd = ["-r", str(source_framerate)]
-
-
-    # Decode pass
-    if mode == "decode":
-      # For the decode pass, the speed factor will be <1, so we will slow down the video.
-      video_filter = f"{vf_head}"
-      speed_factor = interest # Value to be used to slow down the video
-      source_file_fps = get_video_metadata(INPUT_VIDEO)["fps"]
-      logger.debug(f"{str(source_file_fps)} {target_framerate}")
-
-      # Set the target framerate, which will be higher if we're doing motion interpolation
-      target_framerate = (source_file_fps * speed_factor) if MINTERP else source_file_fps # for minterpolate
-
-      if MINTERP:
-        # https://www.hellocatfood.com/misusing-ffmpegs-motion-interpolation-options/
-        # Interesting.
-        mi_mode = 'blend'
-        if MINTERP == 'mci':
-            mi_mode = 'mci:me_mode=bidir:me=tdls,minterpolate=scd=none'
-
-        video_filter += f"minterpolate=fps={target_framerate},minterpolate=mi_mode={mi_mode},setpts={interest}*PTS"
-      else:
-        video_filter += f"setpts={interest}*PTS"
-
-      if DEBUG:
-        video_filter += f",drawtext=fontfile=AndaleMono.ttf:text='in decode, fps={source_file_fps}':x=(w-text_w)/2:y=((h-text_h)/2)-text_h:fontsize=48:fontcolor='#4c1659'@0.9"
-
-      audio_filter = f"[0:a]asetrate={base_audio_sample_rate}*{1/interest},aresample={source_audio_sr}[a]"
-
-      # Interpolation based filter to reconstruct frames.
-      fr_cmd = ["-r", str(target_framerate)]
-
-    # Final decode pass
-    if mode == "decode-final":
-      # Final decode pass where we're setting the framerate and audio sample rate back to normal.
-      base_audio_sample_rate = get_audio_sample_rate(INPUT_VIDEO)
-      target_framerate = get_video_metadata(INPUT_VIDEO)["fps"]
-      audio_filter = f"[0:a]aresample={base_audio_sample_rate}[a]"
-      video_filter = f"{vf_head}"
-     
-      
-      video_filter += f"null"
-
-      new_kfs = ",".join([str(seg['end']) for seg in segments])
-      fr_cmd = ["-r", str(target_framerate), "-force_key_frames",new_kfs]
-
-    metadata = get_video_metadata(INPUT_VIDEO)
-    logger.debug(f"target framerate: {target_framerate}")
-    logger.debug(metadata)
-    logger.debug(f"source bfps {INPUT_VIDEO} {get_bit_frame_rate(INPUT_VIDEO)}\ntarget bfps {input_file} {get_bit_frame_rate(input_file)}")
-
-    # Add tail at the very end
-    video_filter += vf_tail
-    # If you use high speed intermediaries, there's not as much lost even if it gets dropped down to 30fps.
-    speed_filter = f"{video_filter};{audio_filter}" if audio else video_filter
-
-    # The final command to run
-    ffmpeg_cmd = [
-        "ffmpeg", "-y",
-        "-i", input_file,
-        "-filter_complex", speed_filter, #f"[0:v]setpts={setpts_factor}*PTS[v];[0:a]rubberband=tempo={rubberband_factor}[a]",
-        "-map", "[v]", *[s for s in ["-map", "[a]"] if audio],
-        "-row-mt", "1",  # Enable multi-threading
-        "-c:v", metadata["vcodec"],  # Change to a faster video codec
-        #"-crf", str(metadata["vcrf"]),  # Adjust quality here
-        "-b:v", str(get_bit_frame_rate(INPUT_VIDEO) * target_framerate),  # Adjust bitrate here
-        #"-q:v", str(metadata["vcrf"]), # Value 0-100, 0 is worse, 100 is best (h264_videotoolbox)
-        *[s for s in ["-c:a", metadata["acodec"]] if audio],
-        *[s for s in ["-b:a", str(metadata["abitrate"])] if audio], 
-        #"-q:a", str(metadata["acrf"]), # 0-14
-        #"-ar", "128000",
-        "-fflags", "+genpts",
-        "-avoid_negative_ts", "make_zero",
-        *fr_cmd,
-        "-f", "matroska",
-        output_file
-    ]
-
-    logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
-    result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-    if result.returncode != 0:
-        logger.debug(f"FFmpeg stdout: {result.stdout}")
-        logger.debug(f"FFmpeg stderr: {result.stderr}")
-        raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
-
-
-def concatenate_segments(file_list_path, output_file, metadata, segments=[]):
-    """Concatenate processed segments into a final video file without re-encoding."""
-    logger.info(f"Concatenating segments in {file_list_path} into {output_file}")
-    new_kfs = ",".join([str(seg['end']) for seg in segments])
-    logger.debug(f"Forcing keyframes {new_kfs}")
-    ffmpeg_cmd = [
-        "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", file_list_path,
-        "-c", "copy",  # Copy codec to avoid re-encoding
-        #"-c:a", metadata["acodec"],  
-        #"-af", "[0:a]concat=n=1:v=0:a=1[a]",  # Concatenate audio streams
-        "-fflags", "+genpts",
-        "-avoid_negative_ts", "make_zero",
-        "-reset_timestamps", "1",
-        "-copyts",
-        "-r", str(metadata["fps"]),  # Set the output framerate
-        "-force_key_frames", new_kfs,
-        "-f", "matroska", output_file
-    ]
-    logger.debug(f"Running FFMpeg command: {' '.join(ffmpeg_cmd)}")
-    
-    result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-    #print(f"FFmpeg stdout: {result.stdout}")
-    #print(f"FFmpeg stderr: {result.stderr}")
-
-    if result.returncode != 0:
-        logger.error(f"FFmpeg stdout: {result.stdout}")
-        logger.error(f"FFmpeg stderr: {result.stderr}")
-        raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
-
-
-def split_video(input_file, segments, prefix):
-    """Losslessly split the video file into segments based on the given segment interests."""
-    split_files = []
-    
-    logger.debug(f"Splitting video {input_file} into segments:")
-    logger.debug(f"{segments}")
-
-    segment_times = []
-
-    for i, seg in enumerate(segments):
-        start, end = seg["start"], seg["end"]
-        duration = end - start
-        logger.debug(f"Segment {i}, {duration}")
-        segment_times.append(str(end))# + duration))
-        output_file_template = f"{prefix}_%1d.mkv"  # Use .mkv extension
-        full_output_path_template = os.path.join(TEMP_DIR, output_file_template)
-        outfile = os.path.join(TEMP_DIR, f"{prefix}_{i}.mkv")
-        split_files.append(outfile)
-
-    # Use segment muxer https://stackoverflow.com/questions/44580808/how-to-use-ffmpeg-to-split-a-video-and-then-merge-it-smoothly
-    # https://superuser.com/questions/692714/how-to-split-videos-with-ffmpeg-and-segment-times-option
-    segment_times = ','.join(segment_times)
-    logger.debug(f"{outfile} {seg}")
-    ffmpeg_cmd = [
-        "ffmpeg", "-y",
-        #"-ss", str(start),
-        #"-accurate_seek",
-        "-i", input_file,
-        #"-to", str(end),
-        "-map", "0",
-        #"-f", "matroska",
-        "-c", "copy",
-        "-f", "segment",
-        "-segment_format", "matroska",
-        "-segment_times", segment_times,
-        #"-copyts",
-        "-reset_timestamps", "1",
-        "-fflags", "+genpts",
-        "-avoid_negative_ts", "make_zero",
-        #outfile, # Use .mkv format
-        full_output_path_template,
-    ]
-
-    logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
-    result = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-#logger.debug(f"FFmpeg stdout: {result.stdout}")
-#logger.debug(f"FFmpeg stderr: {result.stderr}")
-
-    if result.returncode != 0:
-        raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
-
-    logger.debug(f"Segments for {input_file} split with times {segments}: {outfile}")
-
-    return split_files
-
 
-def encode_segments(segments_to_encode):
-    """Encode (compress) the segments."""
-    original_duration = get_video_duration(INPUT_VIDEO)
-    split_files = split_video(INPUT_VIDEO, segments_to_encode, "split")
-    compressed_segments = []
-
-    logger.info(f"Beginning encode pass\n{split_files}")
-
-    for i, seg in enumerate(segments_to_encode):
-        interest = seg["interest"]
-
-        # Dynamically infer the filename extension
-        _, ext = os.path.splitext(split_files[i])
-        compressed_file = f"compressed_{i}{ext}"
-        full_compressed_path = os.path.join(TEMP_DIR, compressed_file)
-        compressed_segments.append(full_compressed_path)
-
-        if interest == 1.0:
-            # Skip processing and use the raw split file
-            shutil.copy(split_files[i], full_compressed_path)
-            logger.info(f"Skipping processing for segment {i} with interest {interest}. Using raw split file.")
+def main(argv=None, output_dir=None, thread_limit=THREAD_LIMIT):
+    """Run the command line interface.
+    Args:
+        argv: Arguments, without the program name. Default: sys.argv.
+        output_dir: Directory to write outputs and temp files to, instead of the working directory.
+        thread_limit: Total number of threads for the ffmpeg runs. Default: all of them (or $SHIT_THREADS).
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.farm and (args.pipeline or args.smart_cut):
+        parser.error("--farm can't be combined with --pipeline or --smart_cut")
+    # Only this run's subprocesses go into its trace, even with other runs in the same process
+    with record_spans() if args.trace else nullcontext() as trace:
+        # https://stackoverflow.com/questions/15301147/python-argparse-default-value-or-specified-value
+        # Define input/output filenames
+        output_dir = output_dir or ""
+        input_video = args.input_video
+        # Previews get their own outputs and temp dir, so they never clobber a full run's
+        target_name = "preview_" + args.target_name if args.preview else args.target_name
+        compressed_video = os.path.join(output_dir, "compressed_" + target_name)
+        restored_video = os.path.join(output_dir, "restored_" + target_name)
+        # Split the extension from the filename
+        temp_dir = os.path.join(output_dir, "temp_" + os.path.splitext(target_name)[0])
+
+        # Progress and watchdog settings belong to this run only, other runs in the same process have their own
+        progress = ProgressBoard(progress_file=args.progress_file)
+        run = partial(run_ffmpeg, board=progress, stall_timeout=args.stall_timeout, time_budget=args.time_budget)
+        segment_cache = SegmentCache(args.cache, int(args.cache_size * 1024**3)) if args.cache else None
+        curve = None
+
+        if args.metadata:
+            passes = [load_metadata(metadata_file) for metadata_file in args.metadata]
+            metadata = passes[0]
+            # If the metadata file has probe results for our input, use them instead of probing it again
+            probe_entry = find_probe_entry(metadata, input_video)
+            if probe_entry:
+                seed_probe_cache(input_video, probe_entry["ffprobe"], probe_entry.get("keyframes"))
+            original_duration = metadata["duration"]
+            segments = metadata["segments"]
+            if "curve" in metadata and len(passes) == 1:
+                # Interest curve mode: the whole file follows the curve in one ffmpeg run
+                curve = InterestCurve.from_metadata(metadata["curve"], original_duration)
+                segments = curve.segments()
+            if len(passes) > 1:
+                if any("curve" in p for p in passes):
+                    logger.warning("Interest curves can't be composed, using their piecewise-constant segments instead")
+                # Each pass is relative to the output of the one before, compose them into one pass over the input
+                segments = compose_segment_maps([(p["duration"], p["segments"]) for p in passes])
         else:
-            logger.info(f"Processing segment {i} with interest {interest}. Saving to file {full_compressed_path}")
-            process_segment(split_files[i], full_compressed_path, interest, mode="encode")
-
-        compressed_segment_duration = get_video_duration(full_compressed_path)
-        original_duration = seg["end"] - seg["start"]
-        logger.info(f"Original segment duration: {original_duration}, Compressed segment duration: {compressed_segment_duration}")
-
-    compressed_concat_file = os.path.join(TEMP_DIR, "compressed_list.txt")
-    write_file_list(compressed_concat_file, compressed_segments, TEMP_DIR)
-
-    metadata = get_video_metadata(INPUT_VIDEO)
-    concatenate_segments(compressed_concat_file, COMPRESSED_VIDEO, metadata, segments=get_mutated_segments(segments_to_encode))
-    logger.info(f"Compression complete: saved as {COMPRESSED_VIDEO}")
-
-    return compressed_segments
-
-
-def decode_segments(segments):
-    """Decode (expand) the segments."""
-    #original_duration = get_video_duration(INPUT_VIDEO)
-
-    # This code is now done before calling this function
-    # We need to adjust the segment times to first be relative to the compressed video.
-    # Then we adjust those times to the closest keyframes.
-    #segments_with_pass_through = add_pass_through_segments(segments, original_duration)
-    #mutated_segments = get_mutated_segments(original_duration, segments_with_pass_through)
-    #adjusted_segments = adjust_segments_to_keyframes(COMPRESSED_VIDEO, mutated_segments)
-
-    #adjusted_segments = mutated_segments
-    restored_segments = []
-
-    logger.debug(f"Segments: {segments}")
-    split_files = split_video(COMPRESSED_VIDEO, segments, "decode_pre")
-    logger.info(f"Beginning decode pass\n{split_files}")
-
-    for i, seg in enumerate(segments):
-        interest = seg["interest"]
-        expansion_factor = 1 / interest  # Decompression factor (to restore timing)
-
-        # Dynamically infer the filename extension
-        _, ext = os.path.splitext(COMPRESSED_VIDEO)
-        restored_file = f"restored_{i}{ext}"
-        full_restored_path = os.path.join(TEMP_DIR, restored_file)
-        restored_segments.append(full_restored_path)
-
-        if interest == 1.0:
-            # Skip processing and use the raw split file
-            shutil.copy(split_files[i], full_restored_path)
-            logger.debug(f"Skipping processing for segment {i} with interest {interest}. Using raw split file.")
+            original_duration = get_video_duration(input_video)
+            segments = [
+                {"start": 0, "end": 120, "interest": 0.5},
+            ]
+        logger.info(f"Original file length: {original_duration} seconds")
+
+        source_video = input_video
+        profile = args.profile
+        if args.preview:
+            # Same segment plan, on a small proxy of the source, processed with the fastest profile
+            if not args.decode:
+                source_video = get_proxy(input_video, height=args.preview_height, fps=args.preview_fps, run=run)
+            profile = "fast"
+
+        codec = ShitCodec(
+            source_video,
+            # Decoding only, the input is the compressed file
+            input_video if args.decode else compressed_video,
+            restored_video,
+            temp_dir,
+            minterp=args.minterp,
+            jobs=args.jobs,
+            profile=profile,
+            single_graph=args.single_graph,
+            smart_cut=args.smart_cut,
+            split_segments=args.split_segments,
+            pipeline=args.pipeline,
+            final_reencode=args.final_reencode,
+            atempo=args.atempo,
+            segment_cache=segment_cache,
+            thread_limit=thread_limit,
+            farm=Farm(args.farm, lease=args.farm_lease) if args.farm else None,
+            progress=progress,
+            stall_timeout=args.stall_timeout,
+            time_budget=args.time_budget,
+        )
+        logger.info(codec.describe())
+
+        # A composed map gets its own file, and none of the -t files are ever overwritten, so the same command can be run again
+        composed = args.metadata and len(args.metadata) > 1
+        metadata_file = f"{os.path.splitext(input_video)[0]}{'.preview' if args.preview else ''}{'.composed' if composed else ''}.mshit"
+        if output_dir:
+            # Keep batch runs from writing next to their inputs
+            metadata_file = os.path.join(output_dir, os.path.basename(metadata_file))
+        if any(os.path.abspath(metadata_file) == os.path.abspath(f) for f in args.metadata or []):
+            metadata_file = f"{os.path.splitext(metadata_file)[0]}.encoded.mshit"
+        if args.decode and args.encode:
+            # Nothing to run
+            compressed_duration = curve.compressed_duration() if curve else calculate_compressed_duration(original_duration, segments)
+        elif args.decode:
+            compressed_duration = codec.decode(segments, original_duration, curve=curve)
+        elif args.encode:
+            compressed_duration = codec.encode(segments, original_duration, metadata_file=metadata_file, binary=args.binary_mshit, curve=curve)["compressed_duration"]
         else:
-            logger.debug(f"Processing segment {i} with expansion factor {expansion_factor}. Saving to file {full_restored_path}")
-            process_segment(split_files[i], full_restored_path, expansion_factor, mode="decode")
-
-        compressed_duration = get_video_duration(split_files[i])
-        restored_duration = get_video_duration(full_restored_path)
-        logger.info(f"Compressed segment duration: {compressed_duration}, Restored segment duration: {restored_duration}")
-
-    restored_concat_file = os.path.join(TEMP_DIR, "restored_list.txt")
-    write_file_list(restored_concat_file, restored_segments, TEMP_DIR)
-
-    metadata = get_video_metadata(INPUT_VIDEO)
-
-    high_fps_video = os.path.join(TEMP_DIR, "high_fps.mkv")
-    concatenate_segments(restored_concat_file, high_fps_video, metadata, segments=segments)
-
-    # Reencode to match the framerate to the original video
-    process_segment(high_fps_video, RESTORED_VIDEO, 1.0, mode="decode-final", segments=segments)
-    logger.info(f"Decompression complete: saved as {RESTORED_VIDEO}")
+            compressed_duration = codec.roundtrip(segments, original_duration, metadata_file=metadata_file, binary=args.binary_mshit, curve=curve)
+
+        if args.evaluate:
+            if args.decode or args.encode:
+                logger.warning(f"--evaluate needs a full run, use python evaluate.py <source> {restored_video} -t <metadata> instead")
+            elif codec.audio_only:
+                logger.warning(f"{source_video} has no video, skipping --evaluate")
+            else:
+                report = evaluate(source_video, restored_video, segments, original_duration, samples=args.eval_samples,
+                                  window=args.eval_window, jobs=args.jobs, thread_limit=thread_limit, run=codec.run_ffmpeg)
+                logger.info(f"Quality of {restored_video}:\n{format_report(report)}")
+
+        if args.save_for_next_pass:
+            write_metadata_file(f"{os.path.splitext(args.save_for_next_pass)[0]}.mshit",
+                                compressed_duration,
+                                get_mutated_segments(segments),
+                                binary=args.binary_mshit,
+                                curve=curve.rebased() if curve else None)
+
+        if segment_cache:
+            segment_cache.evict()
+            cache_stats = segment_cache.report()
+            logger.info(f"Segment cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['bytes_saved'] / 1024**2:.1f} MiB saved")
+
+        if trace is not None:
+            write_chrome_trace(args.trace, trace.spans)
+            logger.info(f"Subprocess time by stage:\n{format_summary(trace.spans)}")
 
 
 if __name__ == "__main__":
-    original_duration = get_video_duration(INPUT_VIDEO)
-    logger.info(f"Original file length: {original_duration} seconds")
-
-    metadata_file = args.metadata if args.metadata else f"{os.path.splitext(INPUT_VIDEO)[0]}.mshit"
-
-    if args.metadata:
-        with open(metadata_file, "r") as f:
-            metadata = eval(f.read()) # TODO: Not this... this is terrible
-            original_duration = metadata["duration"]
-            SEGMENTS = metadata["segments"]
-    else:
-        SEGMENTS = [
-            {"start": 0, "end": 120, "interest": 0.5},
-        ]
-
-#    if INPUT_VIDEO == "bee_movie.mkv":
-#        SEGMENTS = BEE_SEGMENTS
-#    if INPUT_VIDEO == "SHORTBEE.mkv":
-#        SEGMENTS = SHORTBEE
-
-    # Add pass-thru segments, then adjust segments to keyframes
-    pass_thru = add_pass_through_segments(SEGMENTS, original_duration)
-    encode_adjusted_segments = adjust_segments_to_keyframes(INPUT_VIDEO, pass_thru, TEMP_DIR)
-    logger.info(f"Adjusted segments: {encode_adjusted_segments}, Original segments: {pass_thru}")
-
-
-
-    
-    DEBUG = False
-    skip_encode = False
-    skip_decode = False
-    if args.decode:
-       skip_encode = True
-    if args.encode:
-        skip_decode = True
-    
-
-    if not skip_encode:
-        logger.info(get_video_metadata(INPUT_VIDEO))
-        compressed_segments = encode_segments(encode_adjusted_segments)
-        #compressed_segments = encode_segments(pass_thru)
-        # Write metadata file after encoding
-        write_metadata_file(f"{os.path.splitext(INPUT_VIDEO)[0]}.mshit", original_duration, SEGMENTS)
-    if skip_encode:
-        #if INPUT_VIDEO == "compressed_SHORBE.mkv" or INPUT_VIDEO == "restored_SHORBE.mkv":
-        COMPRESSED_VIDEO = INPUT_VIDEO
-        pass
-        #compresed_segments = [TEMP_DIR + "/compressed_" + str(i) + ".mkv" for i in range(len(SEGMENTS))]
-        #compressed_segments = ["temp_hip/compressed_0.mkv", "temp_hip/compressed_1.mkv", "temp_hip/compressed_2.mkv", "temp_hip/compressed_3.mkv", "temp_hip/compressed_4.mkv", "temp_hip/compressed_5.mkv"]
-        #compressed_segments = ["temp_trail/compressed_0.mkv", "temp_trail/compressed_1.mkv", "temp_trail/compressed_2.mkv", "temp_trail/compressed_3.mkv"]
-        #if INPUT_VIDEO == "compressed_SHORBE.mkv":
-           
-
-        # SHORTBEE dir: temp_SHEE
-        #  compressed_segments = ["temp_SHEE/compressed_0.mkv", "temp_SHEE/compressed_1.mkv"]
-
-    #estimated_compressed_duration = calculate_compressed_duration(original_duration, encode_adjusted_segments)
-    #logger.info(f"Estimated compressed duration: {estimated_compressed_duration} seconds")
-
-    ## Calculate estimated expanded duration based on compressed duration
-    #estimated_expanded_duration = calculate_expanded_duration(estimated_compressed_duration, encode_adjusted_segments)
-    #logger.info(f"Estimated expanded duration: {estimated_expanded_duration} seconds")
-
-    if not skip_decode:
-        # Rebase the original segments to be relative to the compressed video
-        compressed_duration = get_video_duration(COMPRESSED_VIDEO)
-        # Add pass thrus to the rebased segments
-        decode_pass_thru_segments = add_pass_through_segments(SEGMENTS, compressed_duration)
-        rebased_segments = get_mutated_segments(decode_pass_thru_segments)
-        # Adjust the rebased segments to keyframes
-        decode_adjusted_segments = adjust_segments_to_keyframes(COMPRESSED_VIDEO, rebased_segments, TEMP_DIR)
-        logger.debug(f"Adjusted segments: {decode_adjusted_segments}, Original segments: {decode_pass_thru_segments}")
-        decode_segments(decode_adjusted_segments)
-    if skip_decode:
-        compressed_duration = calculate_compressed_duration(original_duration, SEGMENTS)
-
-    if args.save_for_next_pass:
-        write_metadata_file(f"{os.path.splitext(args.save_for_next_pass)[0]}.mshit",
-                            compressed_duration,
-                            get_mutated_segments(SEGMENTS))
-
-    # For testing
-    #concatenate_segments("temp/restored_list.txt", RESTORED_VIDEO, get_video_metadata(INPUT_VIDEO))
-
-#process_segment(INPUT_VIDEO, "test.mp4", 0.5, mode="decode")
\ No newline at end of file
+    main()
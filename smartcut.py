@@ -0,0 +1,62 @@
+from bisect import bisect_left, bisect_right
+from logging_config import logger
+from progress import run_ffmpeg
+
+# Smart cutting: cut a file at exact timestamps without re-encoding all of it.
+# Whole GOPs inside a cut range are stream copied, and only the partial GOPs at its edges are re-encoded.
+
+
+def plan_smart_cut(start, end, keyframes, duration, tolerance=0.001):
+    """Split the range [start, end) into pieces that can be stream copied and pieces that must be re-encoded.
+    Args:
+        start, end: The exact range to cut.
+        keyframes: Sorted keyframe times of the file.
+        duration: Duration of the file. The end of the file counts as a keyframe.
+        tolerance: Keyframes this close to start/end count as being on them (e.g. half a frame).
+    Returns:
+        A list of ("copy"|"encode", start, end) tuples covering the range in order.
+    """
+    # The first keyframe at or after start, and the last one at or before end
+    i = bisect_left(keyframes, start - tolerance)
+    k_in = keyframes[i] if i < len(keyframes) else None
+    if end >= duration - tolerance:
+        k_out = end
+    else:
+        j = bisect_right(keyframes, end + tolerance) - 1
+        k_out = keyframes[j] if j >= 0 else None
+
+    if k_in is None or k_out is None or k_in >= k_out:
+        # No whole GOP in the range
+        return [("encode", start, end)]
+
+    pieces = []
+    if k_in - start > tolerance:
+        pieces.append(("encode", start, k_in))
+    pieces.append(("copy", k_in, k_out))
+    if end - k_out > tolerance:
+        pieces.append(("encode", k_out, end))
+    return pieces
+
+
+def copy_range(input_file, output_file, start, end, run=run_ffmpeg):
+    """Stream copy [start, end) of a file. start must be a keyframe for the cut to be exact.
+    run: Function to run ffmpeg with, e.g. a codec's run_ffmpeg."""
+    ffmpeg_cmd = [
+        "ffmpeg", "-y",
+        # Input seeking lands exactly on start when it's a keyframe
+        "-ss", str(start),
+        "-i", input_file,
+        "-t", str(end - start),
+        "-map", "0",
+        "-c", "copy",
+        "-fflags", "+genpts",
+        "-avoid_negative_ts", "make_zero",
+        "-f", "matroska",
+        output_file
+    ]
+    logger.info(f"Running FFmpeg command: {' '.join(ffmpeg_cmd)}")
+    result = run(ffmpeg_cmd, expected_duration=end - start)
+
+    if result.returncode != 0:
+        logger.debug(f"FFmpeg stderr: {result.stderr}")
+        raise RuntimeError(f"FFmpeg command failed with return code {result.returncode}")
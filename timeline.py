@@ -0,0 +1,139 @@
+import numpy as np
+from math import isclose
+
+# Array-backed segment timelines.
+# Segment lists are passed around as lists of {"start", "end", "interest"} dicts, which is fine for a handful of
+# hand-written segments, but automatic analysis produces one per second or so. A Timeline keeps the same segments as
+# three contiguous float64 arrays, and does the planning operations (gap filling, rebasing onto the compressed
+# timeline, duration math, keyframe snapping, merging) with whole-array numpy operations instead of Python loops.
+
+
+class Timeline:
+    """A list of segments, stored as start, end and interest arrays.
+    Args:
+        start, end, interest: Sequences of the same length, converted to float64 arrays.
+    """
+
+    __slots__ = ("start", "end", "interest")
+
+    def __init__(self, start=(), end=(), interest=()):
+        self.start = np.asarray(start, dtype=np.float64)
+        self.end = np.asarray(end, dtype=np.float64)
+        self.interest = np.asarray(interest, dtype=np.float64)
+
+    @classmethod
+    def from_segments(cls, segments):
+        """Build a Timeline from a list of segment dicts."""
+        if isinstance(segments, Timeline):
+            return segments
+        count = len(segments)
+        start = np.fromiter((seg["start"] for seg in segments), dtype=np.float64, count=count)
+        end = np.fromiter((seg["end"] for seg in segments), dtype=np.float64, count=count)
+        interest = np.fromiter((seg["interest"] for seg in segments), dtype=np.float64, count=count)
+        return cls(start, end, interest)
+
+    def to_segments(self):
+        """The segments as a list of dicts with plain float values."""
+        return [{"start": s, "end": e, "interest": i}
+                for s, e, i in zip(self.start.tolist(), self.end.tolist(), self.interest.tolist())]
+
+    def __len__(self):
+        return len(self.start)
+
+    def __repr__(self):
+        return f"Timeline({len(self)} segments)"
+
+    def durations(self):
+        """Duration of each segment."""
+        return self.end - self.start
+
+    def compressed_durations(self):
+        """Duration of each segment once it's sped up by its interest."""
+        return self.durations() * self.interest
+
+    def with_pass_through(self, duration):
+        """Fill the gaps before, between and after the segments with pass-through segments (interest 1).
+        Like add_pass_through_segments: a first segment starting within a second of 0 counts as starting at 0, and
+        a last segment ending within a second of the end counts as ending there. Segments themselves are unchanged.
+        """
+        if not len(self):
+            return Timeline([0.0], [duration], [1.0]) if duration >= 1 else Timeline()
+        previous_end = np.concatenate(([0.0], self.end[:-1]))
+        gap = np.where(self.start < 1, 0.0, self.start) > previous_end
+        # Each segment moves back by the number of gaps up to and including its own, which go in front of it
+        positions = np.arange(len(self)) + np.cumsum(gap)
+        gap_positions = positions[gap] - 1
+
+        last_end = self.end[-1] if self.end[-1] <= duration - 1 else duration
+        tail = last_end < duration
+        size = len(self) + int(gap.sum()) + int(tail)
+        start = np.empty(size)
+        end = np.empty(size)
+        interest = np.ones(size)
+        start[positions], end[positions], interest[positions] = self.start, self.end, self.interest
+        start[gap_positions], end[gap_positions] = previous_end[gap], self.start[gap]
+        if tail:
+            start[-1], end[-1] = last_end, duration
+        return Timeline(start, end, interest)
+
+    def completed(self, duration):
+        """Add pass-through segments and close any remaining gaps, so the segments cover [0, duration) contiguously.
+        Segments that end before the ones ahead of them are dropped.
+        """
+        filled = self.with_pass_through(duration)
+        previous_end = np.concatenate(([0.0], np.maximum.accumulate(filled.end)[:-1]))
+        keep = filled.end > previous_end
+        return Timeline(previous_end[keep], filled.end[keep], filled.interest[keep])
+
+    def rebased(self):
+        """The segments laid end to end on the compressed timeline, each sped up by its interest."""
+        end = np.cumsum(self.compressed_durations())
+        start = np.concatenate(([0.0], end[:-1]))
+        return Timeline(start, end, self.interest)
+
+    def compressed_duration(self, original_duration):
+        """Duration of a video of original_duration once the segments are sped up. The rest plays at normal speed."""
+        return float(original_duration + (self.compressed_durations() - self.durations()).sum())
+
+    def expanded_duration(self, compressed_duration):
+        """Duration of a compressed video of compressed_duration once the segments are slowed back down."""
+        return float(compressed_duration + (self.durations() - self.compressed_durations()).sum())
+
+    def snapped(self, keyframes, duration):
+        """Move every segment boundary to the nearest keyframe, ties going to the earlier one.
+        Like adjust_segments_to_keyframes: the last segment's end is moved to duration if it's within 10% of it,
+        and the first segment's start to 0 if it's at 0.
+        Args:
+            keyframes: Sorted keyframe times.
+            duration: Duration of the video.
+        """
+        keyframes = np.asarray(keyframes, dtype=np.float64)
+        start, end = _nearest(keyframes, self.start), _nearest(keyframes, self.end)
+        if len(self) and isclose(end[-1], duration, rel_tol=0.1):
+            end[-1] = duration
+        if len(self) > 1 and isclose(start[0], 0.0, rel_tol=0.1):
+            start[0] = 0.0
+        return Timeline(start, end, self.interest)
+
+    def merged(self):
+        """Merge runs of adjacent segments with the same interest."""
+        if not len(self):
+            return Timeline()
+        joins = np.zeros(len(self), dtype=bool)
+        joins[1:] = (self.interest[1:] == self.interest[:-1]) & _isclose(self.end[:-1], self.start[1:])
+        first = np.flatnonzero(~joins)
+        last = np.append(first[1:], len(self)) - 1
+        return Timeline(self.start[first], self.end[last], self.interest[first])
+
+
+def _isclose(a, b, rel_tol=1e-09):
+    """Elementwise math.isclose. np.isclose scales its tolerance by b only."""
+    return np.abs(a - b) <= rel_tol * np.maximum(np.abs(a), np.abs(b))
+
+
+def _nearest(keyframes, times):
+    """Nearest keyframe to each time, ties going to the earlier one, like pktindex.nearest_keyframe."""
+    i = np.searchsorted(keyframes, times, side="left")
+    before = keyframes[np.maximum(i - 1, 0)]
+    after = keyframes[np.minimum(i, len(keyframes) - 1)]
+    return np.where((i > 0) & ((times - before <= after - times) | (i == len(keyframes))), before, after)
@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextvars
+import subprocess
+from functools import partial
+from contextlib import contextmanager
+from platform import system
+from logging_config import logger
+
+# Subprocess tracing. Every ffmpeg/ffprobe run goes through TracedPopen (or traced_run(), its subprocess.run equivalent),
+# which records a span when the process exits:
+#   tool, stage (the calling function, unless given), segment (the scheduler task index, if any),
+#   wall time, child CPU time and max RSS (from wait4's rusage), and bytes in (input files) and out (output file and pipes).
+# Spans can be exported as Chrome trace-event JSON (chrome://tracing, Perfetto) and summarized per stage.
+# Spans are only recorded inside record_spans(), into that call's SpanRecorder, which is found through a context
+# variable. Code that hands work to other threads wraps it in in_current_context(), so several traced runs can share a
+# process without seeing each other's spans, and untraced runs record nothing.
+
+_context = threading.local()
+_recorder = contextvars.ContextVar("span_recorder", default=None)
+
+# ru_maxrss is in kilobytes on Linux and bytes on macOS
+RSS_UNIT = 1 if system() == "Darwin" else 1024
+
+
+def set_segment(segment):
+    """Set the segment index spans started from this thread are attributed to."""
+    _context.segment = segment
+
+
+def current_segment():
+    return getattr(_context, "segment", None)
+
+
+class SpanRecorder:
+    """The spans recorded by one record_spans() call. Span start times are relative to its creation."""
+
+    def __init__(self):
+        self.spans = []
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+
+@contextmanager
+def record_spans():
+    """Record the spans of the subprocesses started in this context, and in work handed on with in_current_context().
+    Yields:
+        The SpanRecorder.
+    """
+    recorder = SpanRecorder()
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+def in_current_context(fn):
+    """Wrap fn to run in a copy of the calling thread's context, for handing to another thread, so the subprocesses it
+    starts are recorded with this thread's. Each wrapper should be called once."""
+    return partial(contextvars.copy_context().run, fn)
+
+
+def _calling_stage():
+    """Name of the first function on the stack outside this module."""
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else None
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+def _command_files(cmd):
+    """Guess a command's input files (the arguments of -i, or the last argument for ffprobe) and output file (ffmpeg's last argument)."""
+    tool = os.path.basename(cmd[0])
+    if tool.startswith("ffprobe"):
+        return [cmd[-1]], None
+    inputs = [cmd[i + 1] for i, arg in enumerate(cmd[:-1]) if arg == "-i"]
+    output = cmd[-1] if tool.startswith("ffmpeg") and cmd[-1] != "-" else None
+    return inputs, output
+
+
+class TracedPopen(subprocess.Popen):
+    """subprocess.Popen that records a span for the process when it exits.
+    Args:
+        stage: What the process is part of. Default: the calling function's name.
+        segment: Segment index. Default: the one set for this thread by the scheduler.
+    """
+
+    def __init__(self, args, *popen_args, stage=None, segment=None, **kwargs):
+        self.stage = stage if stage is not None else _calling_stage()
+        self.segment = segment if segment is not None else current_segment()
+        self.rusage = None
+        self.piped_bytes = 0
+        self._traced = False
+        self._recorder = _recorder.get()
+        self._inputs, self._output = _command_files([str(arg) for arg in args])
+        self._bytes_in = sum(_file_size(path) for path in self._inputs) if self._recorder is not None else 0
+        self._span_start = time.perf_counter()
+        super().__init__(args, *popen_args, **kwargs)
+
+    if hasattr(os, "wait4"):
+        def _try_wait(self, wait_flags):
+            # Same as Popen's, but with wait4 so we get the child's resource usage
+            try:
+                (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+                if pid == self.pid:
+                    self.rusage = rusage
+            except ChildProcessError:
+                pid = self.pid
+                sts = 0
+            return (pid, sts)
+
+    def __exit__(self, exc_type, value, traceback):
+        super().__exit__(exc_type, value, traceback)
+        self.record_span()
+
+    def record_span(self):
+        """Record the span of this process, once it has exited, if it was started while recording spans."""
+        if self._traced or self.returncode is None or self._recorder is None:
+            return
+        self._traced = True
+        end = time.perf_counter()
+        span = {
+            "tool": os.path.basename(str(self.args[0])),
+            "stage": self.stage,
+            "segment": self.segment,
+            "start": self._span_start - self._recorder.start_time,
+            "wall_time": end - self._span_start,
+            "cpu_time": self.rusage.ru_utime + self.rusage.ru_stime if self.rusage else None,
+            "max_rss": self.rusage.ru_maxrss * RSS_UNIT if self.rusage else None,
+            "bytes_in": self._bytes_in,
+            "bytes_out": _file_size(self._output) + self.piped_bytes,
+            "returncode": self.returncode,
+            "thread": threading.get_ident(),
+        }
+        self._recorder.add(span)
+
+
+def traced_run(args, stage=None, segment=None, check=False, **kwargs):
+    """subprocess.run, traced. Takes the same arguments, plus stage and segment as for TracedPopen."""
+    with TracedPopen(args, stage=stage, segment=segment, **kwargs) as proc:
+        try:
+            stdout, stderr = proc.communicate()
+        except BaseException:
+            proc.kill()
+            raise
+        proc.piped_bytes = len(stdout or "")
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+
+def write_chrome_trace(path, spans):
+    """Write spans as Chrome trace-event JSON, one complete ("X") event per process, one track per thread."""
+    threads = {}
+    events = []
+    for span in spans:
+        tid = threads.setdefault(span["thread"], len(threads))
+        name = span["stage"] if span["segment"] is None else f"{span['stage']} #{span['segment']}"
+        events.append({
+            "name": name,
+            "cat": span["tool"],
+            "ph": "X",
+            "ts": round(span["start"] * 1e6),
+            "dur": round(span["wall_time"] * 1e6),
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": {k: v for k, v in span.items() if k not in ("start", "thread")},
+        })
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    logger.info(f"Wrote {len(events)} spans to {path}")
+
+
+def summarize_spans(spans):
+    """Total the spans per stage and tool.
+    Returns:
+        A list of dicts sorted by total wall time, longest first.
+    """
+    totals = {}
+    for span in spans:
+        total = totals.setdefault((span["stage"], span["tool"]), {
+            "stage": span["stage"], "tool": span["tool"], "count": 0, "wall_time": 0.0,
+            "cpu_time": 0.0, "max_rss": 0, "bytes_in": 0, "bytes_out": 0,
+        })
+        total["count"] += 1
+        total["wall_time"] += span["wall_time"]
+        total["cpu_time"] += span["cpu_time"] or 0.0
+        total["max_rss"] = max(total["max_rss"], span["max_rss"] or 0)
+        total["bytes_in"] += span["bytes_in"]
+        total["bytes_out"] += span["bytes_out"]
+    return sorted(totals.values(), key=lambda t: t["wall_time"], reverse=True)
+
+
+def format_summary(spans):
+    """Format the per-stage totals as a table."""
+    rows = [("stage", "tool", "count", "wall s", "cpu s", "max rss MiB", "in MiB", "out MiB")]
+    for t in summarize_spans(spans):
+        rows.append((str(t["stage"]), t["tool"], str(t["count"]), f"{t['wall_time']:.2f}", f"{t['cpu_time']:.2f}",
+                     f"{t['max_rss'] / 1024**2:.1f}", f"{t['bytes_in'] / 1024**2:.1f}", f"{t['bytes_out'] / 1024**2:.1f}"))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)